@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from .query_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+def text_digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# Persistent cache of generated answers. An exact hit needs the same model,
+# system prompt, retrieved context and normalised question. The optional
+# near-duplicate lookup relaxes only the question: it compares question
+# embeddings among entries that share the model, prompt and context, so a
+# reused answer is always grounded in the same retrieved text. Each entry
+# remembers which documents contributed to its context so removing a document
+# drops every answer built on it.
+class AnswerCache:
+    def __init__(self, path, max_entries=1000, similarity_threshold=None):
+        self.path = path
+        self.max_entries = max(1, int(max_entries))
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                scope TEXT NOT NULL,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                embedding BLOB,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS answers_by_scope ON answers (scope);
+            CREATE TABLE IF NOT EXISTS answer_sources (
+                key TEXT NOT NULL,
+                source TEXT NOT NULL,
+                PRIMARY KEY (key, source)
+            );
+            CREATE INDEX IF NOT EXISTS answer_sources_by_source ON answer_sources (source);
+        """)
+        self._conn.commit()
+
+    def _scope(self, model, system_prompt, context):
+        return text_digest(f"{model}\0{text_digest(system_prompt)}\0{text_digest(context)}")
+
+    def lookup(self, model, system_prompt, context, question, embedding=None):
+        scope = self._scope(model, system_prompt, context)
+        key = text_digest(f"{scope}\0{normalize_query(question)}")
+        with self._lock:
+            row = self._conn.execute("SELECT answer FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                self._touch(key)
+                return row[0]
+
+            if self.similarity_threshold is not None and embedding is not None:
+                query = np.asarray(embedding, dtype=np.float32)
+                query /= np.linalg.norm(query) or 1.0
+                best_key, best_answer, best_score = None, None, self.similarity_threshold
+                for candidate_key, answer, blob in self._conn.execute(
+                    "SELECT key, answer, embedding FROM answers WHERE scope = ? AND embedding IS NOT NULL", (scope,)
+                ):
+                    score = float(np.frombuffer(blob, dtype=np.float32) @ query)
+                    if score >= best_score:
+                        best_key, best_answer, best_score = candidate_key, answer, score
+                if best_key is not None:
+                    self.semantic_hits += 1
+                    self._touch(best_key)
+                    logger.info(f"Answer cache near-duplicate hit (similarity {best_score:.3f})")
+                    return best_answer
+
+            self.misses += 1
+            return None
+
+    def _touch(self, key):
+        with self._conn:
+            self._conn.execute("UPDATE answers SET last_used = ? WHERE key = ?", (time.time(), key))
+
+    def store(self, model, system_prompt, context, question, answer, sources, embedding=None):
+        scope = self._scope(model, system_prompt, context)
+        key = text_digest(f"{scope}\0{normalize_query(question)}")
+        blob = None
+        if embedding is not None:
+            vector = np.asarray(embedding, dtype=np.float32)
+            blob = (vector / (np.linalg.norm(vector) or 1.0)).tobytes()
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers (key, scope, question, answer, embedding, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, scope, question, answer, blob, now, now),
+            )
+            self._conn.execute("DELETE FROM answer_sources WHERE key = ?", (key,))
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO answer_sources (key, source) VALUES (?, ?)",
+                [(key, source) for source in set(sources) if source],
+            )
+            self._evict()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        stale = [key for (key,) in self._conn.execute(
+            "SELECT key FROM answers ORDER BY last_used LIMIT ?", (count - self.max_entries,)
+        )]
+        self._delete_keys(stale)
+
+    def _delete_keys(self, keys):
+        self._conn.executemany("DELETE FROM answers WHERE key = ?", [(key,) for key in keys])
+        self._conn.executemany("DELETE FROM answer_sources WHERE key = ?", [(key,) for key in keys])
+
+    def invalidate_sources(self, sources):
+        with self._lock, self._conn:
+            keys = set()
+            for source in sources:
+                keys.update(key for (key,) in self._conn.execute(
+                    "SELECT key FROM answer_sources WHERE source = ?", (source,)
+                ))
+            self._delete_keys(keys)
+        if keys:
+            logger.info(f"Invalidated {len(keys)} cached answers for {', '.join(sources)}")
+        return len(keys)
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def replay(answer):
+    # Streams a cached answer in word-sized pieces, like generate_stream
+    for piece in re.findall(r"\s*\S+", answer):
+        yield piece
+
+
+def record(stream, on_complete):
+    # Passes pieces through and hands the full answer to on_complete only if
+    # the stream finished; cancelled or failed generations are not cached.
+    # Closing this generator closes the wrapped stream, so a consumer going
+    # away reaches the scheduler and cancels the generation.
+    pieces = []
+    try:
+        for piece in stream:
+            pieces.append(piece)
+            yield piece
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+    on_complete("".join(pieces))
@@ -0,0 +1,271 @@
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.document_processor import (
+    UploadedDocument, process_documents, get_document_catalog, remove_document,
+    get_ingest_job_runner, submit_ingest_job, get_ingest_job, list_ingest_jobs, is_read_only
+)
+from app.index_bundle import ReadOnlyIndexError
+from app.model_handler import ModelHandler
+from app.scheduler import SchedulerBusyError
+from app.prompts import get_system_prompt, build_rag_prompt, build_chat_prompt, get_cache_prefixes, get_context_budget
+from app.rag import (
+    build_context, get_query_cache_stats, get_answer_cache_stats, get_telemetry_summary, stream_answer,
+    get_conversation, get_conversation_stats, clear_conversation
+)
+from app.telemetry import get_telemetry, start_trace
+from app.utils import load_config, get_config_value, cache_resource
+
+# Headless HTTP API next to the Streamlit UI:
+#   uvicorn app.api:app --host 0.0.0.0 --port 8000
+# or `python -m app.api`, which reads api_host / api_port from the config.
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+config = load_config()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Picks up ingestion jobs that a restart interrupted
+    if not is_read_only():
+        get_ingest_job_runner()
+    yield
+
+
+app = FastAPI(title="Airgapped Offline RAG API", lifespan=lifespan)
+
+
+@app.exception_handler(ReadOnlyIndexError)
+async def read_only_index(request, exc):
+    # Adding or removing documents while a prebuilt index bundle is served
+    return JSONResponse(status_code=409, content={"detail": str(exc)})
+
+
+class QueryRequest(BaseModel):
+    question: str
+    top_k: Optional[int] = None
+
+
+class ChatRequest(BaseModel):
+    question: str
+    model: Optional[str] = None
+    use_rag: bool = True
+    top_k: Optional[int] = None
+    session_id: Optional[str] = None
+
+
+@cache_resource
+def get_model_handler():
+    model_handler = ModelHandler(config)
+    if get_config_value(config, 'model_pool_warmup', True):
+        model_handler.warm_up()
+    return model_handler
+
+
+def resolve_model_choice(model_handler, model_choice):
+    if not model_handler.available_models:
+        raise HTTPException(status_code=503, detail="No models are available")
+    if model_choice is None:
+        return model_handler.available_models[0]
+    if model_choice not in model_handler.available_models:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Model {model_choice} is not available. Available models: {', '.join(model_handler.available_models)}"
+        )
+    return model_choice
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok"}
+
+
+@app.get("/models")
+def list_models():
+    return {"models": get_model_handler().available_models}
+
+
+@app.get("/documents")
+def list_documents():
+    return {"documents": get_document_catalog()}
+
+
+@app.put("/documents/{name}")
+async def ingest_document(name: str, request: Request, background: bool = False):
+    # The request body is the raw PDF, e.g.
+    #   curl -X PUT --data-binary @report.pdf localhost:8000/documents/report.pdf
+    # With ?background=true it is queued as an ingestion job and the reply
+    # carries the job id to poll at /jobs/{job_id}.
+    if name != os.path.basename(name) or not name.lower().endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="Document name must be a plain .pdf file name")
+    data = await request.body()
+    if not data:
+        raise HTTPException(status_code=400, detail="Request body is empty")
+
+    if background:
+        job_id = await run_in_threadpool(submit_ingest_job, [UploadedDocument(name, data)])
+        return JSONResponse(status_code=202, content={"document": name, "job_id": job_id})
+
+    try:
+        num_chunks = await run_in_threadpool(process_documents, [UploadedDocument(name, data)])
+    except ReadOnlyIndexError:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing document {name}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing document: {str(e)}")
+    return {"document": name, "chunks_added": num_chunks}
+
+
+@app.delete("/documents/{name}")
+def delete_document(name: str):
+    removed = remove_document(name)
+    if not removed:
+        raise HTTPException(status_code=404, detail=f"No embeddings found for document: {name}")
+    return {"document": name, "removed": True}
+
+
+@app.get("/jobs")
+def list_jobs(limit: int = 20):
+    return {"jobs": list_ingest_jobs(limit)}
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    # Pages parsed, chunks embedded, per-file status and an ETA
+    job = get_ingest_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No ingestion job {job_id}")
+    return job
+
+
+@app.post("/query")
+def query(request: QueryRequest):
+    top_k = request.top_k or config['top_k']
+    started = time.perf_counter()
+    trace = start_trace("query", question=request.question, top_k=top_k)
+    context, accounting = build_context(request.question, top_k=top_k)
+    record = get_telemetry(config).write(trace)
+    return {
+        "context": context,
+        "accounting": accounting,
+        "seconds": round(time.perf_counter() - started, 4),
+        "timings": record["seconds"],
+        "query_cache": get_query_cache_stats(),
+    }
+
+
+@app.get("/stats")
+def stats():
+    model_handler = get_model_handler()
+    return {
+        "scheduler": model_handler.get_scheduler_metrics(),
+        "model_pool": model_handler.get_pool_metrics(),
+        "prefix_cache": model_handler.get_prefix_cache_stats(),
+        "speculative": model_handler.get_speculative_stats(),
+        "query_cache": get_query_cache_stats(),
+        "answer_cache": get_answer_cache_stats(),
+        "conversations": get_conversation_stats(),
+        "telemetry": get_telemetry_summary(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    # Prometheus text exposition of the request telemetry; off by default
+    if not get_config_value(config, 'prometheus_metrics', False):
+        raise HTTPException(status_code=404, detail="Prometheus metrics are disabled")
+    return PlainTextResponse(get_telemetry(config).prometheus_text(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/chat")
+def chat(request: ChatRequest, http_request: Request):
+    # Streams the answer as server-sent events: one "token" event per
+    # generated piece, then "done" with the full answer (or "error").
+    # Requests from the same session_id (default: the client address) queue
+    # behind each other; different sessions are served round-robin. Only an
+    # explicit session_id keeps a conversation, so follow-up questions see
+    # the earlier turns.
+    model_handler = get_model_handler()
+    model_choice = resolve_model_choice(model_handler, request.model)
+    top_k = request.top_k or config['top_k']
+    session_id = request.session_id or (http_request.client.host if http_request.client else "anonymous")
+    start_trace("api_chat", question=request.question, model=model_choice, use_rag=request.use_rag, session_id=session_id)
+
+    conversation = get_conversation(model_handler, model_choice, request.session_id)
+    history, summary = conversation.snapshot() if conversation is not None else ([], "")
+
+    cache_prefixes = None
+    system_prompt, context = "", ""
+    if request.use_rag:
+        token_budget, count_tokens = get_context_budget(request.question, model_handler, model_choice, history, summary)
+        context, accounting = build_context(request.question, top_k=top_k, token_budget=token_budget, count_tokens=count_tokens)
+        system_prompt = get_system_prompt()
+        full_prompt = build_rag_prompt(system_prompt, context, request.question, history, summary)
+        cache_prefixes = get_cache_prefixes(system_prompt, context)
+    else:
+        accounting = {}
+        full_prompt = build_chat_prompt(request.question, history, summary)
+
+    try:
+        stream, cached = stream_answer(
+            model_handler, model_choice, request.question, full_prompt,
+            system_prompt=system_prompt, context=context,
+            sources=[chunk['source'] for chunk in accounting.get('chunks', [])],
+            cache_prefixes=cache_prefixes, session_id=session_id, conversation=conversation
+        )
+    except SchedulerBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+    def events():
+        yield sse_event("context", {"model": model_choice, "cached": cached, "chunks": accounting.get("chunks", [])})
+        answer = ""
+        try:
+            for token in stream:
+                answer += token
+                yield sse_event("token", {"text": token})
+        except Exception as e:
+            logger.error(f"Error generating response: {str(e)}")
+            yield sse_event("error", {"detail": str(e)})
+            return
+        finally:
+            # Cancels the generation, queued or running, if the client went away
+            stream.close()
+        yield sse_event("done", {"answer": answer})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.delete("/sessions/{session_id}")
+def delete_session(session_id: str):
+    # Forgets the conversation and its cached llama.cpp state
+    if not clear_conversation(get_model_handler(), session_id):
+        raise HTTPException(status_code=404, detail=f"No conversation for session: {session_id}")
+    return {"session_id": session_id, "cleared": True}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        app,
+        host=get_config_value(config, 'api_host', "127.0.0.1"),
+        port=get_config_value(config, 'api_port', 8000)
+    )
@@ -0,0 +1,335 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+# One-shot CPU autotuner for llama.cpp. Short prefill and decode
+# micro-benchmarks of the configured GGUF pick the thread counts, batch size
+# and mmap/mlock options, and the winners are written to a per-host profile
+# that ModelHandler.load_model applies automatically.
+#
+#   python -m app.autotune --output autotune.json
+
+PROFILE_VERSION = 1
+MEMORY_OPTIONS = {
+    "mmap": {"use_mmap": True, "use_mlock": False},
+    "mmap+mlock": {"use_mmap": True, "use_mlock": True},
+    "no-mmap": {"use_mmap": False, "use_mlock": False},
+}
+DEFAULT_MEMORY_OPTION = "mmap"
+# Decode speeds within this fraction of the best count as a tie, which the
+# faster load breaks
+DECODE_TOLERANCE = 0.03
+SAMPLE_TEXT = (
+    "The maintenance manual lists the inspection schedule for every pump, valve and sensor in the plant. "
+    "Operators record pressure readings at the start of each shift and report alarms to the control room. "
+)
+
+_profiles = {}
+
+
+def host_id():
+    # Container hostnames change on every run, so hosts are told apart by
+    # their CPU instead: architecture, usable CPUs and the CPU model name
+    cpu_model = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu_model = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    digest = hashlib.sha256(cpu_model.encode("utf-8")).hexdigest()[:8]
+    return f"{platform.machine() or 'cpu'}-{usable_cpus()}cpu-{digest}"
+
+
+def usable_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def physical_cores():
+    cores = set()
+    physical_id = None
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                if key == "physical id":
+                    physical_id = value.strip()
+                elif key == "core id":
+                    cores.add((physical_id, value.strip()))
+    except OSError:
+        pass
+    return min(len(cores), usable_cpus()) if cores else max(1, usable_cpus() // 2)
+
+
+def thread_candidates():
+    cpus = usable_cpus()
+    candidates = {cpus, physical_cores()}
+    count = 1
+    while count < cpus:
+        candidates.add(count)
+        count *= 2
+    return sorted(candidates)
+
+
+def profile_path(profile_dir):
+    return os.path.join(profile_dir, f"{host_id()}.json")
+
+
+def load_profile(profile_dir):
+    path = profile_path(profile_dir)
+    if path not in _profiles:
+        try:
+            with open(path) as f:
+                _profiles[path] = json.load(f)
+        except FileNotFoundError:
+            _profiles[path] = None
+        except (OSError, ValueError) as e:
+            logger.error(f"Error reading autotune profile {path}: {str(e)}")
+            _profiles[path] = None
+    return _profiles[path]
+
+
+def save_profile(profile_dir, model_path, settings, results):
+    path = profile_path(profile_dir)
+    os.makedirs(profile_dir, exist_ok=True)
+    profile = load_profile(profile_dir) or {}
+    if profile.get("version") != PROFILE_VERSION:
+        profile = {"version": PROFILE_VERSION}
+    profile["host"] = {
+        "id": host_id(),
+        "platform": platform.platform(),
+        "usable_cpus": usable_cpus(),
+        "physical_cores": physical_cores(),
+    }
+    profile.setdefault("models", {})[os.path.basename(model_path)] = {
+        "file_bytes": os.path.getsize(model_path),
+        "tuned_at": time.time(),
+        "settings": settings,
+        "results": results,
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp_path, path)
+    _profiles[path] = profile
+    return path
+
+
+def mlock_allowed(num_bytes):
+    # llama.cpp only warns when mlock fails, so check the limit up front
+    try:
+        import resource
+        limit = resource.getrlimit(resource.RLIMIT_MEMLOCK)[0]
+    except (ImportError, ValueError, OSError):
+        return False
+    return limit == resource.RLIM_INFINITY or limit >= num_bytes
+
+
+def get_tuned_settings(profile_dir, model_path):
+    # Llama keyword arguments tuned for model_path on this host, or {} when
+    # it has not been tuned here. A profile made for a different file of the
+    # same name is ignored.
+    profile = load_profile(profile_dir)
+    if not profile or profile.get("version") != PROFILE_VERSION:
+        return {}
+    entry = profile.get("models", {}).get(os.path.basename(model_path))
+    if entry is None:
+        return {}
+    if os.path.exists(model_path) and entry.get("file_bytes") != os.path.getsize(model_path):
+        logger.warning(f"Autotune profile for {os.path.basename(model_path)} was made for a different file; "
+                       f"run python -m app.autotune again")
+        return {}
+    settings = dict(entry["settings"])
+    if settings.get("use_mlock") and not mlock_allowed(entry["file_bytes"]):
+        logger.warning("Autotuned settings ask for mlock but RLIMIT_MEMLOCK is too low here; loading without it")
+        settings["use_mlock"] = False
+    return settings
+
+
+class MicroBenchmark:
+    def __init__(self, llama_cpp, model_path, n_ctx, prompt_tokens, decode_tokens, runs):
+        self.llama_cpp = llama_cpp
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.prompt_tokens = prompt_tokens
+        self.decode_tokens = decode_tokens
+        self.runs = max(1, runs)
+
+    def load(self, n_batch, n_threads, n_threads_batch, use_mmap=True, use_mlock=False):
+        started = time.perf_counter()
+        model = self.llama_cpp.Llama(
+            model_path=self.model_path,
+            n_ctx=self.n_ctx,
+            n_batch=n_batch,
+            n_threads=n_threads,
+            n_threads_batch=n_threads_batch,
+            n_gpu_layers=-1 if self.llama_cpp.llama_supports_gpu_offload() else 0,
+            use_mmap=use_mmap,
+            use_mlock=use_mlock,
+            verbose=False,
+        )
+        return model, time.perf_counter() - started
+
+    def prompt(self, model):
+        # Repeated sample text, cut to the requested number of tokens; the
+        # decode tokens must still fit in the context window
+        count = max(1, min(self.prompt_tokens, self.n_ctx - self.decode_tokens - 1))
+        text = SAMPLE_TEXT * (count // 20 + 1)
+        tokens = model.tokenize(text.encode("utf-8"))
+        while len(tokens) < count:
+            tokens += tokens
+        return tokens[:count]
+
+    def measure(self, model):
+        # Median prefill and decode speed over the runs. Decoding feeds the
+        # same token back so no time is spent sampling.
+        tokens = self.prompt(model)
+        prefill, decode = [], []
+        for _ in range(self.runs):
+            model.reset()
+            started = time.perf_counter()
+            model.eval(tokens)
+            prefill.append(len(tokens) / (time.perf_counter() - started))
+            started = time.perf_counter()
+            for _ in range(self.decode_tokens):
+                model.eval(tokens[-1:])
+            decode.append(self.decode_tokens / (time.perf_counter() - started))
+        return {
+            "prefill_tokens_per_second": round(statistics.median(prefill), 2),
+            "decode_tokens_per_second": round(statistics.median(decode), 2),
+        }
+
+    def set_threads(self, model, n_threads, n_threads_batch):
+        # Thread counts can change on a loaded context, so the thread sweep
+        # needs a single load
+        self.llama_cpp.llama_set_n_threads(model.ctx, n_threads, n_threads_batch)
+
+
+def autotune(llama_cpp, model_path, n_ctx, n_batch, threads=None, batch_sizes=None, memory_options=None,
+             prompt_tokens=256, decode_tokens=32, runs=3):
+    # Three stages, each keeping the winners of the ones before: thread
+    # counts (decode and prefill are tuned separately, as llama.cpp takes
+    # one count for each), batch size for prefill, then mmap/mlock.
+    bench = MicroBenchmark(llama_cpp, model_path, n_ctx, prompt_tokens, decode_tokens, runs)
+    threads = threads or thread_candidates()
+    batch_sizes = sorted(size for size in (batch_sizes or [64, 128, 256, 512]) if size <= n_ctx) or [n_batch]
+    memory_options = memory_options or list(MEMORY_OPTIONS)
+    results = {"threads": [], "batch_sizes": [], "memory": []}
+
+    model, _ = bench.load(n_batch, threads[-1], threads[-1])
+    for count in threads:
+        bench.set_threads(model, count, count)
+        measured = bench.measure(model)
+        results["threads"].append({"threads": count, **measured})
+        logger.info(f"threads={count}: {measured}")
+    del model
+    n_threads = max(results["threads"], key=lambda row: row["decode_tokens_per_second"])["threads"]
+    n_threads_batch = max(results["threads"], key=lambda row: row["prefill_tokens_per_second"])["threads"]
+
+    for size in batch_sizes:
+        model, _ = bench.load(size, n_threads, n_threads_batch)
+        measured = bench.measure(model)
+        del model
+        results["batch_sizes"].append({"n_batch": size, **measured})
+        logger.info(f"n_batch={size}: {measured}")
+    best_batch = max(results["batch_sizes"], key=lambda row: row["prefill_tokens_per_second"])["n_batch"]
+
+    file_bytes = os.path.getsize(model_path)
+    for name in memory_options:
+        options = MEMORY_OPTIONS[name]
+        if options["use_mlock"] and not (llama_cpp.llama_supports_mlock() and mlock_allowed(file_bytes)):
+            results["memory"].append({
+                "option": name,
+                "skipped": "RLIMIT_MEMLOCK is below the model size; raise it (ulimit -l, or ulimits.memlock "
+                           "in docker-compose) to try mlock",
+            })
+            continue
+        model, load_seconds = bench.load(best_batch, n_threads, n_threads_batch, **options)
+        measured = bench.measure(model)
+        del model
+        results["memory"].append({"option": name, "load_seconds": round(load_seconds, 3), **measured})
+        logger.info(f"{name}: load {load_seconds:.2f}s, {measured}")
+    measured = [row for row in results["memory"] if "skipped" not in row]
+    if measured:
+        fastest = max(row["decode_tokens_per_second"] for row in measured)
+        best_memory = min(
+            (row for row in measured if row["decode_tokens_per_second"] >= fastest * (1 - DECODE_TOLERANCE)),
+            key=lambda row: row["load_seconds"]
+        )["option"]
+    else:
+        # Every option asked for was skipped; keep llama.cpp's default
+        best_memory = DEFAULT_MEMORY_OPTION
+        logger.warning(f"No memory option could be measured; using {best_memory}")
+
+    settings = {
+        "n_threads": n_threads,
+        "n_threads_batch": n_threads_batch,
+        "n_batch": best_batch,
+        **MEMORY_OPTIONS[best_memory],
+    }
+    return settings, results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Tune llama.cpp threads, batch size and mmap/mlock for this host and save them as its profile"
+    )
+    parser.add_argument("--model-path", default=None, help="GGUF to tune (default: LLAMA_MODEL_PATH)")
+    parser.add_argument("--threads", type=int, nargs="+", default=None,
+                        help="thread counts to try (default: powers of two, physical cores and all CPUs)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=None, help="n_batch values to try")
+    parser.add_argument("--memory-options", nargs="+", choices=list(MEMORY_OPTIONS), default=None)
+    parser.add_argument("--prompt-tokens", type=int, default=256, help="prompt length for the prefill test")
+    parser.add_argument("--decode-tokens", type=int, default=32, help="tokens decoded per run")
+    parser.add_argument("--runs", type=int, default=3, help="runs per setting; the median is kept")
+    parser.add_argument("--profile-dir", default=None, help="defaults to AUTOTUNE_PROFILE_DIR")
+    parser.add_argument("--dry-run", action="store_true", help="report the results without saving the profile")
+    parser.add_argument("--output", help="Also write the JSON report here")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app.utils import load_config, get_config_value
+
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    config = load_config()
+    model_path = args.model_path or config.get('llama_model_path')
+    if not model_path or not os.path.exists(model_path):
+        sys.exit(f"Model {model_path} not found; pass --model-path")
+    profile_dir = args.profile_dir or get_config_value(config, 'autotune_profile_dir', "./models/autotune")
+
+    import llama_cpp
+    settings, results = autotune(
+        llama_cpp, model_path, int(config['model_n_ctx']), int(config['model_n_batch']),
+        threads=args.threads, batch_sizes=args.batch_sizes, memory_options=args.memory_options,
+        prompt_tokens=args.prompt_tokens, decode_tokens=args.decode_tokens, runs=args.runs
+    )
+    report = {"host": host_id(), "model": model_path, "settings": settings, "results": results}
+    if not args.dry_run:
+        report["profile"] = save_profile(profile_dir, model_path, settings, results)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+# Offline benchmark for ingestion and retrieval. It builds a synthetic PDF
+# corpus with planted facts at known locations, ingests it through
+# process_documents and measures throughput, retrieve_context latency and
+# recall@k. Results are printed as JSON so runs can be diffed across commits.
+#
+#   python -m app.benchmark --embedding-model stub --output bench.json
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FILLER_WORDS = (
+    "system maintenance operator report schedule pressure valve panel review "
+    "inspection quarterly procedure manual section reference equipment supply "
+    "network storage backup policy archive training safety checklist vendor "
+    "contract budget meeting summary incident response status update record "
+    "module interface protocol sensor reading threshold alarm cycle shift"
+).split()
+SYLLABLES = "ka lo vi ren mar tu sel dor fen ga pri nol za bek ur tis mo quen hal dri".split()
+LINE_WIDTH = 90
+LINES_PER_PAGE = 40
+
+
+def make_pdf(pages):
+    # Minimal single-font PDF writer; pages is a list of lists of text lines.
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(len(pages)))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>")
+    font_id = 3 + 2 * len(pages)
+    for i, lines in enumerate(pages):
+        escaped = (line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") for line in lines)
+        stream = "BT /F1 10 Tf 40 760 Td 12 TL " + " ".join(f"({line}) Tj T*" for line in escaped) + " ET"
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {4 + 2 * i} 0 R >>"
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    return bytes(out)
+
+
+def wrap_words(words, width=LINE_WIDTH):
+    lines, line = [], ""
+    for word in words:
+        if line and len(line) + len(word) + 1 > width:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    if line:
+        lines.append(line)
+    return lines
+
+
+def unit_names(rng, count):
+    # Distinct made-up words, so each planted fact has its own vocabulary
+    # that no filler text or other fact shares.
+    words = set()
+    while len(words) < count * 3:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(4)))
+    words = sorted(words)
+    names = {" ".join(words[i:i + 3]) for i in range(0, count * 3, 3)}
+    names = sorted(names)
+    rng.shuffle(names)
+    return names
+
+
+def build_corpus(num_docs, pages_per_doc, facts_per_doc, seed=0):
+    # Returns (documents, facts). Each fact is planted once, at a known
+    # document and page, and is the answer to exactly one query. Pages carry
+    # at most one fact so no chunk answers two queries.
+    if facts_per_doc > pages_per_doc:
+        raise ValueError(f"At most one fact per page: facts_per_doc must be <= {pages_per_doc}")
+    rng = random.Random(seed)
+    names = unit_names(rng, num_docs * facts_per_doc)
+
+    documents, facts = [], []
+    for doc_index in range(num_docs):
+        source = f"bench_{doc_index:04d}.pdf"
+        placements = {}
+        for page in sorted(rng.sample(range(pages_per_doc), facts_per_doc)):
+            fact = {
+                "source": source,
+                "page": page,
+                "unit": names[len(facts)],
+                "code": f"CX-{rng.randrange(10**6):06d}",
+            }
+            facts.append(fact)
+            placements[page] = fact
+
+        pages = []
+        for page in range(pages_per_doc):
+            words = [rng.choice(FILLER_WORDS) for _ in range(LINE_WIDTH * LINES_PER_PAGE // 9)]
+            fact = placements.get(page)
+            if fact is not None:
+                position = rng.randrange(len(words))
+                words[position:position] = f"The calibration code for the {fact['unit']} unit is {fact['code']}.".split()
+            pages.append(wrap_words(words))
+        documents.append((source, make_pdf(pages)))
+    return documents, facts
+
+
+def fact_query(fact):
+    return f"What is the calibration code for the {fact['unit']} unit?"
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    values = np.asarray(samples) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "mean_ms": round(float(values.mean()), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=APP_ROOT, capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def apply_overrides(modules, overrides):
+    # Each app module loads its own copy of config.yaml
+    for module in modules:
+        for key, value in overrides.items():
+            if value is not None:
+                module.config[key] = value
+
+
+def measure_embedding(embeddings, texts, batch_size):
+    # Raw model throughput, bypassing the on-disk embedding cache
+    embeddings = getattr(embeddings, "embeddings", embeddings)
+    started = time.perf_counter()
+    for start in range(0, len(texts), batch_size):
+        embeddings.embed_documents(texts[start:start + batch_size])
+    seconds = time.perf_counter() - started
+    return {
+        "texts": len(texts),
+        "seconds": round(seconds, 4),
+        "texts_per_second": round(len(texts) / seconds, 2) if seconds else None,
+        "chars_per_second": round(sum(len(text) for text in texts) / seconds, 2) if seconds else None,
+    }
+
+
+def measure_dense_overlap(vectorstore, embeddings, queries, top_k):
+    # Fraction of the exact float32 top-k (brute force over every chunk)
+    # that the store's own dense search returns; isolates index and
+    # quantization loss from retrieval quality.
+    texts, ids = [], []
+    offset = 0
+    while True:
+        batch = vectorstore.get(include=["documents", "metadatas"], limit=5000, offset=offset)
+        if not batch["ids"]:
+            break
+        texts.extend(batch["documents"])
+        ids.extend(metadata.get("chunk_id", chunk_id) for chunk_id, metadata in zip(batch["ids"], batch["metadatas"]))
+        offset += len(batch["ids"])
+    matrix = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True).clip(min=1e-12)
+
+    overlap = 0
+    for query in queries:
+        query_vector = np.asarray(embeddings.embed_query(query), dtype=np.float32)
+        exact = {ids[i] for i in np.argsort(-(matrix @ query_vector))[:top_k]}
+        found = vectorstore.similarity_search_by_vector_with_relevance_scores(query_vector.tolist(), k=top_k)
+        overlap += len(exact & {doc.metadata.get("chunk_id") for doc, _ in found})
+    return round(overlap / (len(queries) * top_k), 4) if queries else None
+
+
+def run_benchmark(args):
+    from app import document_processor, rag
+    from app.utils import get_config_value
+
+    apply_overrides([document_processor, rag], {
+        "embedding_model": args.embedding_model,
+        "chunk_size": args.chunk_size,
+        "chunk_overlap": args.chunk_overlap,
+        "parent_chunk_size": args.parent_chunk_size,
+        "vector_storage": args.vector_storage,
+        "hybrid_search": args.hybrid_search,
+    })
+    config = document_processor.config
+    top_k = args.top_k or int(config.get('top_k', 3))
+
+    documents, facts = build_corpus(args.docs, args.pages, args.facts_per_doc, seed=args.seed)
+    uploads = [document_processor.UploadedDocument(name, data) for name, data in documents]
+    corpus_bytes = sum(len(data) for _, data in documents)
+
+    started = time.perf_counter()
+    num_chunks = document_processor.process_documents(uploads)
+    ingest_seconds = time.perf_counter() - started
+    total_pages = args.docs * args.pages
+
+    vectorstore = document_processor.get_vectorstore()
+    sample = vectorstore.get(include=["documents"], limit=args.embedding_sample)["documents"]
+    embedding = measure_embedding(document_processor.get_embedding_function(), sample, args.embedding_batch_size)
+
+    # Warm up lazily loaded resources so they do not skew the first sample
+    rag.retrieve_context("warm up", top_k)
+
+    latencies = []
+    hits = 0
+    for fact in facts:
+        query_started = time.perf_counter()
+        context = rag.retrieve_context(fact_query(fact), top_k)
+        latencies.append(time.perf_counter() - query_started)
+        if fact["code"] in context:
+            hits += 1
+
+    retrieval = {
+        "queries": len(facts),
+        f"recall_at_{top_k}": round(hits / len(facts), 4) if facts else None,
+        **percentiles(latencies),
+    }
+    if args.exact_reference:
+        retrieval[f"dense_overlap_at_{top_k}"] = measure_dense_overlap(
+            vectorstore, document_processor.get_embedding_function(), [fact_query(fact) for fact in facts], top_k
+        )
+
+    return {
+        "revision": git_revision(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {
+            "embedding_model": config['embedding_model'],
+            "chunk_size": int(config['chunk_size']),
+            "chunk_overlap": int(config['chunk_overlap']),
+            "parent_chunk_size": get_config_value(config, 'parent_chunk_size', 0),
+            "top_k": top_k,
+            "hybrid_search": get_config_value(config, 'hybrid_search', True),
+            "rerank_mode": get_config_value(config, 'rerank_mode', "none"),
+            "vector_storage": get_config_value(config, 'vector_storage', "chroma"),
+        },
+        "corpus": {
+            "documents": args.docs,
+            "pages": total_pages,
+            "facts": len(facts),
+            "bytes": corpus_bytes,
+            "seed": args.seed,
+        },
+        "ingest": {
+            "chunks": num_chunks,
+            "seconds": round(ingest_seconds, 4),
+            "pages_per_second": round(total_pages / ingest_seconds, 2) if ingest_seconds else None,
+            "chunks_per_second": round(num_chunks / ingest_seconds, 2) if ingest_seconds else None,
+        },
+        "embedding": embedding,
+        "vector_store": vectorstore.memory_stats() if hasattr(vectorstore, "memory_stats") else None,
+        "retrieval": retrieval,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline ingestion and retrieval benchmark")
+    parser.add_argument("--docs", type=int, default=20, help="number of synthetic PDFs")
+    parser.add_argument("--pages", type=int, default=10, help="pages per PDF")
+    parser.add_argument("--facts-per-doc", type=int, default=5, help="planted facts (queries) per PDF")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--top-k", type=int, default=None, help="defaults to top_k from config.yaml")
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--chunk-overlap", type=int, default=None)
+    parser.add_argument("--parent-chunk-size", type=int, default=None,
+                        help="parent section size for parent/child indexing; 0 turns it off")
+    parser.add_argument("--embedding-model", default=None,
+                        help="embedding model name, or 'stub' for the deterministic offline embedder")
+    parser.add_argument("--vector-storage", choices=["chroma", "int8", "binary"], default=None)
+    parser.add_argument("--hybrid-search", type=lambda value: value.lower() in ("1", "true", "yes", "on"), default=None,
+                        help="true/false; turn off to measure dense recall alone")
+    parser.add_argument("--exact-reference", action="store_true",
+                        help="also compare dense search against brute-force float32 top-k")
+    parser.add_argument("--embedding-sample", type=int, default=256, help="chunks used for the throughput test")
+    parser.add_argument("--embedding-batch-size", type=int, default=64)
+    parser.add_argument("--workdir", default=None,
+                        help="directory for the temporary vector store (default: a fresh temp dir)")
+    parser.add_argument("--output", default=None, help="write the JSON results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output_path = os.path.abspath(args.output) if args.output else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="offline-rag-bench-")
+    os.makedirs(workdir, exist_ok=True)
+
+    # The app keeps its stores relative to the working directory; run in the
+    # scratch directory but keep already downloaded embedding models visible.
+    models_dir = os.path.join(os.getcwd(), "models")
+    os.chdir(workdir)
+    if os.path.isdir(models_dir) and not os.path.exists("models"):
+        os.symlink(models_dir, "models")
+
+    results = run_benchmark(args)
+    results["workdir"] = workdir
+    output = json.dumps(results, indent=2)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
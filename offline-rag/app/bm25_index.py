@@ -0,0 +1,275 @@
+import logging
+import math
+import os
+import re
+import threading
+from array import array
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Keeps identifiers such as "PN-4471-B", "4.2.1" or "clause_7" together while
+# still indexing their parts, so exact part numbers and clause references match.
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+PART_PATTERN = re.compile(r"[a-z0-9]+")
+COMPACT_RATIO = 0.3
+COMPACT_MIN_DEAD = 1000
+
+
+def pack_strings(strings):
+    # Variable-length strings as an offsets array plus one UTF-8 blob
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(data) for data in encoded], dtype=np.uint64)
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+def unpack_strings(offsets, blob):
+    blob = blob.tobytes()
+    return [blob[int(start):int(end)].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def tokenize(text):
+    tokens = []
+    for match in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(match)
+        parts = PART_PATTERN.findall(match)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+# In-process BM25 inverted index over chunk ids. Postings are kept in compact
+# typed arrays that numpy views without copying, so scoring a query is a few
+# vectorised passes over the posting lists of its terms.
+class BM25Index:
+    def __init__(self, path=None, k1=1.2, b=0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self.chunk_ids = []
+        self.sources = []
+        self._doc_len = array("i")
+        self._alive = bytearray()
+        self._id_to_doc = {}
+        self._source_docs = {}
+        self._terms = {}
+        self._post_docs = []
+        self._post_tfs = []
+        self._total_len = 0
+        self._dead = 0
+        self._weights = {}
+
+    def __len__(self):
+        return len(self.chunk_ids) - self._dead
+
+    def __contains__(self, chunk_id):
+        return chunk_id in self._id_to_doc
+
+    def add_many(self, items):
+        # items is an iterable of (chunk_id, source, text)
+        with self._lock:
+            for chunk_id, source, text in items:
+                if chunk_id in self._id_to_doc:
+                    self._remove_doc(self._id_to_doc[chunk_id])
+                self._add(chunk_id, source, text)
+            self._weights.clear()
+
+    def _add(self, chunk_id, source, text):
+        doc = len(self.chunk_ids)
+        counts = {}
+        tokens = tokenize(text)
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+
+        for token, tf in counts.items():
+            term = self._terms.get(token)
+            if term is None:
+                term = len(self._post_docs)
+                self._terms[token] = term
+                self._post_docs.append(array("i"))
+                self._post_tfs.append(array("i"))
+            self._post_docs[term].append(doc)
+            self._post_tfs[term].append(tf)
+
+        self.chunk_ids.append(chunk_id)
+        self.sources.append(source)
+        self._doc_len.append(len(tokens))
+        self._alive.append(1)
+        self._id_to_doc[chunk_id] = doc
+        self._source_docs.setdefault(source, []).append(doc)
+        self._total_len += len(tokens)
+
+    def remove_ids(self, chunk_ids):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                doc = self._id_to_doc.get(chunk_id)
+                if doc is not None:
+                    self._remove_doc(doc)
+            self._weights.clear()
+            self._maybe_compact()
+
+    def remove_source(self, source):
+        with self._lock:
+            for doc in self._source_docs.pop(source, []):
+                if self._alive[doc]:
+                    self._remove_doc(doc)
+            self._weights.clear()
+            self._maybe_compact()
+
+    def _remove_doc(self, doc):
+        if not self._alive[doc]:
+            return
+        self._alive[doc] = 0
+        self._dead += 1
+        self._total_len -= self._doc_len[doc]
+        self._id_to_doc.pop(self.chunk_ids[doc], None)
+
+    def _maybe_compact(self):
+        if self._dead >= COMPACT_MIN_DEAD and self._dead >= COMPACT_RATIO * len(self.chunk_ids):
+            self._compact()
+
+    def _compact(self):
+        alive = np.frombuffer(bytes(self._alive), dtype=np.uint8).astype(bool)
+        remap = np.cumsum(alive) - 1
+
+        post_docs, post_tfs, terms = [], [], {}
+        for token, term in self._terms.items():
+            docs = np.frombuffer(self._post_docs[term], dtype=np.int32)
+            keep = alive[docs]
+            if not keep.any():
+                continue
+            terms[token] = len(post_docs)
+            post_docs.append(array("i", remap[docs[keep]].astype(np.int32).tobytes()))
+            post_tfs.append(array("i", np.frombuffer(self._post_tfs[term], dtype=np.int32)[keep].tobytes()))
+
+        kept = np.flatnonzero(alive)
+        chunk_ids = [self.chunk_ids[doc] for doc in kept]
+        sources = [self.sources[doc] for doc in kept]
+        doc_len = array("i", np.frombuffer(self._doc_len, dtype=np.int32)[kept].tobytes())
+        self._reset()
+        self._rebuild_lookups(chunk_ids, sources, doc_len)
+        self._terms, self._post_docs, self._post_tfs = terms, post_docs, post_tfs
+        logger.info(f"Compacted BM25 index to {len(self.chunk_ids)} chunks")
+
+    def _rebuild_lookups(self, chunk_ids, sources, doc_len):
+        self.chunk_ids = chunk_ids
+        self.sources = sources
+        self._doc_len = doc_len
+        self._alive = bytearray(b"\x01" * len(chunk_ids))
+        self._id_to_doc = {chunk_id: doc for doc, chunk_id in enumerate(chunk_ids)}
+        self._source_docs = {}
+        for doc, source in enumerate(sources):
+            self._source_docs.setdefault(source, []).append(doc)
+        self._total_len = int(np.frombuffer(doc_len, dtype=np.int32).sum()) if len(doc_len) else 0
+        self._dead = 0
+        self._weights = {}
+
+    def search(self, query, k=10):
+        # Returns (chunk_id, score) pairs, best first
+        with self._lock:
+            num_docs = len(self)
+            if not num_docs or k <= 0:
+                return []
+            query_terms = [self._terms[token] for token in set(tokenize(query)) if token in self._terms]
+            if not query_terms:
+                return []
+
+            scores = np.zeros(len(self.chunk_ids), dtype=np.float32)
+            for term in query_terms:
+                docs, weights = self._term_weights(term)
+                df = len(docs)
+                idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+                scores[docs] += np.float32(idf) * weights
+
+            scores *= np.frombuffer(self._alive, dtype=np.uint8)
+            k = min(k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(self.chunk_ids[doc], float(scores[doc])) for doc in top if scores[doc] > 0]
+
+    def _term_weights(self, term):
+        # The length-normalised tf part of BM25 only changes when the index
+        # does, so it is computed once per term until the next mutation.
+        cached = self._weights.get(term)
+        if cached is not None:
+            return cached
+
+        docs = np.frombuffer(self._post_docs[term], dtype=np.int32).copy()
+        tfs = np.frombuffer(self._post_tfs[term], dtype=np.int32).astype(np.float32)
+        doc_len = np.frombuffer(self._doc_len, dtype=np.int32)[docs]
+        avg_len = self._total_len / max(1, len(self))
+        norm = self.k1 * (1 - self.b + self.b * doc_len / avg_len)
+        weights = (tfs * (self.k1 + 1) / (tfs + norm)).astype(np.float32)
+        self._weights[term] = (docs, weights)
+        return docs, weights
+
+    def save(self, path=None):
+        path = path or self.path
+        with self._lock:
+            if self._dead:
+                # Persist only live postings
+                self._compact()
+
+            tokens = list(self._terms)
+            terms = [self._terms[token] for token in tokens]
+            lengths = np.array([len(self._post_docs[term]) for term in terms], dtype=np.int64)
+            post_docs = np.concatenate([np.frombuffer(self._post_docs[term], dtype=np.int32) for term in terms]) if terms else np.zeros(0, np.int32)
+            post_tfs = np.concatenate([np.frombuffer(self._post_tfs[term], dtype=np.int32) for term in terms]) if terms else np.zeros(0, np.int32)
+
+            # Strings are packed rather than saved as object arrays, so loading
+            # never unpickles anything; a chunk without a source gets ""
+            strings = {}
+            for name, values in (("tokens", tokens), ("chunk_ids", self.chunk_ids),
+                                 ("sources", [source or "" for source in self.sources])):
+                strings[f"{name}_offsets"], strings[name] = pack_strings(values)
+
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(
+                    f,
+                    lengths=lengths,
+                    post_docs=post_docs,
+                    post_tfs=post_tfs,
+                    doc_len=np.frombuffer(self._doc_len, dtype=np.int32),
+                    **strings,
+                )
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        index = cls(path, **kwargs)
+        if not os.path.exists(path):
+            return index
+        with np.load(path, allow_pickle=False) as data:
+            if "tokens_offsets" not in data.files:
+                raise ValueError(f"{path} was saved in the older pickled format")
+            offsets = np.concatenate([[0], np.cumsum(data["lengths"])])
+            post_docs = data["post_docs"]
+            post_tfs = data["post_tfs"]
+            for term, token in enumerate(unpack_strings(data["tokens_offsets"], data["tokens"])):
+                start, end = offsets[term], offsets[term + 1]
+                index._terms[token] = term
+                index._post_docs.append(array("i", post_docs[start:end].tobytes()))
+                index._post_tfs.append(array("i", post_tfs[start:end].tobytes()))
+            index._rebuild_lookups(
+                unpack_strings(data["chunk_ids_offsets"], data["chunk_ids"]),
+                unpack_strings(data["sources_offsets"], data["sources"]),
+                array("i", data["doc_len"].astype(np.int32).tobytes()),
+            )
+        return index
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    # rankings is a list of ranked key lists; returns (key, score) best first
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,60 @@
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks on Windows; writers are serialised per process only
+    fcntl = None
+
+
+# Serialises changes to the collection (vector store, keyword index, manifest,
+# parent store). The UI and the API run as separate processes over the same
+# chroma_db, and Chroma, the keyword index file and the quantized store's
+# files all assume a single writer, so the thread lock is paired with an
+# flock on a file in chroma_db. Re-entrant within a thread; the file lock is
+# taken by the outermost acquire and released by the matching release.
+class CollectionLock:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self, blocking=True):
+        if not self._lock.acquire(blocking=blocking):
+            return False
+        if self._depth == 0 and fcntl is not None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._file = open(self.path, "a+b")
+                fcntl.flock(self._file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._close_file()
+                self._lock.release()
+                return False
+            except BaseException:
+                self._close_file()
+                self._lock.release()
+                raise
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._close_file()
+        self._lock.release()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
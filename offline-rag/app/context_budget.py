@@ -0,0 +1,74 @@
+MIN_OVERLAP_CHARS = 16
+
+
+def overlap_length(first, second, max_overlap):
+    # Length of the longest suffix of ``first`` that is also a prefix of
+    # ``second``, which is what chunk_overlap leaves between neighbours.
+    upper = min(len(first), len(second), max_overlap)
+    for length in range(upper, MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:length]):
+            return length
+    return 0
+
+
+def dedupe_against(text, source, selected, max_overlap):
+    removed = 0
+    for other in selected:
+        if other["source"] != source:
+            continue
+        if text in other["text"]:
+            return "", len(text)
+        head = overlap_length(other["text"], text, max_overlap)
+        if head:
+            text = text[head:]
+            removed += head
+        tail = overlap_length(text, other["text"], max_overlap)
+        if tail:
+            text = text[:-tail]
+            removed += tail
+    return text, removed
+
+
+def assemble_context(scored_docs, count_tokens=None, token_budget=None, max_overlap=0, separator="\n"):
+    # scored_docs is ranked best-first. Chunks are packed in that order while
+    # they fit the budget; a chunk that does not fit is skipped so a smaller,
+    # lower-ranked one can still use the remaining room.
+    if count_tokens is None:
+        count_tokens = lambda text: len(text.split())
+    separator_tokens = count_tokens(separator) if separator else 0
+
+    selected = []
+    used_tokens = 0
+    accounting = {
+        "token_budget": token_budget,
+        "candidates": len(scored_docs),
+        "overlap_chars_removed": 0,
+        "duplicates_dropped": 0,
+        "over_budget_dropped": 0,
+        "chunks": [],
+    }
+
+    for doc, score in scored_docs:
+        source = doc.metadata.get("source")
+        text, removed = dedupe_against(doc.page_content, source, selected, max_overlap)
+        accounting["overlap_chars_removed"] += removed
+        if not text.strip():
+            accounting["duplicates_dropped"] += 1
+            continue
+
+        tokens = count_tokens(text) + (separator_tokens if selected else 0)
+        if token_budget is not None and used_tokens + tokens > token_budget:
+            accounting["over_budget_dropped"] += 1
+            continue
+
+        used_tokens += tokens
+        selected.append({"source": source, "text": text})
+        accounting["chunks"].append({
+            "source": source,
+            "page": doc.metadata.get("page"),
+            "score": score,
+            "tokens": tokens,
+        })
+
+    accounting["context_tokens"] = used_tokens
+    return separator.join(item["text"] for item in selected), accounting
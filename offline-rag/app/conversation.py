@@ -0,0 +1,101 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from .prompts import get_history_prefix
+
+logger = logging.getLogger(__name__)
+
+
+# The chat history of one session: earlier questions and answers, plus a
+# rolling summary of the turns that no longer fit.
+class Conversation:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.turns = []
+        self.summary = ""
+        self.summarized_turns = 0
+        self.last_used = time.time()
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.turns), self.summary
+
+    def add_turn(self, question, answer):
+        answer = answer.strip()
+        if not answer:
+            return
+        with self._lock:
+            self.turns.append((question.strip(), answer))
+            self.last_used = time.time()
+
+    def fold(self, count, summary):
+        # Replaces the oldest count turns with an updated summary
+        with self._lock:
+            self.turns = self.turns[count:]
+            self.summary = summary
+            self.summarized_turns += count
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "turns": len(self.turns),
+                "summarized_turns": self.summarized_turns,
+                "summary": self.summary,
+                "last_used": self.last_used,
+            }
+
+
+class ConversationStore:
+    def __init__(self, max_sessions=256):
+        self.max_sessions = max(1, int(max_sessions))
+        self.evictions = 0
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            conversation = self._conversations.get(session_id)
+            if conversation is None:
+                conversation = Conversation(session_id)
+                self._conversations[session_id] = conversation
+                while len(self._conversations) > self.max_sessions:
+                    self._conversations.popitem(last=False)
+                    self.evictions += 1
+            self._conversations.move_to_end(session_id)
+            return conversation
+
+    def clear(self, session_id):
+        with self._lock:
+            return self._conversations.pop(session_id, None) is not None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._conversations),
+                "max_sessions": self.max_sessions,
+                "evictions": self.evictions,
+            }
+
+
+def compact_conversation(conversation, max_tokens, count_tokens, summarize, keep_turns=2):
+    # Once the history outgrows max_tokens, the oldest turns are folded into
+    # the summary, keeping the latest keep_turns verbatim while that is
+    # enough. Returns how many turns were folded.
+    folded = 0
+    while True:
+        turns, summary = conversation.snapshot()
+        if not turns or count_tokens(get_history_prefix("", turns, summary)) <= max_tokens:
+            return folded
+        count = max(1, len(turns) - keep_turns) if not folded else len(turns)
+        try:
+            new_summary = summarize(summary, turns[:count]).strip()
+        except Exception as e:
+            # Losing the oldest turns beats overflowing the context window
+            logger.error(f"Error summarizing conversation {conversation.session_id}, dropping old turns: {str(e)}")
+            new_summary = summary
+        conversation.fold(count, new_summary)
+        folded += count
+        logger.info(f"Folded {count} turns of conversation {conversation.session_id} into its summary")
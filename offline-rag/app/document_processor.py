@@ -1,10 +1,12 @@
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings.fastembed import FastEmbedEmbeddings
 import os
 import shutil
-from .utils import load_config
+from .utils import load_config, get_config_value, cache_resource
+from .manifest import IngestManifest, sha256_bytes
+from .query_cache import bump_collection_generation
+from .bm25_index import BM25Index
+from .collection_lock import CollectionLock
+from .startup import lazy_import, startup_report
+from .ingest_jobs import IngestJobRunner, IngestJobStore
 import streamlit as st
 import logging
 
@@ -12,14 +14,69 @@ config = load_config()
 logger = logging.getLogger(__name__)
 
 DOCUMENTS_DIR = "./documents"
+CHROMA_DIR = "./chroma_db"
+MANIFEST_PATH = os.path.join(CHROMA_DIR, "ingest_manifest.sqlite3")
+KEYWORD_INDEX_PATH = os.path.join(CHROMA_DIR, "bm25_index.npz")
+QUANTIZED_DIR = os.path.join(CHROMA_DIR, "quantized")
+ANSWER_CACHE_PATH = os.path.join(CHROMA_DIR, "answer_cache.sqlite3")
+INGEST_JOBS_PATH = os.path.join(CHROMA_DIR, "ingest_jobs.sqlite3")
+PARENT_STORE_PATH = os.path.join(CHROMA_DIR, "parents.sqlite3")
+WRITE_LOCK_PATH = os.path.join(CHROMA_DIR, "write.lock")
+# A prebuilt, read-only index (python -m app.index_bundle); served instead of
+# the live stores whenever the file exists
+INDEX_BUNDLE_PATH = get_config_value(config, 'index_bundle', os.path.join(CHROMA_DIR, "index.ragbundle"))
 os.makedirs(DOCUMENTS_DIR, exist_ok=True)
 
-@st.cache_resource
+# Ingesting, removing and clearing documents mutate the vector store,
+# manifest and keyword index together, in this process or in another one
+# sharing chroma_db
+ingest_lock = CollectionLock(WRITE_LOCK_PATH)
+
+# Collection version the in-memory stores were loaded at. The UI and the API
+# run as separate processes over the same chroma_db, so each change is
+# recorded in the manifest and the other process reloads when it notices.
+_collection_version = None
+
+# Set when get_ingest_job_runner creates the runner
+_ingest_job_runner = None
+
+EMBEDDING_MAX_LENGTH = 512
+
+# Minimal stand-in for Streamlit's UploadedFile so documents can be ingested
+# from scripts and other entry points.
+class UploadedDocument:
+    def __init__(self, name, data):
+        self.name = name
+        self._data = data
+
+    def getvalue(self):
+        return bytes(self._data)
+
+    def getbuffer(self):
+        return memoryview(self._data)
+
+@cache_resource
+def get_embedding_cache(model_name, max_length):
+    from .embedding_cache import EmbeddingCache, namespace_for
+    cache_dir = get_config_value(config, 'embedding_cache_dir', "./embedding_cache")
+    dtype = get_config_value(config, 'embedding_cache_dtype', "float32")
+    directory = os.path.join(cache_dir, f"{namespace_for(model_name, max_length)}-{dtype}")
+    return EmbeddingCache(directory, dtype=dtype)
+
+@cache_resource
 def get_embedding_function():
+    # LangChain and FastEmbed are imported here rather than at module level so
+    # the UI can render before they load
+    model_name = config['embedding_model']
+    if model_name == "stub":
+        # Deterministic offline embedder used by the benchmark
+        from .stub_embeddings import HashingEmbeddings
+        return HashingEmbeddings()
     try:
-        return FastEmbedEmbeddings(
-            model_name=config['embedding_model'],
-            max_length=512,
+        FastEmbedEmbeddings = lazy_import("langchain_community.embeddings.fastembed").FastEmbedEmbeddings
+        embeddings = FastEmbedEmbeddings(
+            model_name=model_name,
+            max_length=EMBEDDING_MAX_LENGTH,
             doc_embed_type="passage",
             cache_dir="./models"
         )
@@ -27,80 +84,454 @@ def get_embedding_function():
         logger.error(f"Error loading embedding model: {str(e)}")
         st.error(f"Error loading embedding model: {str(e)}")
         from langchain_community.embeddings import HuggingFaceEmbeddings
-        return HuggingFaceEmbeddings(cache_folder="./models")
+        embeddings = HuggingFaceEmbeddings(cache_folder="./models")
+        model_name = embeddings.model_name
+    return cache_embeddings(embeddings, model_name)
+
+def cache_embeddings(embeddings, model_name):
+    # Ingestion still works without the cache, e.g. when its directory is on
+    # a read-only filesystem, but re-ingesting then embeds every chunk again
+    if not get_config_value(config, 'embedding_cache_enabled', True):
+        return embeddings
+    try:
+        from .embedding_cache import CachedEmbeddings
+        return CachedEmbeddings(embeddings, get_embedding_cache(model_name, EMBEDDING_MAX_LENGTH))
+    except Exception as e:
+        cache_dir = get_config_value(config, 'embedding_cache_dir', "./embedding_cache")
+        logger.warning(
+            f"Embedding cache at {cache_dir} is unavailable, continuing without it: {str(e)}. "
+            "Point EMBEDDING_CACHE_DIR at a writable directory or set EMBEDDING_CACHE_ENABLED=false."
+        )
+        return embeddings
+
+@cache_resource
+def get_index_bundle():
+    if not INDEX_BUNDLE_PATH or not os.path.exists(INDEX_BUNDLE_PATH):
+        return None
+    from .index_bundle import IndexBundle
+    with startup_report.timed("loads", "index_bundle"):
+        bundle = IndexBundle(INDEX_BUNDLE_PATH)
+    if bundle.header['embedding_model'] != config['embedding_model']:
+        # Queries embedded by another model would match nothing sensible
+        raise ValueError(
+            f"Index bundle {INDEX_BUNDLE_PATH} was built with embedding model {bundle.header['embedding_model']}, "
+            f"but EMBEDDING_MODEL is {config['embedding_model']}"
+        )
+    logger.info(f"Serving read-only index bundle {INDEX_BUNDLE_PATH} ({bundle.count} chunks)")
+    return bundle
+
+def is_read_only():
+    return get_index_bundle() is not None
 
-@st.cache_resource
+def check_writable():
+    bundle = get_index_bundle()
+    if bundle is not None:
+        from .index_bundle import ReadOnlyIndexError
+        raise ReadOnlyIndexError(f"Serving the read-only index bundle {bundle.path}; documents cannot be changed")
+
+@cache_resource
 def get_vectorstore():
     embeddings = get_embedding_function()
-    return Chroma(persist_directory="./chroma_db", embedding_function=embeddings)
+    bundle = get_index_bundle()
+    if bundle is not None:
+        from .index_bundle import BundleVectorStore
+        return BundleVectorStore(bundle, embeddings)
+    _note_collection_version()
+    # "chroma" keeps float32 vectors in an HNSW index; "int8" and "binary"
+    # search quantized codes in RAM and rescore from a memory-mapped file.
+    storage = get_config_value(config, 'vector_storage', "chroma")
+    if storage in ("int8", "binary"):
+        from .quantized_store import QuantizedVectorStore
 
-def process_documents(uploaded_files, rebuild=False):
-    if rebuild:
-        clear_vectorstore()
+        return QuantizedVectorStore(
+            QUANTIZED_DIR,
+            embeddings,
+            quantization=storage,
+            rescore_factor=get_config_value(config, 'vector_rescore_factor', 4 if storage == "int8" else 10)
+        )
+    Chroma = lazy_import("langchain_community.vectorstores.chroma").Chroma
+    return Chroma(persist_directory=CHROMA_DIR, embedding_function=embeddings)
 
-    documents = []
-    for file in uploaded_files:
-        file_path = os.path.join(DOCUMENTS_DIR, file.name)
-        with open(file_path, "wb") as f:
-            f.write(file.getvalue())
-
-        loader = PyPDFLoader(file_path)
-        docs = loader.load()
-        logger.info(f"Loaded {len(docs)} pages from {file.name}")
-        for doc in docs:
-            doc.metadata['source'] = file.name
-        documents.extend(docs)
-
-    if not documents:
-        logger.warning("No documents were loaded.")
-        return 0
+@cache_resource
+def get_manifest():
+    return IngestManifest(MANIFEST_PATH)
+
+@cache_resource
+def get_answer_cache():
+    if not get_config_value(config, 'answer_cache_enabled', True):
+        return None
+    from .answer_cache import AnswerCache
+    semantic = get_config_value(config, 'answer_cache_semantic', False)
+    try:
+        return AnswerCache(
+            ANSWER_CACHE_PATH,
+            max_entries=get_config_value(config, 'answer_cache_max_entries', 1000),
+            similarity_threshold=get_config_value(config, 'answer_cache_similarity', 0.95) if semantic else None
+        )
+    except Exception as e:
+        # e.g. chroma_db mounted read-only
+        logger.error(f"Error opening answer cache, continuing without it: {str(e)}")
+        return None
+
+def invalidate_cached_answers(sources):
+    answer_cache = get_answer_cache()
+    if answer_cache is not None:
+        answer_cache.invalidate_sources(sources)
+
+@cache_resource
+def get_keyword_index():
+    bundle = get_index_bundle()
+    if bundle is not None:
+        from .index_bundle import BundleKeywordIndex
+        return BundleKeywordIndex(bundle)
+    _note_collection_version()
+    if os.path.exists(KEYWORD_INDEX_PATH):
+        try:
+            return BM25Index.load(KEYWORD_INDEX_PATH)
+        except ValueError as e:
+            # Rebuilt from the vector store below and saved in the current format
+            logger.warning(f"Rebuilding keyword index: {str(e)}")
+
+    # Collections built before the keyword index existed get it backfilled once
+    index = BM25Index(KEYWORD_INDEX_PATH)
+    try:
+        vectorstore = get_vectorstore()
+        batch_size = 5000
+        offset = 0
+        while True:
+            results = vectorstore.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+            if not results['ids']:
+                break
+            index.add_many(
+                (metadata.get('chunk_id', chunk_id), metadata.get('source'), text)
+                for chunk_id, text, metadata in zip(results['ids'], results['documents'], results['metadatas'])
+            )
+            offset += len(results['ids'])
+        if len(index):
+            index.save()
+            logger.info(f"Built keyword index for {len(index)} existing chunks")
+    except Exception as e:
+        logger.error(f"Error building keyword index: {str(e)}")
+    return index
+
+def _current_manifest():
+    manifest = get_manifest()
+    if manifest.is_replaced():
+        # chroma_db was cleared after the manifest was opened
+        manifest.close()
+        get_manifest.clear()
+        manifest = get_manifest()
+    return manifest
+
+def _read_collection_version():
+    return _current_manifest().collection_version()
+
+def _note_collection_version():
+    # Read before a store loads, so a change made while it loads is picked up
+    # by the next sync_collection
+    global _collection_version
+    if _collection_version is None:
+        _collection_version = _read_collection_version()
+
+def _collection_changed():
+    # Called with ingest_lock held once this process has changed the collection
+    global _collection_version
+    _collection_version = _current_manifest().bump_collection_version()
+    bump_collection_generation()
+
+def _close_vectorstore():
+    vectorstore = get_vectorstore()
+    if hasattr(vectorstore, "close"):
+        # The quantized store holds its codes in memory
+        vectorstore.close()
+    else:
+        # Chroma keeps one client per persist directory for the life of the
+        # process, with the HNSW index loaded in memory
+        lazy_import("chromadb.api.client").SharedSystemClient.clear_system_cache()
+    get_vectorstore.clear()
+
+def sync_collection():
+    # Called before each retrieval: reloads the in-memory stores when another
+    # process has changed the collection since they were loaded
+    global _collection_version
+    if is_read_only():
+        return
+    # A writer, here or in another process, is mid-change; its version
+    # becomes visible once it finishes
+    if not ingest_lock.acquire(blocking=False):
+        return
+    try:
+        version = _read_collection_version()
+        if _collection_version is None:
+            # Nothing loaded yet; the stores note the version as they load
+            _collection_version = version
+            return
+        if version == _collection_version:
+            return
+        logger.info("Collection changed in another process, reloading the vector store and keyword index")
+        _close_vectorstore()
+        get_keyword_index.clear()
+        _collection_version = version
+        bump_collection_generation()
+    except Exception as e:
+        logger.error(f"Error checking for collection changes: {str(e)}")
+    finally:
+        ingest_lock.release()
 
+def save_keyword_index():
+    try:
+        get_keyword_index().save()
+    except Exception as e:
+        logger.error(f"Error saving keyword index: {str(e)}")
+
+def get_text_splitter():
     chunk_size = int(config['chunk_size'])
     chunk_overlap = min(int(config['chunk_overlap']), chunk_size - 1)
 
-    text_splitter = RecursiveCharacterTextSplitter(
+    RecursiveCharacterTextSplitter = lazy_import("langchain.text_splitter").RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap
     )
-    texts = text_splitter.split_documents(documents)
-    logger.info(f"Split documents into {len(texts)} chunks")
 
-    if not texts:
-        logger.warning("No text chunks were created after splitting.")
+def get_parent_splitter():
+    # Parent/child indexing: chunk_size sets the embedded child chunks and
+    # parent_chunk_size the sections they expand to; 0 turns it off
+    parent_chunk_size = get_config_value(config, 'parent_chunk_size', 0)
+    if not parent_chunk_size:
+        return None
+    parent_chunk_overlap = min(get_config_value(config, 'parent_chunk_overlap', 0), parent_chunk_size - 1)
+
+    RecursiveCharacterTextSplitter = lazy_import("langchain.text_splitter").RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(
+        chunk_size=int(parent_chunk_size),
+        chunk_overlap=int(parent_chunk_overlap)
+    )
+
+@cache_resource
+def get_parent_store():
+    # None when there are no parents to expand to
+    bundle = get_index_bundle()
+    if bundle is not None:
+        if not bundle.header.get("parent_count"):
+            return None
+        from .index_bundle import BundleParentStore
+        return BundleParentStore(bundle)
+    if not get_config_value(config, 'parent_chunk_size', 0) and not os.path.exists(PARENT_STORE_PATH):
+        return None
+    from .parent_store import ParentStore
+    return ParentStore(PARENT_STORE_PATH)
+
+def get_ingestion_pipeline(on_progress=None):
+    from .ingest_pipeline import IngestionPipeline, default_worker_count
+    parent_splitter = get_parent_splitter()
+    return IngestionPipeline(
+        get_vectorstore(),
+        get_text_splitter(),
+        workers=get_config_value(config, 'ingest_workers', default_worker_count()),
+        batch_size=get_config_value(config, 'ingest_batch_size', 64),
+        pages_per_task=get_config_value(config, 'ingest_pages_per_task', 8),
+        memory_limit_mb=get_config_value(config, 'ingest_memory_limit_mb', 256),
+        manifest=get_manifest(),
+        keyword_index=get_keyword_index(),
+        on_progress=on_progress,
+        parent_splitter=parent_splitter,
+        parent_store=get_parent_store() if parent_splitter is not None else None
+    )
+
+def process_documents(uploaded_files, rebuild=False, on_progress=None):
+    check_writable()
+    if rebuild:
+        clear_vectorstore()
+    # An empty file has no PDF to parse; the others are still ingested and
+    # the empty ones reported afterwards
+    empty = [file.name for file in uploaded_files if not len(file.getbuffer())]
+    uploaded_files = [file for file in uploaded_files if file.name not in empty]
+    num_chunks = 0
+    if uploaded_files:
+        with ingest_lock:
+            sync_collection()
+            num_chunks = _process_documents(uploaded_files, on_progress)
+    if empty:
+        from .pdf_extract import EmptyDocumentError
+        raise EmptyDocumentError(f"{', '.join(empty)}: the file is empty (0 bytes); upload it again")
+    return num_chunks
+
+def _process_documents(uploaded_files, on_progress=None):
+    manifest = get_manifest()
+    sources = []
+    file_hashes = {}
+    byte_sizes = {}
+    persist_uploads = get_config_value(config, 'persist_uploads', False)
+    for file in uploaded_files:
+        # UploadedFile is a BytesIO; getbuffer() views its bytes where
+        # getvalue() would copy them
+        data = file.getbuffer()
+        file_hash = sha256_bytes(data)
+        known_hash = manifest.file_hash(file.name)
+        if known_hash == file_hash:
+            logger.info(f"Skipping unchanged document: {file.name}")
+            continue
+        if known_hash is None and not manifest.chunk_ids(file.name):
+            # Chunks indexed before the manifest existed have random ids,
+            # so drop them rather than duplicating the document. Chunks of
+            # an interrupted run are in the manifest and are kept.
+            _delete_source_embeddings(file.name)
+        # Answers built on the old version of this document are stale
+        invalidate_cached_answers([file.name])
+
+        if getattr(file, "path", None):
+            # Already on disk, e.g. saved when its ingestion job was queued
+            sources.append((file.name, file.path))
+        elif persist_uploads:
+            file_path = os.path.join(DOCUMENTS_DIR, file.name)
+            with open(file_path, "wb") as f:
+                f.write(data)
+            sources.append((file.name, file_path))
+        else:
+            sources.append((file.name, data))
+        file_hashes[file.name] = file_hash
+        byte_sizes[file.name] = len(data)
+
+    if not sources:
+        logger.warning("No new or modified documents to process.")
         return 0
 
-    vectorstore = get_vectorstore()
+    pipeline = get_ingestion_pipeline(on_progress)
     try:
-        vectorstore.add_documents(texts)
-        vectorstore.persist()
-        logger.info(f"Added {len(texts)} chunks to the vector store")
+        num_chunks = pipeline.run(sources)
+        if num_chunks:
+            persist_vectorstore(get_vectorstore())
     except Exception as e:
         logger.error(f"Error adding documents to vector store: {str(e)}")
         raise
+    finally:
+        save_keyword_index()
+        _collection_changed()
 
-    return len(texts)
+    for source_name, file_hash in file_hashes.items():
+        manifest.record_file(source_name, file_hash, byte_sizes[source_name])
 
-def get_existing_documents():
-    try:
-        vectorstore = get_vectorstore()
-        # Retrieve all documents
-        results = vectorstore.get()
-        # Extract unique source names from the results
-        documents = list(set(metadata['source'] for metadata in results['metadatas']))
+    if not num_chunks:
+        logger.warning("No new text chunks were created after splitting.")
+        return 0
+
+    logger.info(f"Added {num_chunks} chunks to the vector store")
+    return num_chunks
 
-        # Persist the vectorstore
+def persist_vectorstore(vectorstore):
+    # Chroma 0.4+ writes through on every change and deprecates persist();
+    # the quantized store uses it to compact away deleted rows
+    if get_config_value(config, 'vector_storage', "chroma") in ("int8", "binary"):
         vectorstore.persist()
 
-        return documents
+def _backfill_document_catalog(manifest):
+    # One-off scan for collections built before the catalog existed
+    vectorstore = get_vectorstore()
+    chunk_counts = {}
+    batch_size = 5000
+    offset = 0
+    while True:
+        results = vectorstore.get(include=["metadatas"], limit=batch_size, offset=offset)
+        if not results['ids']:
+            break
+        for metadata in results['metadatas']:
+            source = metadata.get('source')
+            chunk_counts[source] = chunk_counts.get(source, 0) + 1
+        offset += len(results['ids'])
+    manifest.backfill_documents(chunk_counts)
+
+def get_document_catalog():
+    try:
+        bundle = get_index_bundle()
+        if bundle is not None:
+            return bundle.documents
+        manifest = _current_manifest()
+        if not manifest.is_catalog_backfilled():
+            _backfill_document_catalog(manifest)
+        return manifest.list_documents()
     except Exception as e:
-        logging.error(f"Error retrieving existing documents: {e}")
+        logging.error(f"Error reading document catalog: {e}")
+        return []
+
+def get_existing_documents():
+    return [document['source'] for document in get_document_catalog()]
+
+def _delete_source_embeddings(document_name):
+    get_keyword_index().remove_source(document_name)
+    vectorstore = get_vectorstore()
+    results = vectorstore.get(where={"source": document_name})
+    if results and results['ids']:
+        vectorstore.delete(ids=results['ids'])
+    return results['ids'] if results else []
+
+@cache_resource
+def get_ingest_job_runner():
+    # Created at startup so jobs interrupted by a restart resume right away
+    global _ingest_job_runner
+    check_writable()
+    _ingest_job_runner = IngestJobRunner(
+        IngestJobStore(INGEST_JOBS_PATH, lease_seconds=get_config_value(config, 'ingest_job_lease_seconds', 60)),
+        process_documents,
+        DOCUMENTS_DIR,
+        persist_uploads=get_config_value(config, 'persist_uploads', False)
+    )
+    return _ingest_job_runner
+
+def submit_ingest_job(uploaded_files):
+    return get_ingest_job_runner().submit(uploaded_files)
+
+def get_ingest_job(job_id):
+    if is_read_only():
+        return None
+    return get_ingest_job_runner().store.get_job(job_id)
+
+def list_ingest_jobs(limit=20):
+    if is_read_only():
         return []
+    return get_ingest_job_runner().store.list_jobs(limit)
 
 def clear_vectorstore():
-    if os.path.exists("./chroma_db"):
-        shutil.rmtree("./chroma_db")
+    global _ingest_job_runner
+    check_writable()
+    # The job runner goes first: its thread may be waiting for ingest_lock.
+    # Only a runner that already exists is closed; creating one here would
+    # resume queued jobs just to stop them.
+    if _ingest_job_runner is not None:
+        _ingest_job_runner.close()
+        get_ingest_job_runner.clear()
+        _ingest_job_runner = None
+    with ingest_lock:
+        return _clear_vectorstore()
+
+def _clear_vectorstore():
+    get_manifest().close()
+    get_manifest.clear()
+    answer_cache = get_answer_cache()
+    if answer_cache is not None:
+        answer_cache.close()
+    get_answer_cache.clear()
+    _close_vectorstore()
+    get_keyword_index.clear()
+    parent_store = get_parent_store()
+    if hasattr(parent_store, "close"):
+        parent_store.close()
+    get_parent_store.clear()
+
+    # The directory itself stays: it may be a mount point, and other
+    # processes wait on the lock file inside it
+    if os.path.exists(CHROMA_DIR):
+        for name in os.listdir(CHROMA_DIR):
+            path = os.path.join(CHROMA_DIR, name)
+            if os.path.abspath(path) == os.path.abspath(WRITE_LOCK_PATH):
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
         logger.info("Cleared Chroma vectorstore.")
-        get_vectorstore.clear()
+    # Recorded in the new, empty manifest
+    _collection_changed()
 
     for file in os.listdir(DOCUMENTS_DIR):
         file_path = os.path.join(DOCUMENTS_DIR, file)
@@ -111,6 +542,15 @@ def clear_vectorstore():
     return True
 
 def remove_document(document_name):
+    check_writable()
+    with ingest_lock:
+        sync_collection()
+        try:
+            return _remove_document(document_name)
+        finally:
+            _collection_changed()
+
+def _remove_document(document_name):
     try:
         vectorstore = get_vectorstore()
 
@@ -123,15 +563,20 @@ def remove_document(document_name):
         else:
             logging.warning(f"Document file not found: {document_path}")
 
-        # Get the ids of the documents to delete from vectorstore
-        results = vectorstore.get(where={"source": document_name})
-        if results and results['ids']:
-            # Delete the documents from vectorstore
-            vectorstore.delete(ids=results['ids'])
-            logging.info(f"Removed {len(results['ids'])} embeddings for document: {document_name}")
+        get_manifest().remove_source(document_name)
+        invalidate_cached_answers([document_name])
+
+        # Delete the document's chunks from the vectorstore
+        removed_ids = _delete_source_embeddings(document_name)
+        save_keyword_index()
+        parent_store = get_parent_store()
+        if parent_store is not None:
+            parent_store.remove_source(document_name)
+        if removed_ids:
+            logging.info(f"Removed {len(removed_ids)} embeddings for document: {document_name}")
 
             # Persist the changes
-            vectorstore.persist()
+            persist_vectorstore(vectorstore)
 
             return True
         else:
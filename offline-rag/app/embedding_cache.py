@@ -0,0 +1,208 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+GROWTH_ROWS = 4096
+SQLITE_MAX_VARIABLES = 500
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def namespace_for(model_name, max_length):
+    return hashlib.sha256(f"{model_name}\0{max_length}".encode("utf-8")).hexdigest()[:16]
+
+
+# Vectors live in one memory-mapped matrix per (model, max_length, dtype);
+# a SQLite table maps each text hash to its row. Rows are only appended, and
+# the index row is committed after the vector is written, so readers in other
+# processes never see a half-written vector.
+class EmbeddingCache:
+    def __init__(self, directory, dtype="float32"):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._vectors_path = os.path.join(directory, f"vectors.{self.dtype.name}")
+        self._lock_path = os.path.join(directory, "write.lock")
+        self._conn = sqlite3.connect(
+            os.path.join(directory, "index.sqlite3"), timeout=30, check_same_thread=False
+        )
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS entries (text_hash TEXT PRIMARY KEY, row INTEGER NOT NULL);
+        """)
+        self._conn.commit()
+        self._dim = self._read_dim()
+        self._matrix = None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get_many(self, hashes):
+        found = {}
+        if self._dim is None:
+            self._dim = self._read_dim()
+            if self._dim is None:
+                return found
+
+        with self._lock:
+            rows = {}
+            unique = list(dict.fromkeys(hashes))
+            for start in range(0, len(unique), SQLITE_MAX_VARIABLES):
+                batch = unique[start:start + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" * len(batch))
+                rows.update(self._conn.execute(
+                    f"SELECT text_hash, row FROM entries WHERE text_hash IN ({placeholders})", batch
+                ).fetchall())
+            if not rows:
+                return found
+
+            matrix = self._mapped(max(rows.values()) + 1)
+            for key, row in rows.items():
+                found[key] = np.asarray(matrix[row], dtype=np.float32)
+        return found
+
+    def put_many(self, items):
+        # items is a list of (text_hash, vector) pairs
+        if not items:
+            return
+        vectors = np.asarray([vector for _, vector in items], dtype=np.float32)
+
+        with self._lock, self._file_lock():
+            if self._dim is None:
+                self._dim = self._read_dim() or vectors.shape[1]
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO meta (key, value) VALUES ('dim', ?)", (str(self._dim),)
+                    )
+            if vectors.shape[1] != self._dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match cache dimension {self._dim}")
+
+            # Another process may have cached some of these since the caller
+            # looked them up; a row allocated for those would be orphaned
+            new = {}
+            stored = self._stored_hashes([key for key, _ in items])
+            for index, (key, _) in enumerate(items):
+                if key not in stored and key not in new:
+                    new[key] = index
+            if not new:
+                return
+            vectors = vectors[list(new.values())]
+
+            next_row = self._conn.execute("SELECT COALESCE(MAX(row), -1) + 1 FROM entries").fetchone()[0]
+            matrix = self._mapped(next_row + len(new), grow=True)
+            matrix[next_row:next_row + len(new)] = vectors.astype(self.dtype)
+            matrix.flush()
+
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO entries (text_hash, row) VALUES (?, ?)",
+                    [(key, next_row + offset) for offset, key in enumerate(new)],
+                )
+
+    def _stored_hashes(self, hashes):
+        stored = set()
+        unique = list(dict.fromkeys(hashes))
+        for start in range(0, len(unique), SQLITE_MAX_VARIABLES):
+            batch = unique[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ",".join("?" * len(batch))
+            stored.update(key for (key,) in self._conn.execute(
+                f"SELECT text_hash FROM entries WHERE text_hash IN ({placeholders})", batch
+            ))
+        return stored
+
+    def _read_dim(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+        return int(row[0]) if row else None
+
+    def _mapped(self, rows_needed, grow=False):
+        row_bytes = self._dim * self.dtype.itemsize
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        capacity = size // row_bytes
+
+        if rows_needed > capacity and grow:
+            capacity = max(rows_needed, capacity * 2, GROWTH_ROWS)
+            with open(self._vectors_path, "ab") as f:
+                f.truncate(capacity * row_bytes)
+            self._matrix = None
+
+        if self._matrix is None or self._matrix.shape[0] < min(rows_needed, capacity):
+            self._matrix = np.memmap(self._vectors_path, dtype=self.dtype, mode="r+", shape=(capacity, self._dim))
+        return self._matrix
+
+    def _file_lock(self):
+        return _FileLock(self._lock_path)
+
+    def close(self):
+        with self._lock:
+            self._matrix = None
+            self._conn.close()
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, "a")
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        return False
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, cache):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        hashes = [text_hash(text) for text in texts]
+        cached = self.cache.get_many(hashes)
+
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        if missing:
+            computed = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), computed))
+            try:
+                self.cache.put_many(new_items)
+            except Exception as e:
+                logger.error(f"Error writing embedding cache: {str(e)}")
+            for key, vector in new_items:
+                cached[key] = np.asarray(vector, dtype=np.float32)
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        logger.info(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} computed")
+        return [cached[key].tolist() for key in hashes]
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
@@ -0,0 +1,528 @@
+import argparse
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import shutil
+import struct
+import sys
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from .bm25_index import pack_strings, tokenize
+
+logger = logging.getLogger(__name__)
+
+# A prebuilt index in one file, for shipping a prepared corpus to air-gapped
+# hosts. After a fixed prefix (magic, format version, header length) comes a
+# JSON header describing the corpus and where each section starts, then the
+# sections themselves: raw little-endian arrays aligned to 64 bytes. Opening
+# a bundle reads only the header; every section is a view into a read-only
+# mmap, so a page is read from disk the first time a search touches it.
+MAGIC = b"ORAGBNDL"
+FORMAT_VERSION = 1
+PREFIX = struct.Struct("<8sIIQ")
+ALIGNMENT = 64
+SCAN_BLOCK_ROWS = 65536
+EXPORT_BATCH_SIZE = 5000
+
+
+class ReadOnlyIndexError(RuntimeError):
+    pass
+
+
+def build_postings(texts):
+    # BM25 postings in the layout BundleKeywordIndex reads: terms sorted by
+    # their UTF-8 bytes so a query term is found by binary search
+    postings = {}
+    doc_len = np.zeros(len(texts), dtype=np.int32)
+    for doc, text in enumerate(texts):
+        counts = {}
+        tokens = tokenize(text)
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            postings.setdefault(token, []).append((doc, tf))
+        doc_len[doc] = len(tokens)
+
+    tokens = sorted(postings, key=lambda token: token.encode("utf-8"))
+    post_offsets = np.zeros(len(tokens) + 1, dtype=np.uint64)
+    post_offsets[1:] = np.cumsum([len(postings[token]) for token in tokens], dtype=np.uint64)
+    pairs = np.array([pair for token in tokens for pair in postings[token]], dtype=np.int32).reshape(-1, 2)
+    token_offsets, token_blob = pack_strings(tokens)
+    return {
+        "bm25_token_offsets": token_offsets,
+        "bm25_tokens": token_blob,
+        "bm25_post_offsets": post_offsets,
+        "bm25_post_docs": np.ascontiguousarray(pairs[:, 0]),
+        "bm25_post_tfs": np.ascontiguousarray(pairs[:, 1]),
+        "bm25_doc_len": doc_len,
+    }
+
+
+def sort_order(strings):
+    # Row numbers ordered by the strings' UTF-8 bytes, written next to a
+    # string section so IndexBundle.find_string can binary search it
+    encoded = [string.encode("utf-8") for string in strings]
+    return np.array(sorted(range(len(encoded)), key=encoded.__getitem__), dtype=np.int32)
+
+
+def write_bundle(path, header, sections):
+    # sections maps name -> numpy array; offsets are relative to the first
+    # section, which starts on an aligned boundary after the header
+    layout = {}
+    offset = 0
+    for name, array in sections.items():
+        array = np.ascontiguousarray(array)
+        sections[name] = array
+        layout[name] = {
+            "offset": offset,
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "sha256": hashlib.sha256(array.tobytes()).hexdigest(),
+        }
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = dict(header, format_version=FORMAT_VERSION, sections=layout)
+    header_bytes = json.dumps(header).encode("utf-8")
+    body_start = -(-(PREFIX.size + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(PREFIX.pack(MAGIC, FORMAT_VERSION, 0, len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in sections.items():
+            f.seek(body_start + layout[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(body_start + offset)
+    os.replace(tmp_path, path)
+    return header
+
+
+class IndexBundle:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, version, _, header_len = PREFIX.unpack(f.read(PREFIX.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not an index bundle")
+            if version != FORMAT_VERSION:
+                raise ValueError(
+                    f"Index bundle {path} has format version {version}; this build reads version {FORMAT_VERSION}"
+                )
+            self.header = json.loads(f.read(header_len).decode("utf-8"))
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._body_start = -(-(PREFIX.size + header_len) // ALIGNMENT) * ALIGNMENT
+        self._arrays = {}
+
+    @property
+    def count(self):
+        return self.header["count"]
+
+    @property
+    def dim(self):
+        return self.header["dim"]
+
+    @property
+    def documents(self):
+        return self.header["documents"]
+
+    def array(self, name):
+        array = self._arrays.get(name)
+        if array is None:
+            section = self.header["sections"][name]
+            dtype = np.dtype(section["dtype"])
+            shape = tuple(section["shape"])
+            array = np.frombuffer(
+                self._mmap, dtype=dtype, count=int(np.prod(shape)), offset=self._body_start + section["offset"]
+            ).reshape(shape)
+            self._arrays[name] = array
+        return array
+
+    def string(self, name, index):
+        return self.string_bytes(name, index).decode("utf-8")
+
+    def string_bytes(self, name, index):
+        offsets = self.array(f"{name}_offsets")
+        return self.array(name)[int(offsets[index]):int(offsets[index + 1])].tobytes()
+
+    def sorted_rows(self, name):
+        # Bundles written before the {name}_order sections existed get the
+        # order built in memory on first use
+        order_name = f"{name}_order"
+        if order_name in self.header["sections"]:
+            return self.array(order_name)
+        order = self._arrays.get(order_name)
+        if order is None:
+            count = len(self.array(f"{name}_offsets")) - 1
+            order = np.array(sorted(range(count), key=lambda row: self.string_bytes(name, row)), dtype=np.int32)
+            self._arrays[order_name] = order
+        return order
+
+    def find_string(self, name, value):
+        # Row of value in a string section, by binary search over its sort
+        # order, so a lookup reads only a few strings; None if absent
+        target = value.encode("utf-8")
+        order = self.sorted_rows(name)
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            if self.string_bytes(name, int(order[middle])) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(order) and self.string_bytes(name, int(order[low])) == target:
+            return int(order[low])
+        return None
+
+    def verify(self):
+        # Reads every section, so only meant for import, not for startup
+        for name, section in self.header["sections"].items():
+            if hashlib.sha256(self.array(name).tobytes()).hexdigest() != section["sha256"]:
+                raise ValueError(f"Index bundle {self.path} is corrupt: section {name} does not match its checksum")
+
+    def info(self):
+        info = {key: value for key, value in self.header.items() if key not in ("sections", "documents")}
+        info["documents"] = len(self.documents)
+        info["bytes"] = os.path.getsize(self.path)
+        return info
+
+    def close(self):
+        self._arrays.clear()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Arrays handed out earlier still view the mapping; it is
+            # released with them
+            pass
+
+
+# Read-only vector store over a bundle. Queries scan the float vectors block
+# by block (exact cosine similarity) and read texts and metadata only for the
+# hits. Implements the read side of the interface the app uses from Chroma.
+class BundleVectorStore(VectorStore):
+    def __init__(self, bundle, embedding_function):
+        self.bundle = bundle
+        self.embedding_function = embedding_function
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        raise ReadOnlyIndexError(f"The index bundle {self.bundle.path} is read-only")
+
+    def delete(self, ids=None, **kwargs):
+        raise ReadOnlyIndexError(f"The index bundle {self.bundle.path} is read-only")
+
+    def persist(self):
+        pass
+
+    def _document(self, row):
+        return self.bundle.string("texts", row), json.loads(self.bundle.string("metadatas", row))
+
+    def _rows_for_ids(self, ids):
+        rows = [self.bundle.find_string("ids", chunk_id) for chunk_id in ids]
+        return [row for row in rows if row is not None]
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=None, **kwargs):
+        include = include if include is not None else ["documents", "metadatas"]
+        rows = self._rows_for_ids(ids) if ids is not None else range(self.bundle.count)
+        if where:
+            rows = [
+                row for row in rows
+                if all(self._document(row)[1].get(key) == value for key, value in where.items())
+            ]
+        rows = list(rows)[offset or 0:]
+        if limit is not None:
+            rows = rows[:limit]
+        documents = [self._document(row) for row in rows]
+        return {
+            "ids": [self.bundle.string("ids", row) for row in rows],
+            "documents": [text for text, _ in documents] if "documents" in include else None,
+            "metadatas": [metadata for _, metadata in documents] if "metadatas" in include else None,
+            "embeddings": (
+                self.bundle.array("vectors")[rows].astype(np.float32).tolist() if "embeddings" in include else None
+            ),
+        }
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k=4, **kwargs):
+        vectors = self.bundle.array("vectors")
+        if not len(vectors) or k <= 0:
+            return []
+        query_vector = np.asarray(embedding, dtype=np.float32)
+        query_vector /= np.linalg.norm(query_vector) or 1.0
+        scores = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), SCAN_BLOCK_ROWS):
+            block = vectors[start:start + SCAN_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32, copy=False) @ query_vector
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        results = []
+        for row in top:
+            text, metadata = self._document(int(row))
+            results.append((Document(page_content=text, metadata=metadata), float(1.0 - scores[row])))
+        return results
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_relevance_scores(self.embedding_function.embed_query(query), k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise ReadOnlyIndexError("Index bundles are built with `python -m app.index_bundle export`")
+
+
+# Read-only BM25 over the postings stored in a bundle, scored exactly like
+# BM25Index. Query terms are found by binary search over the sorted term
+# blob, so only the postings of the query's terms are read.
+class BundleKeywordIndex:
+    def __init__(self, bundle, k1=1.2, b=0.75):
+        self.bundle = bundle
+        self.k1 = k1
+        self.b = b
+        self._avg_len = None
+
+    def __len__(self):
+        return self.bundle.count
+
+    def __contains__(self, chunk_id):
+        return self.bundle.find_string("ids", chunk_id) is not None
+
+    def add_many(self, items):
+        raise ReadOnlyIndexError(f"The index bundle {self.bundle.path} is read-only")
+
+    def remove_ids(self, chunk_ids):
+        raise ReadOnlyIndexError(f"The index bundle {self.bundle.path} is read-only")
+
+    def remove_source(self, source):
+        raise ReadOnlyIndexError(f"The index bundle {self.bundle.path} is read-only")
+
+    def save(self, path=None):
+        pass
+
+    def _find_term(self, token):
+        target = token.encode("utf-8")
+        offsets = self.bundle.array("bm25_token_offsets")
+        blob = self.bundle.array("bm25_tokens")
+        low, high = 0, len(offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            candidate = blob[int(offsets[middle]):int(offsets[middle + 1])].tobytes()
+            if candidate < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(offsets) - 1 and blob[int(offsets[low]):int(offsets[low + 1])].tobytes() == target:
+            return low
+        return None
+
+    def search(self, query, k=10):
+        # Returns (chunk_id, score) pairs, best first
+        num_docs = len(self)
+        if not num_docs or k <= 0:
+            return []
+        doc_len = self.bundle.array("bm25_doc_len")
+        if self._avg_len is None:
+            self._avg_len = float(doc_len.sum()) / num_docs
+        post_offsets = self.bundle.array("bm25_post_offsets")
+
+        scores = np.zeros(num_docs, dtype=np.float32)
+        matched = False
+        for token in set(tokenize(query)):
+            term = self._find_term(token)
+            if term is None:
+                continue
+            matched = True
+            start, end = int(post_offsets[term]), int(post_offsets[term + 1])
+            docs = self.bundle.array("bm25_post_docs")[start:end]
+            tfs = self.bundle.array("bm25_post_tfs")[start:end].astype(np.float32)
+            norm = self.k1 * (1 - self.b + self.b * doc_len[docs] / self._avg_len)
+            df = end - start
+            idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+            scores[docs] += np.float32(idf) * (tfs * (self.k1 + 1) / (tfs + norm)).astype(np.float32)
+        if not matched:
+            return []
+        k = min(k, num_docs)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.bundle.string("ids", int(doc)), float(scores[doc])) for doc in top if scores[doc] > 0]
+
+
+
+# Read-only parents for parent/child indexing. Parents are stored in reading
+# order, so neighbouring sections of a source are consecutive rows.
+class BundleParentStore:
+    def __init__(self, bundle):
+        self.bundle = bundle
+
+    def __len__(self):
+        return self.bundle.header["parent_count"]
+
+    def get_many(self, parent_ids):
+        found = {}
+        for parent_id in parent_ids:
+            row = self.bundle.find_string("parent_ids", parent_id)
+            if row is None:
+                continue
+            place = json.loads(self.bundle.string("parent_places", row))
+            found[parent_id] = {
+                "parent_id": parent_id, "text": self.bundle.string("parent_texts", row), "row": row, **place,
+            }
+        return found
+
+    def adjacent(self, first, second):
+        return first["source"] == second["source"] and second["row"] == first["row"] + 1
+
+    def add_many(self, parents):
+        raise ReadOnlyIndexError("Index bundles are read-only")
+
+    def remove_source(self, source):
+        raise ReadOnlyIndexError("Index bundles are read-only")
+
+
+def export_bundle(path, vectorstore, documents, embedding_model, chunk_size=None, chunk_overlap=None,
+                  vector_dtype="float32", parent_store=None):
+    # Reads every chunk with its vector from a live store and writes a bundle
+    ids, texts, metadatas, vectors = [], [], [], []
+    offset = 0
+    while True:
+        results = vectorstore.get(
+            include=["embeddings", "documents", "metadatas"], limit=EXPORT_BATCH_SIZE, offset=offset
+        )
+        if not results['ids']:
+            break
+        ids.extend(results['ids'])
+        texts.extend(results['documents'])
+        metadatas.extend(results['metadatas'])
+        vectors.extend(results['embeddings'])
+        offset += len(results['ids'])
+    if not ids:
+        raise ValueError("The vector store is empty; there is nothing to export")
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+    sections = {"vectors": vectors.astype(vector_dtype)}
+    for name, strings in (("ids", ids), ("texts", texts), ("metadatas", [json.dumps(m) for m in metadatas])):
+        sections[f"{name}_offsets"], sections[name] = pack_strings(strings)
+    sections["ids_order"] = sort_order(ids)
+    sections.update(build_postings(texts))
+    parents = parent_store.rows() if parent_store is not None else []
+    if parents:
+        for name, strings in (
+            ("parent_ids", [row[0] for row in parents]),
+            ("parent_texts", [row[4] for row in parents]),
+            ("parent_places", [json.dumps({"source": row[1], "page": row[2], "position": row[3]}) for row in parents]),
+        ):
+            sections[f"{name}_offsets"], sections[name] = pack_strings(strings)
+        sections["parent_ids_order"] = sort_order([row[0] for row in parents])
+
+    chunk_counts = {}
+    for metadata in metadatas:
+        chunk_counts[metadata.get('source')] = chunk_counts.get(metadata.get('source'), 0) + 1
+    catalog = {document['source']: document for document in documents}
+    header = {
+        "created_at": time.time(),
+        "embedding_model": embedding_model,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "count": len(ids),
+        "dim": int(vectors.shape[1]),
+        "vector_dtype": vector_dtype,
+        "parent_count": len(parents),
+        "documents": [
+            {
+                "source": source,
+                "chunk_count": count,
+                "byte_size": catalog.get(source, {}).get('byte_size'),
+                "ingested_at": catalog.get(source, {}).get('ingested_at'),
+                "content_hash": catalog.get(source, {}).get('content_hash'),
+            }
+            for source, count in sorted(chunk_counts.items(), key=lambda item: str(item[0]))
+        ],
+    }
+    return write_bundle(path, header, sections)
+
+
+def import_bundle(source_path, target_path):
+    # Checks the bundle end to end before it replaces the one in service
+    bundle = IndexBundle(source_path)
+    try:
+        bundle.verify()
+        info = bundle.info()
+    finally:
+        bundle.close()
+    os.makedirs(os.path.dirname(os.path.abspath(target_path)), exist_ok=True)
+    tmp_path = f"{target_path}.tmp"
+    shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, target_path)
+    return info
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export, import or inspect a read-only index bundle")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Write the current vector store to a bundle")
+    export.add_argument("output", help="Bundle file to write")
+    export.add_argument("--vector-dtype", choices=["float32", "float16"], default="float32",
+                        help="float16 halves the bundle size at a negligible cost in accuracy")
+    install = commands.add_parser("import", help="Verify a bundle and install it where INDEX_BUNDLE points")
+    install.add_argument("bundle", help="Bundle file to import")
+    install.add_argument("--target", help="Install here instead of INDEX_BUNDLE")
+    info = commands.add_parser("info", help="Print a bundle's header")
+    info.add_argument("bundle")
+    info.add_argument("--verify", action="store_true", help="Also check every section's checksum")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app.utils import load_config
+
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    config = load_config()
+
+    if args.command == "export":
+        from app import document_processor
+        if document_processor.get_index_bundle() is not None:
+            sys.exit(
+                f"An index bundle is in service at {document_processor.INDEX_BUNDLE_PATH}; "
+                "move it away or point INDEX_BUNDLE elsewhere to export from the live vector store"
+            )
+        header = export_bundle(
+            args.output,
+            document_processor.get_vectorstore(),
+            document_processor.get_document_catalog(),
+            config['embedding_model'],
+            chunk_size=config.get('chunk_size'),
+            chunk_overlap=config.get('chunk_overlap'),
+            vector_dtype=args.vector_dtype,
+            parent_store=document_processor.get_parent_store(),
+        )
+        print(f"Wrote {header['count']} chunks from {len(header['documents'])} documents to {args.output}")
+    elif args.command == "import":
+        from app.document_processor import INDEX_BUNDLE_PATH, ingest_lock
+        target = args.target or INDEX_BUNDLE_PATH
+        with ingest_lock:
+            info = import_bundle(args.bundle, target)
+        print(f"Installed {args.bundle} at {target}")
+        print(json.dumps(info, indent=2))
+    else:
+        bundle = IndexBundle(args.bundle)
+        if args.verify:
+            bundle.verify()
+        print(json.dumps(bundle.info(), indent=2))
+        bundle.close()
+
+
+if __name__ == "__main__":
+    main()
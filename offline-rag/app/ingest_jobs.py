@@ -0,0 +1,365 @@
+import logging
+import mmap
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+# A document saved on disk, e.g. an upload persisted before its job ran.
+# process_documents ingests it from path instead of writing it again.
+class StoredDocument:
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+    def getbuffer(self):
+        with open(self.path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                # mmap cannot map an empty file; process_documents reports it
+                return memoryview(b"")
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+# Jobs are shared by every process using the same file (the UI and the API).
+# A job belongs to the process holding its lease: the owner renews it while
+# the job is queued or running, and another process may claim the job only
+# once the lease has run out, i.e. after the owner died or stopped.
+class IngestJobStore:
+    def __init__(self, path, lease_seconds=60):
+        self.path = path
+        self.owner = uuid.uuid4().hex
+        self.lease_seconds = lease_seconds
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                owner TEXT,
+                lease_until REAL
+            );
+            CREATE TABLE IF NOT EXISTS job_files (
+                job_id TEXT NOT NULL,
+                source TEXT NOT NULL,
+                path TEXT,
+                byte_size INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                pages_total INTEGER,
+                pages_done INTEGER NOT NULL DEFAULT 0,
+                chunks_split INTEGER NOT NULL DEFAULT 0,
+                chunks_done INTEGER NOT NULL DEFAULT 0,
+                chunks_added INTEGER,
+                error TEXT,
+                position INTEGER NOT NULL,
+                PRIMARY KEY (job_id, source)
+            );
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+        self._conn.commit()
+
+    def create_job(self, job_id, files):
+        # files is a list of (source, path, byte_size); path is None for
+        # uploads held only in memory
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, status, created_at, owner, lease_until) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, time.time(), self.owner, time.time() + self.lease_seconds)
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO job_files (job_id, source, path, byte_size, status, position) "
+                "VALUES (?, ?, ?, ?, 'queued', ?)",
+                [(job_id, source, path, byte_size, position) for position, (source, path, byte_size) in enumerate(files)],
+            )
+
+    def abandoned_jobs(self):
+        # Unfinished jobs no live process holds a lease on
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job_id FROM jobs WHERE status IN ('queued', 'running') "
+                "AND (owner IS NULL OR lease_until IS NULL OR lease_until < ?) ORDER BY created_at", (time.time(),)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def claim_job(self, job_id):
+        # Atomic across processes: of several claiming the same abandoned job,
+        # exactly one sees its update applied
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET owner = ?, lease_until = ? WHERE job_id = ? AND status IN ('queued', 'running') "
+                "AND (owner IS NULL OR lease_until IS NULL OR lease_until < ? OR owner = ?)",
+                (self.owner, now + self.lease_seconds, job_id, now, self.owner),
+            )
+        return cursor.rowcount == 1
+
+    def renew_leases(self):
+        # Returns the unfinished jobs this process still owns; a job missing
+        # from the result was claimed by another process after the lease ran out
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status IN ('queued', 'running')",
+                (time.time() + self.lease_seconds, self.owner),
+            )
+            rows = self._conn.execute(
+                "SELECT job_id FROM jobs WHERE owner = ? AND status IN ('queued', 'running')", (self.owner,)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def release_jobs(self):
+        # On shutdown, so another process can resume the jobs without
+        # waiting for the leases to run out
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET owner = NULL, lease_until = NULL WHERE owner = ? AND status IN ('queued', 'running')",
+                (self.owner,),
+            )
+
+    def pending_files(self, job_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT source, path FROM job_files WHERE job_id = ? AND status IN ('queued', 'running') "
+                "ORDER BY position", (job_id,)
+            ).fetchall()
+        return rows
+
+    def start_job(self, job_id):
+        # A resumed job restarts its clock so the ETA reflects this run
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ? WHERE job_id = ?", (time.time(), job_id)
+            )
+
+    def start_file(self, job_id, source):
+        # Counters restart with the file; chunks indexed before an
+        # interruption are skipped and reported as done again
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE job_files SET status = 'running', pages_done = 0, chunks_split = 0, chunks_done = 0 "
+                "WHERE job_id = ? AND source = ?", (job_id, source)
+            )
+
+    def add_progress(self, job_id, source, pages_total=None, pages=0, chunks=0, chunks_done=0):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE job_files SET pages_total = COALESCE(?, pages_total), pages_done = pages_done + ?, "
+                "chunks_split = chunks_split + ?, chunks_done = chunks_done + ? WHERE job_id = ? AND source = ?",
+                (pages_total, pages, chunks, chunks_done, job_id, source),
+            )
+
+    def finish_file(self, job_id, source, chunks_added=None, error=None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE job_files SET status = ?, chunks_added = ?, error = ? WHERE job_id = ? AND source = ?",
+                ("failed" if error else "done", chunks_added, error, job_id, source),
+            )
+
+    def finish_job(self, job_id):
+        with self._lock, self._conn:
+            failed = self._conn.execute(
+                "SELECT COUNT(*) FROM job_files WHERE job_id = ? AND status = 'failed'", (job_id,)
+            ).fetchone()[0]
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, lease_until = NULL WHERE job_id = ?",
+                ("failed" if failed else "done", time.time(), job_id),
+            )
+
+    def get_job(self, job_id):
+        with self._lock:
+            job = self._conn.execute(
+                "SELECT status, created_at, started_at, finished_at FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            if job is None:
+                return None
+            files = self._conn.execute(
+                "SELECT source, byte_size, status, pages_total, pages_done, chunks_split, chunks_done, "
+                "chunks_added, error FROM job_files WHERE job_id = ? ORDER BY position", (job_id,)
+            ).fetchall()
+        status, created_at, started_at, finished_at = job
+        files = [
+            {"source": source, "byte_size": byte_size, "status": file_status, "pages_total": pages_total,
+             "pages_done": pages_done, "chunks_split": chunks_split, "chunks_done": chunks_done,
+             "chunks_added": chunks_added, "error": error}
+            for source, byte_size, file_status, pages_total, pages_done, chunks_split, chunks_done,
+            chunks_added, error in files
+        ]
+        fraction = estimate_fraction(files)
+        eta_seconds = None
+        if status == "running" and started_at and 0 < fraction < 1:
+            eta_seconds = round((time.time() - started_at) * (1 - fraction) / fraction, 1)
+        return {
+            "job_id": job_id,
+            "status": status,
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+            "pages_done": sum(f["pages_done"] for f in files),
+            "pages_total": sum(f["pages_total"] or 0 for f in files),
+            "chunks_done": sum(f["chunks_done"] for f in files),
+            "chunks_added": sum(f["chunks_added"] or 0 for f in files),
+            "fraction": round(fraction, 4),
+            "eta_seconds": eta_seconds,
+            "files": files,
+        }
+
+    def list_jobs(self, limit=20):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job_id FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [self.get_job(job_id) for (job_id,) in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def estimate_fraction(files):
+    # Files are weighted by size. Within a running file the chunk total is
+    # extrapolated from the pages parsed so far, so the estimate covers
+    # both parsing and embedding.
+    total_bytes = sum(f["byte_size"] for f in files) or 1
+    done = 0.0
+    for f in files:
+        if f["status"] in ("done", "failed"):
+            file_fraction = 1.0
+        elif f["pages_total"] and f["pages_done"]:
+            expected_chunks = f["chunks_split"] * f["pages_total"] / f["pages_done"]
+            file_fraction = f["chunks_done"] / expected_chunks if expected_chunks else f["pages_done"] / f["pages_total"]
+        else:
+            file_fraction = 0.0
+        done += f["byte_size"] * min(1.0, file_fraction)
+    return done / total_bytes
+
+
+# Runs ingestion jobs one at a time on a background thread. Each file is
+# processed on its own, so finished files are recorded in the manifest as
+# they complete and chunks are checkpointed batch by batch; a job cut short
+# by a restart resumes where it stopped. Uploads kept only in memory cannot
+# survive a restart, so those files are failed with a hint instead.
+# A heartbeat thread renews the leases on this runner's jobs and picks up
+# jobs whose owner has gone, whether after a restart or in another process.
+class IngestJobRunner:
+    def __init__(self, store, process_documents, documents_dir, persist_uploads=False):
+        self.store = store
+        self.process_documents = process_documents
+        self.documents_dir = documents_dir
+        self.persist_uploads = persist_uploads
+        self._documents = {}
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._closed = threading.Event()
+        self._resume()
+        self._worker = threading.Thread(target=self._run, name="ingest-jobs", daemon=True)
+        self._worker.start()
+        self._heartbeat = threading.Thread(target=self._renew, name="ingest-jobs-lease", daemon=True)
+        self._heartbeat.start()
+
+    def submit(self, uploaded_files):
+        job_id = uuid.uuid4().hex
+        files = []
+        for file in uploaded_files:
+            data = file.getbuffer()
+            path = None
+            if self.persist_uploads:
+                path = os.path.join(self.documents_dir, file.name)
+                with open(path, "wb") as f:
+                    f.write(data)
+            else:
+                self._documents[(job_id, file.name)] = file
+            files.append((file.name, path, len(data)))
+        self.store.create_job(job_id, files)
+        self._enqueue(job_id)
+        logger.info(f"Queued ingestion job {job_id} with {len(files)} documents")
+        return job_id
+
+    def _enqueue(self, job_id):
+        with self._queued_lock:
+            if job_id in self._queued:
+                return
+            self._queued.add(job_id)
+        self._queue.put(job_id)
+
+    def _resume(self):
+        for job_id in self.store.abandoned_jobs():
+            if not self.store.claim_job(job_id):
+                continue
+            for source, path in self.store.pending_files(job_id):
+                if path is None or not os.path.exists(path):
+                    self.store.finish_file(
+                        job_id, source,
+                        error="Interrupted by a restart; the upload was only held in memory. "
+                              "Upload it again, or enable PERSIST_UPLOADS so jobs can resume."
+                    )
+            logger.info(f"Resuming ingestion job {job_id}")
+            self._enqueue(job_id)
+
+    def _renew(self):
+        while not self._closed.wait(self.store.lease_seconds / 3):
+            try:
+                self.store.renew_leases()
+                self._resume()
+            except Exception as e:
+                logger.error(f"Error renewing ingestion job leases: {str(e)}")
+
+    def _run(self):
+        while True:
+            job_id = self._queue.get()
+            if job_id is _STOP or self._closed.is_set():
+                return
+            try:
+                self._run_job(job_id)
+            except Exception as e:
+                logger.error(f"Error running ingestion job {job_id}: {str(e)}")
+            finally:
+                with self._queued_lock:
+                    self._queued.discard(job_id)
+
+    def _run_job(self, job_id):
+        self.store.start_job(job_id)
+        for source, path in self.store.pending_files(job_id):
+            if self._closed.is_set():
+                return
+            if job_id not in self.store.renew_leases():
+                logger.warning(f"Ingestion job {job_id} was taken over by another process")
+                return
+            document = self._documents.pop((job_id, source), None)
+            if document is None:
+                document = StoredDocument(source, path)
+            self.store.start_file(job_id, source)
+            try:
+                chunks_added = self.process_documents(
+                    [document],
+                    on_progress=lambda source_name, **counts: self.store.add_progress(job_id, source_name, **counts)
+                )
+                self.store.finish_file(job_id, source, chunks_added=chunks_added)
+            except Exception as e:
+                logger.error(f"Error ingesting {source} in job {job_id}: {str(e)}")
+                self.store.finish_file(job_id, source, error=str(e))
+        self.store.finish_job(job_id)
+        logger.info(f"Finished ingestion job {job_id}")
+
+    def close(self):
+        # Waits for the file being ingested, then drops the rest of the queue
+        # and hands its jobs over to any other process sharing the store
+        self._closed.set()
+        self._queue.put(_STOP)
+        self._worker.join()
+        self._heartbeat.join()
+        self.store.release_jobs()
+        self.store.close()
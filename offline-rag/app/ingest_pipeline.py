@@ -0,0 +1,326 @@
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from langchain_core.documents import Document
+
+from .manifest import make_chunk_id, sha256_text
+from .pdf_extract import count_pages, extract_page_range
+
+logger = logging.getLogger(__name__)
+
+
+class StageCounter:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def record(self, items, num_bytes, seconds):
+        self.items += items
+        self.bytes += num_bytes
+        self.seconds += seconds
+
+    @property
+    def items_per_second(self):
+        return self.items / self.seconds if self.seconds > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            "items": self.items,
+            "bytes": self.bytes,
+            "seconds": round(self.seconds, 4),
+            "items_per_second": round(self.items_per_second, 2),
+        }
+
+
+class IngestStats:
+    def __init__(self):
+        self.extract = StageCounter("extract")
+        self.split = StageCounter("split")
+        self.embed = StageCounter("embed")
+        self.wall_seconds = 0.0
+        self.peak_buffered_bytes = 0
+        self.chunks_skipped = 0
+        self.chunks_deleted = 0
+
+    def stages(self):
+        return [self.extract, self.split, self.embed]
+
+    def as_dict(self):
+        stats = {stage.name: stage.as_dict() for stage in self.stages()}
+        stats["wall_seconds"] = round(self.wall_seconds, 4)
+        stats["peak_buffered_bytes"] = self.peak_buffered_bytes
+        stats["chunks_skipped"] = self.chunks_skipped
+        stats["chunks_deleted"] = self.chunks_deleted
+        return stats
+
+    def summary(self):
+        parts = [
+            f"{stage.name}: {stage.items} in {stage.seconds:.2f}s ({stage.items_per_second:.1f}/s)"
+            for stage in self.stages()
+        ]
+        parts.append(f"unchanged: {self.chunks_skipped}, deleted: {self.chunks_deleted}")
+        return f"Ingestion finished in {self.wall_seconds:.2f}s | " + " | ".join(parts)
+
+
+# Streams PDF pages through extract -> split -> embed. Page ranges are parsed
+# in a process pool, split as soon as they arrive and added to the vector store
+# in fixed-size batches, so only about memory_limit_mb of text is buffered.
+# With a manifest, chunks whose content-addressed id is already indexed are
+# skipped and ids that no longer occur in a source are deleted afterwards.
+# Sources held in memory (uploads that were not saved to disk) are extracted
+# in this process so their buffers are never pickled to the workers.
+# With a parent_splitter and parent_store, pages are first split into parent
+# sections, stored as they are, and only their smaller child chunks are
+# embedded, each tagged with its parent_id.
+class IngestionPipeline:
+    def __init__(self, vectorstore, text_splitter, workers=1, batch_size=64,
+                 pages_per_task=8, memory_limit_mb=256, manifest=None, keyword_index=None, on_progress=None,
+                 parent_splitter=None, parent_store=None):
+        self.vectorstore = vectorstore
+        self.text_splitter = text_splitter
+        self.parent_splitter = parent_splitter
+        self.parent_store = parent_store if parent_splitter is not None else None
+        self.workers = max(1, int(workers))
+        self.batch_size = max(1, int(batch_size))
+        self.pages_per_task = max(1, int(pages_per_task))
+        self.memory_limit_bytes = max(1, int(memory_limit_mb)) * 1024 * 1024
+        self.manifest = manifest
+        self.keyword_index = keyword_index
+        # Called as on_progress(source_name, pages_total=None, pages=0,
+        # chunks=0, chunks_done=0) with increments as work completes
+        self.on_progress = on_progress
+        self.stats = IngestStats()
+        self.pages_per_source = {}
+        self._known_ids = {}
+        self._seen_ids = {}
+        self._occurrences = {}
+        self._seen_parent_ids = {}
+        self._buffer = []
+        self._buffered_bytes = 0
+
+    def run(self, sources):
+        # sources is a list of (source_name, source) pairs where source is a
+        # file path or a buffer holding the PDF
+        started = time.perf_counter()
+        chunks_added = 0
+        tasks = deque(self._plan_tasks(sources))
+
+        if self.workers == 1 or sum(isinstance(task[1], str) for task in tasks) <= 1:
+            for source_name, source, start, end in tasks:
+                chunks_added += self._extract_here(source_name, source, start, end)
+        else:
+            chunks_added += self._run_pool(tasks)
+
+        chunks_added += self._flush(len(self._buffer))
+        self._remove_stale_chunks()
+        self.stats.wall_seconds = time.perf_counter() - started
+
+        for source_name, num_pages in self.pages_per_source.items():
+            logger.info(f"Loaded {num_pages} pages from {source_name}")
+        logger.info(self.stats.summary())
+        return chunks_added
+
+    def _plan_tasks(self, sources):
+        tasks = []
+        for source_name, source in sources:
+            num_pages = count_pages(source)
+            self.pages_per_source.setdefault(source_name, 0)
+            self._seen_ids.setdefault(source_name, set())
+            self._seen_parent_ids.setdefault(source_name, set())
+            if self.manifest is not None:
+                self._known_ids[source_name] = self.manifest.chunk_ids(source_name)
+            for start in range(0, num_pages, self.pages_per_task):
+                tasks.append((source_name, source, start, start + self.pages_per_task))
+            self._report(source_name, pages_total=num_pages)
+        return tasks
+
+    def _report(self, source_name, **counts):
+        if self.on_progress is None:
+            return
+        try:
+            self.on_progress(source_name, **counts)
+        except Exception as e:
+            logger.error(f"Error reporting ingestion progress: {str(e)}")
+
+    def _extract_here(self, source_name, source, start, end):
+        pages, seconds = extract_page_range(source, start, end)
+        self._record_extract(pages, seconds)
+        return self._accept_pages(source_name, pages)
+
+    def _run_pool(self, tasks):
+        chunks_added = 0
+        max_in_flight = self.workers * 2
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as executor:
+            futures = {}
+            while tasks or futures:
+                # Back-pressure: stop scheduling extraction while the splitter
+                # and embedder are behind and the buffer sits at the ceiling.
+                while tasks and len(futures) < max_in_flight and self._buffered_bytes < self.memory_limit_bytes:
+                    source_name, source, start, end = tasks.popleft()
+                    if not isinstance(source, str):
+                        chunks_added += self._extract_here(source_name, source, start, end)
+                        continue
+                    future = executor.submit(extract_page_range, source, start, end)
+                    futures[future] = source_name
+
+                if not futures:
+                    chunks_added += self._flush(len(self._buffer))
+                    continue
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    source_name = futures.pop(future)
+                    pages, seconds = future.result()
+                    self._record_extract(pages, seconds)
+                    chunks_added += self._accept_pages(source_name, pages)
+        return chunks_added
+
+    def _record_extract(self, pages, seconds):
+        num_bytes = sum(len(text) for _, text in pages)
+        self.stats.extract.record(len(pages), num_bytes, seconds)
+
+    def _accept_pages(self, source_name, pages):
+        self.pages_per_source[source_name] = self.pages_per_source.get(source_name, 0) + len(pages)
+        documents = [
+            Document(page_content=text, metadata={"source": source_name, "page": page_number})
+            for page_number, text in pages
+            if text.strip()
+        ]
+        if not documents:
+            self._report(source_name, pages=len(pages))
+            return 0
+
+        split_started = time.perf_counter()
+        if self.parent_store is not None:
+            documents = self._split_parents(source_name, documents)
+        chunks = self.text_splitter.split_documents(documents)
+        chunk_bytes = sum(len(chunk.page_content) for chunk in chunks)
+        self.stats.split.record(len(chunks), chunk_bytes, time.perf_counter() - split_started)
+
+        num_split = len(chunks)
+        chunks = self._assign_chunk_ids(source_name, chunks)
+        # Chunks already indexed by an earlier, interrupted run count as done
+        self._report(source_name, pages=len(pages), chunks=num_split, chunks_done=num_split - len(chunks))
+        chunk_bytes = sum(len(chunk.page_content) for chunk in chunks)
+
+        self._buffer.extend(chunks)
+        self._buffered_bytes += chunk_bytes
+        self.stats.peak_buffered_bytes = max(self.stats.peak_buffered_bytes, self._buffered_bytes)
+
+        chunks_added = 0
+        while len(self._buffer) >= self.batch_size:
+            chunks_added += self._flush(self.batch_size)
+        if self._buffered_bytes >= self.memory_limit_bytes:
+            chunks_added += self._flush(len(self._buffer))
+        return chunks_added
+
+    def _split_parents(self, source_name, documents):
+        # Parents never span pages, so (page, position) orders them within
+        # the source whatever order the page ranges finish in. Parents are
+        # written on every run, including for pages whose children are
+        # already indexed, so a resumed run leaves none missing.
+        parents = self.parent_splitter.split_documents(documents)
+        positions = {}
+        rows = []
+        for parent in parents:
+            page = parent.metadata["page"]
+            position = positions.get(page, 0)
+            positions[page] = position + 1
+            key = ("parent", source_name, sha256_text(parent.page_content))
+            occurrence = self._occurrences.get(key, 0)
+            self._occurrences[key] = occurrence + 1
+            parent_id = make_chunk_id(source_name, key[2], occurrence)
+            parent.metadata["parent_id"] = parent_id
+            self._seen_parent_ids.setdefault(source_name, set()).add(parent_id)
+            rows.append((parent_id, source_name, page, position, parent.page_content))
+        self.parent_store.add_many(rows)
+        return parents
+
+    def _assign_chunk_ids(self, source_name, chunks):
+        known_ids = self._known_ids.get(source_name, set())
+        new_chunks = []
+        for chunk in chunks:
+            # A child's id covers its parent too, so a child whose parent
+            # changed is re-indexed pointing at the new parent
+            parent_id = chunk.metadata.get("parent_id")
+            chunk_hash = sha256_text(f"{parent_id}\0{chunk.page_content}" if parent_id else chunk.page_content)
+            key = (source_name, chunk_hash)
+            occurrence = self._occurrences.get(key, 0)
+            self._occurrences[key] = occurrence + 1
+
+            chunk_id = make_chunk_id(source_name, chunk_hash, occurrence)
+            self._seen_ids[source_name].add(chunk_id)
+            if chunk_id in known_ids:
+                self.stats.chunks_skipped += 1
+                if self.keyword_index is not None and chunk_id not in self.keyword_index:
+                    # Indexed before a crash that lost the unsaved keyword index
+                    self.keyword_index.add_many([(chunk_id, source_name, chunk.page_content)])
+                continue
+
+            chunk.metadata["chunk_id"] = chunk_id
+            chunk.metadata["chunk_hash"] = chunk_hash
+            new_chunks.append(chunk)
+        return new_chunks
+
+    def _remove_stale_chunks(self):
+        if self.parent_store is not None:
+            for source_name, seen_parent_ids in self._seen_parent_ids.items():
+                stale_parent_ids = self.parent_store.parent_ids(source_name) - seen_parent_ids
+                if stale_parent_ids:
+                    self.parent_store.remove_ids(stale_parent_ids)
+        if self.manifest is None:
+            return
+        for source_name, known_ids in self._known_ids.items():
+            stale_ids = list(known_ids - self._seen_ids.get(source_name, set()))
+            if not stale_ids:
+                continue
+            self.vectorstore.delete(ids=stale_ids)
+            self.manifest.remove_chunks(stale_ids)
+            if self.keyword_index is not None:
+                self.keyword_index.remove_ids(stale_ids)
+            self.stats.chunks_deleted += len(stale_ids)
+            logger.info(f"Deleted {len(stale_ids)} stale chunks from {source_name}")
+
+    def _flush(self, count):
+        if count <= 0 or not self._buffer:
+            return 0
+        batch, self._buffer = self._buffer[:count], self._buffer[count:]
+        batch_bytes = sum(len(chunk.page_content) for chunk in batch)
+
+        embed_started = time.perf_counter()
+        self.vectorstore.add_documents(batch, ids=[chunk.metadata["chunk_id"] for chunk in batch])
+        self.stats.embed.record(len(batch), batch_bytes, time.perf_counter() - embed_started)
+
+        if self.keyword_index is not None:
+            self.keyword_index.add_many(
+                (chunk.metadata["chunk_id"], chunk.metadata["source"], chunk.page_content) for chunk in batch
+            )
+
+        if self.manifest is not None:
+            by_source = {}
+            for chunk in batch:
+                by_source.setdefault(chunk.metadata["source"], []).append(
+                    (chunk.metadata["chunk_id"], chunk.metadata["chunk_hash"])
+                )
+            for source_name, chunk_rows in by_source.items():
+                self.manifest.add_chunks(source_name, chunk_rows)
+
+        batch_counts = {}
+        for chunk in batch:
+            batch_counts[chunk.metadata["source"]] = batch_counts.get(chunk.metadata["source"], 0) + 1
+        for source_name, count in batch_counts.items():
+            self._report(source_name, chunks_done=count)
+
+        self._buffered_bytes -= batch_bytes
+        return len(batch)
+
+
+def default_worker_count():
+    return max(1, (os.cpu_count() or 2) - 1)
@@ -2,10 +2,11 @@ import streamlit as st
 import sys
 import os
 import logging
-import io
-import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import base64
+import threading
+import uuid
+from streamlit.runtime.scriptrunner import add_script_run_ctx
 
 # Set page config at the very beginning
 st.set_page_config(
@@ -263,10 +264,16 @@ body {
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
-from app.document_processor import process_documents, get_existing_documents, clear_vectorstore, get_embedding_function, remove_document
-from app.model_handler import ModelHandler
-from app.rag import retrieve_context
-from app.utils import load_config
+from app.startup import startup_report, warm_up
+# These stay light: LangChain, Chroma, FastEmbed and llama.cpp are imported
+# lazily on first use, mostly by the background warm-up below.
+with startup_report.timed("imports", "app"):
+    from app.document_processor import get_document_catalog, clear_vectorstore, get_embedding_function, get_vectorstore, remove_document, submit_ingest_job, get_ingest_job, list_ingest_jobs, is_read_only
+    from app.model_handler import ModelHandler
+    from app.rag import build_context, get_query_cache_stats, get_answer_cache_stats, get_telemetry_summary, stream_answer, get_conversation, get_conversation_stats
+    from app.telemetry import start_trace
+    from app.prompts import get_system_prompt, build_rag_prompt, build_chat_prompt, get_cache_prefixes, get_context_budget
+    from app.utils import load_config, get_config_value
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -281,17 +288,27 @@ def get_model_handler():
     # st.write(f"Available models: {model_handler.available_models}")  # Debug info
     return model_handler
 
+@st.cache_resource
+def start_warm_up():
+    # Shared by all sessions; a question asked before it finishes simply
+    # waits for the model it needs.
+    thread = threading.Thread(
+        target=warm_up,
+        args=(get_model_handler(), get_embedding_function, get_vectorstore),
+        name="warm-up",
+        daemon=True
+    )
+    add_script_run_ctx(thread)
+    thread.start()
+    return thread
+
 def load_models():
-    with st.spinner("Loading models... This may take a few minutes."):
-        model_handler = get_model_handler()
+    model_handler = get_model_handler()
 
-        if not model_handler.available_models:
-            st.error("No models are available. Please check your configuration and model files.")
-        else:
-            # st.write(f"Debug: Available models: {model_handler.available_models}")  # More debug info
-            alert = st.success(f"Models loaded successfully! Available models: {', '.join(model_handler.available_models)}")
-            time.sleep(2)
-            alert.empty()
+    if not model_handler.available_models:
+        st.error("No models are available. Please check your configuration and model files.")
+    elif get_config_value(config, 'model_pool_warmup', True):
+        start_warm_up()
 
 def main():
     # Custom CSS for responsive layout
@@ -363,6 +380,10 @@ def main():
         st.session_state.use_rag = True
     if 'debug_mode' not in st.session_state:
         st.session_state.debug_mode = False
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    if 'ingest_job' not in st.session_state:
+        st.session_state.ingest_job = find_active_ingest_job()
 
     if not st.session_state.models_loaded:
         load_models()
@@ -395,23 +416,31 @@ def main():
         """,
         unsafe_allow_html=True
     )
+    startup_report.mark("first_render")
 
 def settings_section():
     with st.container():
         st.subheader("Settings")
 
-        uploaded_files = st.file_uploader("Upload PDF documents", accept_multiple_files=True, type=['pdf'])
+        read_only = is_read_only()
+        if read_only:
+            st.caption("Serving a prebuilt, read-only index bundle; documents cannot be added or removed.")
+            uploaded_files = []
+        else:
+            uploaded_files = st.file_uploader("Upload PDF documents", accept_multiple_files=True, type=['pdf'])
 
-        existing_docs = get_existing_documents()
+        document_catalog = get_document_catalog()
+        existing_docs = [document['source'] for document in document_catalog]
         if existing_docs:
             st.write("Existing documents:")
             with st.container():
-                for doc in existing_docs:
+                for document in document_catalog:
+                    doc = document['source']
                     col1, col2 = st.columns([3, 1])
                     with col1:
-                        st.markdown(f"<p>- {doc}</p>", unsafe_allow_html=True)
+                        st.markdown(f"<p>- {doc} ({format_catalog_details(document)})</p>", unsafe_allow_html=True)
                     with col2:
-                        if st.button(f"Remove", key=f"remove_{doc}"):
+                        if not read_only and st.button(f"Remove", key=f"remove_{doc}"):
                             if remove_document(doc):
                                 st.success(f"Removed {doc}")
                                 st.experimental_rerun()
@@ -421,6 +450,8 @@ def settings_section():
             st.write("No existing documents found.")
 
         model_handler = get_model_handler()
+        if get_config_value(config, 'model_pool_warmup', True) and start_warm_up().is_alive():
+            st.caption("Loading models in the background; the first answer may take longer.")
         if model_handler.available_models:
             model_choice = st.selectbox("Choose a model", model_handler.available_models)
             st.session_state.model_choice = model_choice
@@ -443,37 +474,119 @@ def settings_section():
                     st.success("Chat enabled without RAG.")
                     st.session_state.chat_enabled = True
 
+        if st.session_state.debug_mode:
+            with st.expander("Model Pool"):
+                st.json(model_handler.get_pool_metrics())
+            with st.expander("Prefix Cache"):
+                st.json(model_handler.get_prefix_cache_stats())
+            with st.expander("Generation Queue"):
+                st.json(model_handler.get_scheduler_metrics())
+            if get_config_value(config, 'speculative_decoding', "none") != "none":
+                with st.expander("Speculative Decoding"):
+                    st.json(model_handler.get_speculative_stats())
+            with st.expander("Conversation"):
+                st.json(get_conversation_stats(st.session_state.session_id))
+            with st.expander("Answer Cache"):
+                st.json(get_answer_cache_stats())
+            with st.expander("Startup"):
+                st.json(startup_report.as_dict())
+            with st.expander("Telemetry"):
+                show_telemetry_summary(get_telemetry_summary())
+
+        ingest_progress()
         if 'processing_result' in st.session_state:
             st.markdown(st.session_state.processing_result, unsafe_allow_html=True)
             if st.session_state.debug_mode and 'processing_logs' in st.session_state:
                 with st.expander("Processing Logs"):
                     st.markdown(f'<div class="processing-logs">{st.session_state.processing_logs}</div>', unsafe_allow_html=True)
 
-def process_and_enable_chat(uploaded_files):
-    with st.spinner("Processing documents..."):
-        try:
-            log_capture = io.StringIO()
-            log_handler = logging.StreamHandler(log_capture)
-            logger.addHandler(log_handler)
-
-            num_chunks = process_documents(uploaded_files)
-
-            logger.removeHandler(log_handler)
-            log_contents = log_capture.getvalue()
+def show_telemetry_summary(summary):
+    if not summary['requests']:
+        st.write("No requests recorded yet.")
+        return
+    st.write(
+        f"Last {summary['requests']} requests: total p50 {summary['total_p50_seconds']:.2f}s / "
+        f"p95 {summary['total_p95_seconds']:.2f}s"
+    )
+    if summary['ttft_p50_seconds'] is not None:
+        st.write(f"Time to first token: p50 {summary['ttft_p50_seconds']:.2f}s / p95 {summary['ttft_p95_seconds']:.2f}s")
+    st.write("Slowest requests:")
+    st.json(summary['slowest'])
+    st.write("Cache outcomes:")
+    st.json(summary['cache'])
+    if summary['path']:
+        st.caption(f"Full records: {summary['path']}")
+
+def format_catalog_details(document):
+    details = f"{document['chunk_count']} chunks"
+    if document['byte_size'] is not None:
+        details += f", {document['byte_size'] / 1024:.0f} KB"
+    return details
 
-            if num_chunks > 0:
-                st.session_state.processing_result = f'<div class="stAlert success">Processed {num_chunks} chunks from {len(uploaded_files)} documents</div>'
-                st.session_state.chat_enabled = True
-            else:
-                st.session_state.processing_result = '<div class="stAlert info fade-out">No new documents to process.</div>'
+def process_and_enable_chat(uploaded_files):
+    if not uploaded_files:
+        st.session_state.processing_result = '<div class="stAlert info fade-out">No new documents to process.</div>'
+        st.session_state.chat_enabled = True
+        return
+    try:
+        # Ingestion runs on the job runner's thread; ingest_progress polls it
+        st.session_state.ingest_job = submit_ingest_job(uploaded_files)
+        st.session_state.pop('processing_result', None)
+        st.session_state.pop('processing_logs', None)
+    except Exception as e:
+        logger.error(f"Error processing documents: {str(e)}")
+        st.session_state.processing_result = f'<div class="stAlert error">Error processing documents: {str(e)}</div>'
+        st.session_state.chat_enabled = False
 
-            if st.session_state.debug_mode:
-                st.session_state.processing_logs = log_contents
-            st.session_state.chat_enabled = True
-        except Exception as e:
-            logger.error(f"Error processing documents: {str(e)}")
-            st.session_state.processing_result = f'<div class="stAlert error">Error processing documents: {str(e)}</div>'
-            st.session_state.chat_enabled = False
+def find_active_ingest_job():
+    # Picks up a job started by another session or resumed after a restart
+    try:
+        for job in list_ingest_jobs(limit=5):
+            if job['status'] in ("queued", "running"):
+                return job['job_id']
+    except Exception as e:
+        logger.error(f"Error listing ingestion jobs: {str(e)}")
+    return None
+
+def format_job_progress(job):
+    if job['status'] == "queued":
+        return "Waiting for another ingestion job to finish..."
+    text = f"Parsed {job['pages_done']}/{job['pages_total']} pages, embedded {job['chunks_done']} chunks"
+    if job['eta_seconds'] is not None:
+        text += f", about {job['eta_seconds']:.0f}s left"
+    return text
+
+@st.experimental_fragment(run_every=1)
+def ingest_progress():
+    job_id = st.session_state.get('ingest_job')
+    if job_id is None:
+        return
+    job = get_ingest_job(job_id)
+    if job is None:
+        st.session_state.ingest_job = None
+        return
+    if job['status'] in ("queued", "running"):
+        st.progress(job['fraction'], text=format_job_progress(job))
+        return
+
+    st.session_state.ingest_job = None
+    failed = [f for f in job['files'] if f['status'] == "failed"]
+    if failed:
+        errors = "<br>".join(f"{f['source']}: {f['error']}" for f in failed)
+        st.session_state.processing_result = f'<div class="stAlert error">Error processing documents:<br>{errors}</div>'
+    elif job['chunks_added'] > 0:
+        st.session_state.processing_result = f'<div class="stAlert success">Processed {job["chunks_added"]} chunks from {len(job["files"])} documents</div>'
+    else:
+        st.session_state.processing_result = '<div class="stAlert info fade-out">No new documents to process.</div>'
+    st.session_state.chat_enabled = len(failed) < len(job['files'])
+    if st.session_state.debug_mode:
+        st.session_state.processing_logs = "<br>".join(
+            f"{f['source']}: {f['status']}, {f['pages_done']} pages, {f['chunks_done']} chunks "
+            f"({f['chunks_added'] or 0} new)"
+            for f in job['files']
+        )
+    # The catalog and chat input live outside this fragment
+    st.rerun()
 
 def chat_interface():
     st.subheader("Chat Interface")
@@ -493,22 +606,38 @@ def chat_interface():
             with st.chat_message("assistant"):
                 message_placeholder = st.empty()
                 full_response = ""
-                model_handler = ModelHandler(config)
+                model_handler = get_model_handler()
                 model_choice = st.session_state.model_choice
 
+                start_trace("ui_chat", question=prompt, model=model_choice, use_rag=st.session_state.use_rag,
+                            session_id=st.session_state.session_id)
+                conversation = get_chat_conversation(model_handler, model_choice)
+                history, summary = conversation.snapshot() if conversation is not None else ([], "")
+                cache_prefixes = None
+                system_prompt, context, sources = "", "", []
                 if st.session_state.use_rag:
-                    context = retrieve_context(prompt)
+                    context, accounting = get_rag_context(prompt, model_handler, model_choice, history, summary)
+                    sources = [chunk['source'] for chunk in accounting.get('chunks', [])]
                     system_prompt = get_system_prompt()
-                    full_prompt = f"{system_prompt}\n\nContext: {context}\n\nHuman: {prompt}\n\nAssistant:"
+                    full_prompt = build_rag_prompt(system_prompt, context, prompt, history, summary)
+                    cache_prefixes = get_cache_prefixes(system_prompt, context)
                 else:
-                    full_prompt = prompt
+                    full_prompt = build_chat_prompt(prompt, history, summary)
 
                 if st.session_state.debug_mode:
                     with st.expander("LLM Prompt"):
                         st.code(full_prompt)
 
                 try:
-                    for response in model_handler.generate_stream(full_prompt, model_choice=model_choice):
+                    stream, cached = stream_answer(
+                        model_handler, model_choice, prompt, full_prompt,
+                        system_prompt=system_prompt, context=context, sources=sources,
+                        cache_prefixes=cache_prefixes, session_id=st.session_state.session_id,
+                        conversation=conversation
+                    )
+                    if cached and st.session_state.debug_mode:
+                        st.caption("Served from the answer cache")
+                    for response in stream:
                         full_response += response
                         message_placeholder.markdown(full_response + "▌")
                     message_placeholder.markdown(full_response)
@@ -524,12 +653,6 @@ def chat_interface():
     else:
         st.info("Please process documents or disable RAG to start chatting.")
 
-def get_system_prompt():
-    return """You are a helpful AI assistant. Your task is to answer questions based solely on the provided context.
-    If the context doesn't contain enough information to answer the question, say so.
-    Do not use any external knowledge or make assumptions beyond what's given in the context.
-    If asked about your capabilities or identity, refer only to being an AI assistant without mentioning specific models or companies."""
-
 def handle_chat_input():
     if prompt := st.chat_input("What is your question?"):
         system_prompt = get_system_prompt()
@@ -538,24 +661,40 @@ def handle_chat_input():
             st.markdown(prompt)
 
         with st.chat_message("assistant"):
-            model_handler = ModelHandler(config)
+            model_handler = get_model_handler()
             model_choice = st.session_state.model_choice
             message_placeholder = st.empty()
             full_response = ""
 
+            start_trace("ui_chat", question=prompt, model=model_choice, use_rag=st.session_state.use_rag,
+                        session_id=st.session_state.session_id)
+            conversation = get_chat_conversation(model_handler, model_choice)
+            history, summary = conversation.snapshot() if conversation is not None else ([], "")
+            cache_prefixes = None
+            system_prompt, context, sources = "", "", []
             if st.session_state.use_rag:
-                context = retrieve_context(prompt)
+                context, accounting = get_rag_context(prompt, model_handler, model_choice, history, summary)
+                sources = [chunk['source'] for chunk in accounting.get('chunks', [])]
                 system_prompt = get_system_prompt()
-                full_prompt = f"{system_prompt}\n\nContext: {context}\n\nHuman: {prompt}\n\nAssistant:"
+                full_prompt = build_rag_prompt(system_prompt, context, prompt, history, summary)
+                cache_prefixes = get_cache_prefixes(system_prompt, context)
             else:
-                full_prompt = prompt
+                full_prompt = build_chat_prompt(prompt, history, summary)
 
             if st.session_state.debug_mode:
                 with st.expander("LLM Prompt"):
                     st.code(full_prompt)
 
             try:
-                for response in model_handler.generate_stream(full_prompt, model_choice=model_choice):
+                stream, cached = stream_answer(
+                    model_handler, model_choice, prompt, full_prompt,
+                    system_prompt=system_prompt, context=context, sources=sources,
+                    cache_prefixes=cache_prefixes, session_id=st.session_state.session_id,
+                    conversation=conversation
+                )
+                if cached and st.session_state.debug_mode:
+                    st.caption("Served from the answer cache")
+                for response in stream:
                     full_response += response
                     message_placeholder.markdown(full_response + "▌")
                 message_placeholder.markdown(full_response)
@@ -566,19 +705,37 @@ def handle_chat_input():
 
         st.session_state.messages.append({"role": "assistant", "content": full_response})
 
-def get_rag_context(prompt):
+def get_chat_conversation(model_handler, model_choice):
+    try:
+        with st.spinner("Summarizing the earlier conversation..."):
+            return get_conversation(model_handler, model_choice, st.session_state.session_id)
+    except Exception as e:
+        # The question is still answered, just without the earlier turns
+        logger.error(f"Error loading conversation history: {str(e)}")
+        return None
+
+def get_rag_context(prompt, model_handler=None, model_choice=None, history=(), summary=""):
     try:
-        context = retrieve_context(prompt, top_k=config['top_k'])
+        token_budget, count_tokens = get_context_budget(prompt, model_handler, model_choice, history, summary)
+        context, accounting = build_context(prompt, top_k=config['top_k'], token_budget=token_budget, count_tokens=count_tokens)
         if st.session_state.debug_mode:
             logger.info(f"RAG Context: {context}")
             with st.expander("RAG Debug Information"):
                 st.write("RAG Context:")
                 st.code(context)
-        return context
+                st.write("Token accounting:")
+                st.json(accounting)
+                cache_stats = get_query_cache_stats()
+                st.write(
+                    f"Query cache (generation {cache_stats['generation']}): "
+                    f"results {cache_stats['results']['hits']} hits / {cache_stats['results']['misses']} misses, "
+                    f"embeddings {cache_stats['embeddings']['hits']} hits / {cache_stats['embeddings']['misses']} misses"
+                )
+        return context, accounting
     except Exception as e:
         logger.error(f"Error retrieving context: {str(e)}")
         st.error(f"Error retrieving context: {str(e)}")
-        return ""
+        return "", {}
 
 def get_base64_of_image(image_path):
     with open(image_path, "rb") as img_file:
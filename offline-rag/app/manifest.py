@@ -0,0 +1,160 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+def sha256_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def sha256_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_chunk_id(source, chunk_hash, occurrence):
+    # Identical text can legitimately appear more than once in a file, so the
+    # occurrence index keeps the ids unique while staying content-addressed.
+    return sha256_text(f"{source}\0{chunk_hash}\0{occurrence}")
+
+
+class IngestManifest:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                source TEXT PRIMARY KEY,
+                file_hash TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                chunk_id TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                chunk_hash TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS chunks_by_source ON chunks (source);
+            CREATE TABLE IF NOT EXISTS documents (
+                source TEXT PRIMARY KEY,
+                chunk_count INTEGER NOT NULL,
+                byte_size INTEGER,
+                ingested_at REAL NOT NULL,
+                content_hash TEXT
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+        self._conn.commit()
+        self._inode = os.stat(path).st_ino
+
+    def is_replaced(self):
+        # True once another process has cleared chroma_db and this connection
+        # points at a deleted file
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return True
+
+    def collection_version(self):
+        # Changes whenever any process changes the collection; processes
+        # sharing chroma_db compare it to notice each other's changes
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'collection_version'").fetchone()
+        return row[0] if row else ""
+
+    def bump_collection_version(self):
+        version = uuid.uuid4().hex
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('collection_version', ?)", (version,))
+        return version
+
+    def file_hash(self, source):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_hash FROM files WHERE source = ?", (source,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def chunk_ids(self, source):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_id FROM chunks WHERE source = ?", (source,)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def add_chunks(self, source, chunks):
+        # chunks is an iterable of (chunk_id, chunk_hash) pairs
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (chunk_id, source, chunk_hash) VALUES (?, ?, ?)",
+                [(chunk_id, source, chunk_hash) for chunk_id, chunk_hash in chunks],
+            )
+
+    def remove_chunks(self, chunk_ids):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM chunks WHERE chunk_id = ?", [(chunk_id,) for chunk_id in chunk_ids]
+            )
+
+    def record_file(self, source, file_hash, byte_size=None):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (source, file_hash, updated_at) VALUES (?, ?, ?)",
+                (source, file_hash, now),
+            )
+            chunk_count = self._conn.execute(
+                "SELECT COUNT(*) FROM chunks WHERE source = ?", (source,)
+            ).fetchone()[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (source, chunk_count, byte_size, ingested_at, content_hash) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (source, chunk_count, byte_size, now, file_hash),
+            )
+
+    def list_documents(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT source, chunk_count, byte_size, ingested_at, content_hash FROM documents ORDER BY source"
+            ).fetchall()
+        return [
+            {"source": source, "chunk_count": chunk_count, "byte_size": byte_size,
+             "ingested_at": ingested_at, "content_hash": content_hash}
+            for source, chunk_count, byte_size, ingested_at, content_hash in rows
+        ]
+
+    def backfill_documents(self, chunk_counts):
+        # Catalog rows for sources indexed before the catalog existed; their
+        # size and hash are unknown until they are processed again.
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO documents (source, chunk_count, byte_size, ingested_at, content_hash) "
+                "VALUES (?, ?, NULL, ?, NULL)",
+                [(source, count, now) for source, count in chunk_counts.items()],
+            )
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('catalog_backfilled', '1')")
+
+    def is_catalog_backfilled(self):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'catalog_backfilled'").fetchone()
+        return row is not None
+
+    def remove_source(self, source):
+        chunk_ids = self.chunk_ids(source)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chunks WHERE source = ?", (source,))
+            self._conn.execute("DELETE FROM files WHERE source = ?", (source,))
+            self._conn.execute("DELETE FROM documents WHERE source = ?", (source,))
+        return chunk_ids
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
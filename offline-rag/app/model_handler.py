@@ -1,17 +1,29 @@
 
-from llama_cpp import Llama
-import torch
 import os
-import streamlit as st
 import time
 import logging
+import threading
+from .autotune import get_tuned_settings
+from .model_pool import get_model_pool
+from .prefix_cache import PrefixCache, SessionCache, TTFTStats
+from .scheduler import GenerationScheduler
+from .speculative import GGUFDraftModel, SpeculativeStats, get_speculative_llama_class
+from .utils import get_config_value
+from .startup import lazy_import, startup_report
+from .telemetry import percentile, record_generation
 
 logger = logging.getLogger(__name__)
 
 class ModelHandler:
-    def __init__(self, config):
+    def __init__(self, config, pool=None):
         self.config = config
-        self.loaded_models = {}
+        self.pool = pool or get_model_pool(config)
+        self.prefix_caches = {}
+        self.session_caches = {}
+        self.schedulers = {}
+        self._schedulers_lock = threading.Lock()
+        self.ttft_stats = TTFTStats()
+        self.draft_models = {}
         self.check_available_models()
 
     def check_available_models(self):
@@ -25,79 +37,316 @@ class ModelHandler:
             if path and os.path.exists(path):
                 self.available_models.append(model_name)
 
-    @st.cache_resource
-    def load_model(_self, model_path):
+    def load_model(self, model_path):
         try:
-            quantization = _self._get_quantization_from_filename(model_path)
-            return Llama(
-                model_path=model_path,
-                n_ctx=_self.config['model_n_ctx'],
-                n_batch=_self.config['model_n_batch'],
-                n_gpu_layers=-1 if torch.cuda.is_available() else 0,
-                f16_kv=True,
-                use_mmap=True,
-                verbose=False,
-                **_self._get_quantization_params(quantization)
-            )
+            # Imported on first load so the UI does not wait for llama.cpp
+            llama_cpp = lazy_import("llama_cpp")
+            draft_model = self._load_draft_model(llama_cpp, model_path)
+            llama_class = get_speculative_llama_class(llama_cpp) if draft_model is not None else llama_cpp.Llama
+            params = {"n_batch": self.config['model_n_batch'], "use_mmap": True}
+            params.update(self._get_tuned_settings(model_path))
+            with startup_report.timed("loads", os.path.basename(model_path)):
+                return llama_class(
+                    model_path=model_path,
+                    n_ctx=self.config['model_n_ctx'],
+                    n_gpu_layers=-1 if llama_cpp.llama_supports_gpu_offload() else 0,
+                    f16_kv=True,
+                    verbose=False,
+                    draft_model=draft_model,
+                    # Set explicitly so the logits buffer is sized for the
+                    # whole window, not just one batch
+                    logits_all=draft_model is not None,
+                    **params
+                )
         except Exception as e:
             logger.error(f"Error loading model from {model_path}: {str(e)}")
             raise
 
+    def _load_draft_model(self, llama_cpp, model_path):
+        # Returns the draft for speculative decoding, or None to decode
+        # normally. Any problem with the draft falls back to normal decoding.
+        method = get_config_value(self.config, 'speculative_decoding', "none")
+        if method == "prompt-lookup":
+            speculative = lazy_import("llama_cpp.llama_speculative")
+            draft = speculative.LlamaPromptLookupDecoding(
+                max_ngram_size=get_config_value(self.config, 'speculative_ngram_size', 2),
+                num_pred_tokens=get_config_value(self.config, 'speculative_draft_tokens', 10)
+            )
+        elif method == "draft-model":
+            draft_path = get_config_value(self.config, 'draft_model_path')
+            if not draft_path or not os.path.exists(draft_path):
+                logger.warning(f"Draft model {draft_path} not found, using standard decoding")
+                return None
+            try:
+                target_vocab = llama_cpp.Llama(model_path=model_path, vocab_only=True, verbose=False).n_vocab()
+                with startup_report.timed("loads", os.path.basename(draft_path)):
+                    draft_llama = llama_cpp.Llama(
+                        model_path=draft_path,
+                        n_ctx=self.config['model_n_ctx'],
+                        n_batch=self.config['model_n_batch'],
+                        n_gpu_layers=-1 if llama_cpp.llama_supports_gpu_offload() else 0,
+                        use_mmap=True,
+                        verbose=False
+                    )
+            except Exception as e:
+                logger.error(f"Error loading draft model from {draft_path}, using standard decoding: {str(e)}")
+                return None
+            if draft_llama.n_vocab() != target_vocab:
+                logger.error(
+                    f"Draft model {draft_path} has a {draft_llama.n_vocab()}-token vocabulary but the target has "
+                    f"{target_vocab}; using standard decoding"
+                )
+                return None
+            draft = GGUFDraftModel(draft_llama, get_config_value(self.config, 'speculative_draft_tokens', 4))
+        else:
+            if method != "none":
+                logger.warning(f"Unknown speculative decoding method {method}, using standard decoding")
+            return None
+
+        # llama.cpp keeps logits for every position of the window when
+        # verifying drafts, so expect n_ctx * n_vocab * 4 bytes more RAM.
+        logger.info(f"Speculative decoding ({method}) enabled for {os.path.basename(model_path)}")
+        stats = SpeculativeStats(draft, method)
+        self.draft_models[model_path] = stats
+        return stats
 
-    def _get_quantization_from_filename(self, filename):
-        filename_lower = filename.lower()
-        for q in ['q2', 'q3', 'q4', 'q5', 'q6', 'q8']:
-            if q in filename_lower:
-                return q
-        return 'default'
 
-    def _get_quantization_params(self, quantization):
-        return {'n_gqa': int(quantization[1])} if quantization.startswith('q') else {}
+    def _get_tuned_settings(self, model_path):
+        # Threads, n_batch and mmap/mlock from `python -m app.autotune`, when
+        # this host has a profile for the model
+        if not get_config_value(self.config, 'autotune_enabled', True):
+            return {}
+        profile_dir = get_config_value(self.config, 'autotune_profile_dir', "./models/autotune")
+        settings = get_tuned_settings(profile_dir, model_path)
+        if settings:
+            logger.info(f"Using autotuned settings for {os.path.basename(model_path)}: {settings}")
+        return settings
+
+    def _get_model_paths(self):
+        return {
+            "Llama 3": self.config.get('llama_model_path'),
+            "Mistral": self.config.get('mistral_model_path'),
+            "Gemma": self.config.get('gemma_model_path')
+        }
 
     def get_model(self, model_choice):
-        if model_choice not in self.loaded_models:
-            model_paths = {
-                "Llama 3": self.config['llama_model_path'],
-                "Mistral": self.config['mistral_model_path'],
-                "Gemma": self.config['gemma_model_path']
-            }
-            if model_choice not in model_paths:
-                raise ValueError(f"Model {model_choice} is not available. Available models: {', '.join(self.available_models)}")
-            self.loaded_models[model_choice] = self.load_model(model_paths[model_choice])
-        return self.loaded_models[model_choice]
-
-    def generate_stream(self, prompt, model_choice="Mistral"):
+        model_paths = self._get_model_paths()
+        if not model_paths.get(model_choice):
+            raise ValueError(f"Model {model_choice} is not available. Available models: {', '.join(self.available_models)}")
+        return self.pool.get(model_choice, model_paths[model_choice], self.load_model)
+
+    def warm_up(self, model_choices=None):
+        if model_choices is None:
+            model_choices = self.available_models
+        model_paths = self._get_model_paths()
+        self.pool.warm_up(
+            {choice: model_paths[choice] for choice in model_choices if model_paths.get(choice)},
+            self.load_model
+        )
+
+    def get_pool_metrics(self):
+        return self.pool.metrics()
+
+    def get_prefix_cache(self, model_choice, model):
+        if not get_config_value(self.config, 'prefix_cache_enabled', True):
+            return None
+        cache = self.prefix_caches.get(model_choice)
+        # The pool may have evicted and reloaded the model; states from the
+        # old context are useless for the new one.
+        if cache is None or cache.model is not model:
+            max_mb = get_config_value(self.config, 'prefix_cache_max_mb', 512)
+            cache = PrefixCache(model, max_mb * 2**20)
+            self.prefix_caches[model_choice] = cache
+        return cache
+
+    def _prepare_prefix_cache(self, model_choice, model, prompt, cache_prefixes):
+        cache = self.get_prefix_cache(model_choice, model) if cache_prefixes else None
+        if cache is None:
+            return "disabled", 0
+        prompt_tokens = model.tokenize(prompt.encode("utf-8"))
+        prefix_tokens_list = [model.tokenize(prefix.encode("utf-8")) for prefix in cache_prefixes]
+        hits_before = cache.hits
+        try:
+            reused = cache.prepare(prompt_tokens, prefix_tokens_list)
+        except Exception as e:
+            logger.error(f"Error preparing prefix cache: {str(e)}")
+            return "disabled", 0
+        return ("hit" if cache.hits > hits_before else "miss"), reused
+
+    def get_session_cache(self, model_choice, model):
+        if not get_config_value(self.config, 'session_cache_enabled', True):
+            return None
+        cache = self.session_caches.get(model_choice)
+        if cache is None or cache.model is not model:
+            max_mb = get_config_value(self.config, 'session_cache_max_mb', 512)
+            cache = SessionCache(model, max_mb * 2**20)
+            self.session_caches[model_choice] = cache
+        return cache
+
+    def _prepare_session_cache(self, model_choice, model, prompt, session_id, session_prefix):
+        cache = self.get_session_cache(model_choice, model)
+        if cache is None:
+            return "disabled", 0
+        prompt_tokens = model.tokenize(prompt.encode("utf-8"))
+        prefix_tokens = model.tokenize(session_prefix.encode("utf-8"))
+        hits_before = cache.hits
+        try:
+            reused = cache.prepare(session_id, prompt_tokens, prefix_tokens)
+        except Exception as e:
+            logger.error(f"Error preparing session cache: {str(e)}")
+            return "disabled", 0
+        return ("session_hit" if cache.hits > hits_before else "session_miss"), reused
+
+    def drop_session(self, session_id):
+        for cache in self.session_caches.values():
+            cache.drop(session_id)
+
+    def get_prefix_cache_stats(self):
+        return {
+            "ttft": self.ttft_stats.summary(),
+            "caches": {choice: cache.stats() for choice, cache in self.prefix_caches.items()},
+            "sessions": {choice: cache.stats() for choice, cache in self.session_caches.items()},
+        }
+
+    def get_speculative_stats(self):
+        return {
+            choice: self.draft_models[path].summary()
+            for choice, path in self._get_model_paths().items() if path in self.draft_models
+        }
+
+    def get_scheduler(self, model_choice):
+        with self._schedulers_lock:
+            scheduler = self.schedulers.get(model_choice)
+            if scheduler is None:
+                scheduler = GenerationScheduler(
+                    model_choice,
+                    max_queue=get_config_value(self.config, 'generation_queue_size', 8)
+                )
+                self.schedulers[model_choice] = scheduler
+            return scheduler
+
+    def get_scheduler_metrics(self):
+        return {choice: scheduler.metrics() for choice, scheduler in self.schedulers.items()}
+
+    def generate_stream(self, prompt, model_choice="Mistral", cache_prefixes=None, session_id=None, trace=None,
+                        session_prefix=None):
+        # Queues the generation behind other sessions using the same model.
+        # Raises SchedulerBusyError straight away when the queue is full.
+        submitted = time.perf_counter()
+        return self.get_scheduler(model_choice).stream(
+            session_id,
+            lambda: self._generate_stream(
+                prompt, model_choice, cache_prefixes, trace, submitted, session_id, session_prefix
+            )
+        )
+
+    def _generate_stream(self, prompt, model_choice, cache_prefixes=None, trace=None, submitted=None,
+                         session_id=None, session_prefix=None):
+        # cache_prefixes are leading parts of the prompt, shortest first,
+        # whose llama.cpp state is worth snapshotting for later requests.
+        # session_prefix is the conversation so far in a multi-turn chat; its
+        # state is kept per session instead.
+        started = time.perf_counter()
         model = self.get_model(model_choice)
-        start_time = time.time()
+        start_time = time.perf_counter()
+        if session_prefix and session_id is not None:
+            cache_outcome, reused_tokens = self._prepare_session_cache(
+                model_choice, model, prompt, session_id, session_prefix
+            )
+        else:
+            if not get_config_value(self.config, 'prefix_cache_context', True):
+                cache_prefixes = (cache_prefixes or [])[:1]
+            cache_outcome, reused_tokens = self._prepare_prefix_cache(model_choice, model, prompt, cache_prefixes)
+        prompt_tokens = len(model.tokenize(prompt.encode("utf-8")))
+        draft = getattr(model, "draft_model", None)
+        if isinstance(draft, SpeculativeStats):
+            draft.start()
+            draft_before = draft.snapshot()
+        else:
+            draft = None
+
         tokens_generated = 0
+        ttft = None
+        token_gaps = []
+        last_token_time = None
+        try:
+            for output in model(
+                prompt,
+                max_tokens=self._get_dynamic_max_tokens(prompt_tokens),
+                stop=["Human:", "\n"],
+                echo=False,
+                stream=True,
+                temperature=0.7,
+                top_p=0.95,
+                repeat_penalty=1.1
+            ):
+                now = time.perf_counter()
+                if tokens_generated == 0:
+                    ttft = now - start_time
+                    self.ttft_stats.record(cache_outcome, ttft)
+                    logger.info(f"Time to first token: {ttft:.2f}s (prefix cache {cache_outcome}, {reused_tokens} tokens reused)")
+                else:
+                    token_gaps.append(now - last_token_time)
+                last_token_time = now
+                tokens_generated += 1
+                yield output['choices'][0]['text']
+        finally:
+            # Also runs when the request is cancelled mid-answer
+            total_time = time.perf_counter() - start_time
+            self._log_performance_metrics(total_time, tokens_generated, token_gaps)
+            speculative = draft.since(draft_before, tokens_generated) if draft is not None else None
+            if speculative is not None:
+                logger.info(
+                    f"Speculative decoding: {speculative['accepted_tokens']}/{speculative['proposed_tokens']} "
+                    f"draft tokens accepted, {speculative['tokens_per_target_pass']} tokens per target pass"
+                )
+            record_generation(
+                trace, prompt_tokens, tokens_generated, ttft, token_gaps, total_time,
+                queue_wait_seconds=round(started - submitted, 4) if submitted is not None else None,
+                model_load_seconds=round(start_time - started, 4),
+                prefix_cache=cache_outcome,
+                prefix_reused_tokens=reused_tokens,
+                speculative=speculative,
+            )
 
-        for output in model(
-            prompt,
-            max_tokens=self._get_dynamic_max_tokens(prompt),
-            stop=["Human:", "\n"],
-            echo=False,
-            stream=True,
-            temperature=0.7,
-            top_p=0.95,
-            repeat_penalty=1.1
-        ):
-            tokens_generated += 1
-            yield output['choices'][0]['text']
-
-        end_time = time.time()
-        self._log_performance_metrics(start_time, end_time, tokens_generated)
-
-    def _get_dynamic_max_tokens(self, prompt):
-        prompt_tokens = len(prompt.split())
+    def complete(self, prompt, model_choice, max_tokens, session_id=None):
+        # A short, non-streamed generation such as a conversation summary,
+        # queued like any other request
+        return "".join(self.get_scheduler(model_choice).stream(
+            session_id, lambda: self._complete(prompt, model_choice, max_tokens)
+        ))
+
+    def _complete(self, prompt, model_choice, max_tokens):
+        model = self.get_model(model_choice)
+        output = model(prompt, max_tokens=max_tokens, stop=["Human:"], echo=False, temperature=0.2)
+        yield output['choices'][0]['text']
+
+    def count_tokens(self, text, model_choice):
+        model = self.get_model(model_choice)
+        return len(model.tokenize(text.encode("utf-8"), add_bos=False))
+
+    def get_context_token_budget(self, prompt_without_context, model_choice):
+        # Whatever the window has left once the fixed prompt and the tokens
+        # reserved for the answer are accounted for.
+        model = self.get_model(model_choice)
+        prompt_tokens = len(model.tokenize(prompt_without_context.encode("utf-8")))
+        reserved = int(self.config['max_input_length'])
+        margin = get_config_value(self.config, 'context_token_margin', 16)
+        return max(0, int(self.config['model_n_ctx']) - prompt_tokens - reserved - margin)
+
+    def _get_dynamic_max_tokens(self, prompt_tokens):
         max_tokens = min(
             int(self.config['max_input_length']),
-            self.config['model_n_ctx'] - prompt_tokens
+            int(self.config['model_n_ctx']) - prompt_tokens
         )
         return max(1, max_tokens)  # Ensure at least 1 token is generated
 
-    def _log_performance_metrics(self, start_time, end_time, tokens_generated):
-        total_time = end_time - start_time
-        tokens_per_second = tokens_generated / total_time
-        logger.info(f"Generated {tokens_generated} tokens in {total_time:.2f} seconds ({tokens_per_second:.2f} tokens/sec)")
-
-
+    def _log_performance_metrics(self, total_time, tokens_generated, token_gaps=()):
+        tokens_per_second = tokens_generated / total_time if total_time > 0 else 0.0
+        message = f"Generated {tokens_generated} tokens in {total_time:.2f} seconds ({tokens_per_second:.2f} tokens/sec)"
+        if token_gaps:
+            message += (
+                f", inter-token p50 {percentile(token_gaps, 0.5) * 1000:.1f} ms"
+                f" / p95 {percentile(token_gaps, 0.95) * 1000:.1f} ms"
+            )
+        logger.info(message)
@@ -0,0 +1,162 @@
+import gc
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .utils import get_config_value
+
+logger = logging.getLogger(__name__)
+
+
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # ru_maxrss is a high-water mark in KiB on Linux; good enough as a fallback
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PooledModel:
+    def __init__(self, name, path, model, load_seconds, file_bytes, rss_delta_bytes):
+        self.name = name
+        self.path = path
+        self.model = model
+        self.load_seconds = load_seconds
+        self.file_bytes = file_bytes
+        self.rss_delta_bytes = rss_delta_bytes
+        self.uses = 0
+        self.last_used = time.time()
+
+    @property
+    def footprint_bytes(self):
+        # Weights are mmapped, so RSS right after load understates what the
+        # model occupies once every page has been touched by inference.
+        return max(self.file_bytes, self.rss_delta_bytes)
+
+    def as_dict(self):
+        return {
+            "path": self.path,
+            "load_seconds": round(self.load_seconds, 2),
+            "footprint_mb": round(self.footprint_bytes / 2**20, 1),
+            "rss_delta_mb": round(self.rss_delta_bytes / 2**20, 1),
+            "uses": self.uses,
+            "last_used": self.last_used,
+        }
+
+
+# Owns every loaded Llama instance in the process. Streamlit sessions and
+# other entry points share it, so a GGUF is loaded at most once and models are
+# evicted least-recently-used first when max_ram_mb would be exceeded.
+class ModelPool:
+    def __init__(self, max_ram_mb=0):
+        self.max_ram_bytes = int(max_ram_mb) * 2**20
+        self.evictions = 0
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def get(self, name, path, loader):
+        entry = self._touch(name)
+        if entry is not None:
+            return entry.model
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # Loading can take minutes; hold only this model's lock so sessions
+        # using other, already-loaded models are not blocked.
+        with load_lock:
+            entry = self._touch(name)
+            if entry is not None:
+                return entry.model
+
+            file_bytes = os.path.getsize(path) if os.path.exists(path) else 0
+            self._make_room(file_bytes)
+
+            rss_before = current_rss_bytes()
+            started = time.perf_counter()
+            model = loader(path)
+            load_seconds = time.perf_counter() - started
+            rss_delta = max(0, current_rss_bytes() - rss_before)
+
+            entry = PooledModel(name, path, model, load_seconds, file_bytes, rss_delta)
+            entry.uses = 1
+            with self._lock:
+                self._models[name] = entry
+            logger.info(
+                f"Loaded model {name} in {load_seconds:.2f}s "
+                f"(footprint {entry.footprint_bytes / 2**20:.0f} MB)"
+            )
+            return model
+
+    def warm_up(self, models, loader):
+        # models maps model name -> path
+        for name, path in models.items():
+            try:
+                self.get(name, path, loader)
+            except Exception as e:
+                logger.error(f"Error warming up model {name}: {str(e)}")
+
+    def evict(self, name):
+        with self._lock:
+            entry = self._models.pop(name, None)
+        if entry is None:
+            return False
+        # A generation that still holds a reference keeps the model alive
+        # until it finishes; the pool just stops handing it out.
+        del entry
+        gc.collect()
+        self.evictions += 1
+        logger.info(f"Evicted model {name} from the model pool")
+        return True
+
+    def loaded_models(self):
+        with self._lock:
+            return list(self._models)
+
+    def metrics(self):
+        with self._lock:
+            models = {name: entry.as_dict() for name, entry in self._models.items()}
+            used_bytes = sum(entry.footprint_bytes for entry in self._models.values())
+        return {
+            "models": models,
+            "used_mb": round(used_bytes / 2**20, 1),
+            "budget_mb": round(self.max_ram_bytes / 2**20, 1) if self.max_ram_bytes else None,
+            "evictions": self.evictions,
+        }
+
+    def _touch(self, name):
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is not None:
+                self._models.move_to_end(name)
+                entry.uses += 1
+                entry.last_used = time.time()
+            return entry
+
+    def _make_room(self, needed_bytes):
+        if not self.max_ram_bytes:
+            return
+        while True:
+            with self._lock:
+                used = sum(entry.footprint_bytes for entry in self._models.values())
+                if not self._models or used + needed_bytes <= self.max_ram_bytes:
+                    return
+                victim = next(iter(self._models))
+            self.evict(victim)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_model_pool(config):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ModelPool(get_config_value(config, 'model_pool_max_ram_mb', 0))
+        return _pool
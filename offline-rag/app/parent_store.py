@@ -0,0 +1,99 @@
+import os
+import sqlite3
+import threading
+
+SQLITE_MAX_VARIABLES = 500
+
+
+# Parent sections for parent/child (small-to-big) indexing. Only the small
+# child chunks are embedded; each carries its parent's id, and retrieval
+# swaps child hits for the parent text. A parent's place in its source is
+# (page, position), position counting parents within the page, so hits on
+# neighbouring sections can be merged into one passage.
+class ParentStore:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS parents (
+                parent_id TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                text TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS parents_by_place ON parents (source, page, position);
+        """)
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM parents").fetchone()[0]
+
+    def add_many(self, parents):
+        # parents is an iterable of (parent_id, source, page, position, text)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO parents (parent_id, source, page, position, text) VALUES (?, ?, ?, ?, ?)",
+                list(parents),
+            )
+
+    def get_many(self, parent_ids):
+        parent_ids = list(parent_ids)
+        found = {}
+        with self._lock:
+            for start in range(0, len(parent_ids), SQLITE_MAX_VARIABLES):
+                batch = parent_ids[start:start + SQLITE_MAX_VARIABLES]
+                rows = self._conn.execute(
+                    f"SELECT parent_id, source, page, position, text FROM parents "
+                    f"WHERE parent_id IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for parent_id, source, page, position, text in rows:
+                    found[parent_id] = {
+                        "parent_id": parent_id, "source": source, "page": page, "position": position, "text": text,
+                    }
+        return found
+
+    def adjacent(self, first, second):
+        # True when second directly follows first in the same source, with no
+        # other parent between them (pages without text have no parents)
+        if first["source"] != second["source"]:
+            return False
+        if (first["page"], first["position"]) >= (second["page"], second["position"]):
+            return False
+        with self._lock:
+            between = self._conn.execute(
+                "SELECT COUNT(*) FROM parents WHERE source = ? "
+                "AND (page > ? OR (page = ? AND position > ?)) AND (page < ? OR (page = ? AND position < ?))",
+                (first["source"], first["page"], first["page"], first["position"],
+                 second["page"], second["page"], second["position"]),
+            ).fetchone()[0]
+        return between == 0
+
+    def parent_ids(self, source):
+        with self._lock:
+            rows = self._conn.execute("SELECT parent_id FROM parents WHERE source = ?", (source,)).fetchall()
+        return {row[0] for row in rows}
+
+    def remove_ids(self, parent_ids):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM parents WHERE parent_id = ?", [(parent_id,) for parent_id in parent_ids])
+
+    def remove_source(self, source):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM parents WHERE source = ?", (source,))
+
+    def rows(self):
+        # Every parent in reading order, for exporting an index bundle
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT parent_id, source, page, position, text FROM parents ORDER BY source, page, position"
+            ).fetchall()
+        return rows
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,96 @@
+import io
+import mmap
+import os
+import time
+from contextlib import contextmanager
+
+from pypdf import PdfReader
+
+# Kept free of LangChain/Streamlit imports: these functions run in spawned
+# ingestion worker processes, which import only this module.
+
+
+class EmptyDocumentError(ValueError):
+    pass
+
+
+class BufferReader(io.RawIOBase):
+    # Read-only, seekable stream over a buffer without copying it. pypdf
+    # copies a file path into a BytesIO and BytesIO copies its initial bytes,
+    # so handing it one of these keeps a single copy of the PDF in memory.
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast("B")
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, target):
+        size = min(len(target), len(self._view) - self._position)
+        if size <= 0:
+            return 0
+        target[:size] = self._view[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError("Negative seek position")
+        self._position = position
+        return position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        # Releases the view so a mapped file can be unmapped
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+@contextmanager
+def open_pdf(source):
+    # source is a file path, mapped rather than read so worker processes
+    # share the page cache, or a buffer such as an upload's memoryview. The
+    # mapping is closed on exit, so the reader is only usable inside the block.
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                raise EmptyDocumentError(f"{os.path.basename(source)} is empty (0 bytes)")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                stream = BufferReader(mapped)
+                try:
+                    yield PdfReader(stream)
+                finally:
+                    stream.close()
+    else:
+        if not len(memoryview(source)):
+            raise EmptyDocumentError("The document is empty (0 bytes)")
+        yield PdfReader(BufferReader(source))
+
+
+def count_pages(source):
+    with open_pdf(source) as reader:
+        return len(reader.pages)
+
+
+def extract_page_range(source, start, end):
+    started = time.perf_counter()
+    pages = []
+    with open_pdf(source) as reader:
+        for page_number in range(start, min(end, len(reader.pages))):
+            text = reader.pages[page_number].extract_text() or ""
+            pages.append((page_number, text))
+    return pages, time.perf_counter() - started
@@ -0,0 +1,204 @@
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def live_prefix_length(model, tokens):
+    # input_ids keeps stale tokens past n_tokens after reset() or after
+    # restoring a shorter state; only the first n_tokens are in the KV cache
+    return common_prefix_length(model.input_ids[:model.n_tokens].tolist(), tokens)
+
+
+def state_bytes(state):
+    # A LlamaState also copies the logits buffer (n_batch x n_vocab floats,
+    # n_ctx x n_vocab with logits_all) and input_ids next to the KV cache
+    return state.llama_state_size + state.scores.nbytes + state.input_ids.nbytes
+
+
+class TTFTStats:
+    def __init__(self):
+        self._samples = {"hit": [], "miss": [], "disabled": []}
+        self._lock = threading.Lock()
+
+    def record(self, outcome, seconds, window=200):
+        with self._lock:
+            samples = self._samples.setdefault(outcome, [])
+            samples.append(seconds)
+            del samples[:-window]
+
+    def summary(self):
+        with self._lock:
+            return {
+                outcome: {
+                    "count": len(samples),
+                    "mean_seconds": round(sum(samples) / len(samples), 3) if samples else None,
+                }
+                for outcome, samples in self._samples.items()
+            }
+
+
+# Snapshots llama.cpp state after evaluating a prompt prefix (the system
+# prompt, optionally followed by the retrieved context) and restores it before
+# generation. Llama.generate then only prefills the tokens after the prefix.
+class PrefixCache:
+    def __init__(self, model, max_bytes):
+        self.model = model
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._states = OrderedDict()
+        self._bytes = 0
+
+    def prepare(self, prompt_tokens, prefix_tokens_list):
+        # Returns how many leading prompt tokens are already in the KV cache.
+        model = self.model
+        candidates = []
+        for prefix_tokens in prefix_tokens_list:
+            # Tokenising the prefix alone can differ from the full prompt at
+            # the boundary, so only trust the part that actually matches.
+            length = common_prefix_length(prefix_tokens, prompt_tokens)
+            if 0 < length < len(prompt_tokens):
+                candidates.append(tuple(prompt_tokens[:length]))
+        if not candidates:
+            return 0
+        candidates = sorted(set(candidates), key=len)
+        target = candidates[-1]
+
+        live = live_prefix_length(model, prompt_tokens)
+        if live >= len(target):
+            self.hits += 1
+            return live
+
+        if target in self._states:
+            model.load_state(self._states[target])
+            self._states.move_to_end(target)
+            self.hits += 1
+            return len(target)
+
+        self.misses += 1
+        base = live
+        for prefix in reversed(candidates[:-1]):
+            if len(prefix) <= live:
+                break
+            if prefix in self._states:
+                model.load_state(self._states[prefix])
+                self._states.move_to_end(prefix)
+                base = len(prefix)
+                break
+
+        model.n_tokens = base
+        for prefix in candidates:
+            if len(prefix) <= base:
+                continue
+            model.eval(list(prefix[model.n_tokens:]))
+            self._store(prefix, model.save_state())
+        return len(target)
+
+    def _store(self, prefix, state):
+        if prefix in self._states:
+            return
+        size = state_bytes(state)
+        if size > self.max_bytes:
+            return
+        self._states[prefix] = state
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._states:
+            _, evicted = self._states.popitem(last=False)
+            self._bytes -= state_bytes(evicted)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._states),
+            "mb": round(self._bytes / 2**20, 1),
+        }
+
+
+# One llama.cpp state per chat session, taken at the end of the conversation
+# so far (system prompt, rolling summary and earlier turns). A new turn only
+# appends to that text, so restoring the state leaves just the last exchange,
+# the new context and the question to prefill, even when other sessions used
+# the model in between. Sessions are evicted least-recently-used under
+# max_bytes.
+class SessionCache:
+    def __init__(self, model, max_bytes):
+        self.model = model
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._states = OrderedDict()
+        self._bytes = 0
+
+    def prepare(self, session_id, prompt_tokens, prefix_tokens):
+        # Returns how many leading prompt tokens are already in the KV cache.
+        model = self.model
+        length = min(common_prefix_length(prefix_tokens, prompt_tokens), len(prompt_tokens) - 1)
+        if length <= 0:
+            return 0
+        target = tuple(prompt_tokens[:length])
+        live = live_prefix_length(model, prompt_tokens)
+        entry = self._states.get(session_id)
+
+        if entry is not None and entry[0] == target:
+            self.hits += 1
+            self._states.move_to_end(session_id)
+            if live >= length:
+                return live
+            model.load_state(entry[1])
+            return length
+
+        base = live
+        if entry is not None:
+            saved = common_prefix_length(entry[0], prompt_tokens)
+            if saved == len(entry[0]):
+                self.hits += 1
+            else:
+                self.misses += 1
+            if saved > live:
+                model.load_state(entry[1])
+                base = saved
+        else:
+            self.misses += 1
+
+        # The snapshot must end exactly at the prefix, so a longer live
+        # prefix is cut back by re-evaluating its last token
+        model.n_tokens = min(base, length - 1)
+        model.eval(list(target[model.n_tokens:]))
+        self._store(session_id, target, model.save_state())
+        return length
+
+    def _store(self, session_id, tokens, state):
+        self.drop(session_id)
+        size = state_bytes(state)
+        if size > self.max_bytes:
+            return
+        self._states[session_id] = (tokens, state)
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._states:
+            _, (_, evicted) = self._states.popitem(last=False)
+            self._bytes -= state_bytes(evicted)
+
+    def drop(self, session_id):
+        entry = self._states.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= state_bytes(entry[1])
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "sessions": len(self._states),
+            "mb": round(self._bytes / 2**20, 1),
+        }
@@ -0,0 +1,44 @@
+def get_system_prompt():
+    return """You are a helpful AI assistant. Your task is to answer questions based solely on the provided context.
+    If the context doesn't contain enough information to answer the question, say so.
+    Do not use any external knowledge or make assumptions beyond what's given in the context.
+    If asked about your capabilities or identity, refer only to being an AI assistant without mentioning specific models or companies."""
+
+def get_history_prefix(system_prompt, history=(), summary=""):
+    # The part of a chat prompt that the next turn only appends to; the
+    # retrieved context changes every turn, so it goes after the history
+    parts = [system_prompt] if system_prompt else []
+    if summary:
+        parts.append(f"Summary of the earlier conversation: {summary}")
+    parts.extend(f"Human: {question}\n\nAssistant: {answer}" for question, answer in history)
+    return "".join(f"{part}\n\n" for part in parts)
+
+def build_rag_prompt(system_prompt, context, prompt, history=(), summary=""):
+    return f"{get_history_prefix(system_prompt, history, summary)}Context: {context}\n\nHuman: {prompt}\n\nAssistant:"
+
+def build_chat_prompt(prompt, history=(), summary=""):
+    # Without RAG a first question goes to the model as typed
+    if not history and not summary:
+        return prompt
+    return f"{get_history_prefix('', history, summary)}Human: {prompt}\n\nAssistant:"
+
+def build_summary_prompt(summary, history):
+    return (
+        "Summarize the conversation below in a few sentences. Keep names, numbers and facts "
+        "the user may refer back to.\n\n"
+        f"{get_history_prefix('', history, summary)}Summary:"
+    )
+
+def get_cache_prefixes(system_prompt, context):
+    # Leading parts of build_rag_prompt worth keeping in the prefix cache
+    return [system_prompt, f"{system_prompt}\n\nContext: {context}"]
+
+def get_context_budget(prompt, model_handler=None, model_choice=None, history=(), summary=""):
+    # Returns (token_budget, count_tokens) for build_context; without a model
+    # the context falls back to plain top-k.
+    if model_handler is None or not model_choice:
+        return None, None
+    prompt_without_context = build_rag_prompt(get_system_prompt(), "", prompt, history, summary)
+    token_budget = model_handler.get_context_token_budget(prompt_without_context, model_choice)
+    count_tokens = lambda text: model_handler.count_tokens(text, model_choice)
+    return token_budget, count_tokens
@@ -0,0 +1,417 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATIONS = ("int8", "binary")
+SCAN_BLOCK_ROWS = 65536
+COMPACT_RATIO = 0.3
+COMPACT_MIN_DEAD = 1000
+# popcount of every byte value, for Hamming distances on packed sign bits
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def quantize_int8(vectors):
+    # Symmetric per-vector scaling: v ~= codes * scale
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def quantize_binary(vectors):
+    return np.packbits(vectors > 0, axis=1)
+
+
+def append_file(path, data):
+    # Durable before the SQLite commit that makes the rows visible
+    with open(path, "ab") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def append_rows(buffer, used, rows):
+    # Appends into spare capacity, doubling when full, so ingesting in small
+    # batches stays linear; callers keep a view of the first used rows.
+    needed = used + len(rows)
+    if needed > len(buffer):
+        grown = np.empty((max(needed, 2 * len(buffer)),) + buffer.shape[1:], dtype=buffer.dtype)
+        grown[:used] = buffer[:used]
+        buffer = grown
+    buffer[used:needed] = rows
+    return buffer
+
+
+# Vector store for memory-constrained hosts. Only the quantized codes are held
+# in RAM for the first pass: int8 needs dim + 4 bytes per vector (about 4x less
+# than float32), binary sign bits need dim / 8 (32x less). The best
+# rescore_factor * k candidates are then rescored exactly against normalised
+# float32 vectors read from a memory-mapped file, so the page cache only has to
+# hold the rows that are actually touched. Texts and metadata live in SQLite.
+#
+# Implements the subset of the Chroma interface the app uses: add_documents
+# (upsert by id), delete, get, similarity_search_by_vector_with_relevance_scores
+# (cosine distance, lower is better) and persist.
+class QuantizedVectorStore(VectorStore):
+    def __init__(self, directory, embedding_function, quantization="int8", rescore_factor=4):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization}; expected one of {', '.join(QUANTIZATIONS)}")
+        self.directory = directory
+        self.embedding_function = embedding_function
+        self.quantization = quantization
+        self.rescore_factor = max(1, int(rescore_factor))
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(os.path.join(directory, "rows.sqlite3"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS rows (
+                row INTEGER PRIMARY KEY,
+                chunk_id TEXT UNIQUE NOT NULL,
+                source TEXT,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS rows_by_source ON rows (source);
+        """)
+        self._conn.commit()
+        self._load()
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+        self.dim = int(row[0]) if row else None
+        self._vectors = None
+        if self.dim is None:
+            self._num_rows = 0
+            self._codes = None
+            self._scales = np.zeros(0, dtype=np.float32)
+            self._alive = np.zeros(0, dtype=bool)
+            self._buffers = {}
+            return
+
+        # A compaction commits the renumbered rows before moving its new
+        # files into place; finish the move if that was interrupted
+        if self._conn.execute("SELECT 1 FROM meta WHERE key = 'compacted_files'").fetchone():
+            self._install_compacted_files()
+        else:
+            for name in self._file_widths():
+                if os.path.exists(self._path(f"{name}.tmp")):
+                    os.remove(self._path(f"{name}.tmp"))
+
+        # SQLite is the record of how many rows exist; vectors appended by a
+        # write that never committed are cut off so offsets stay aligned.
+        # Stores written before the count was recorded fall back to the file.
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'num_rows'").fetchone()
+        vectors_path = self._path("vectors.f32")
+        file_rows = os.path.getsize(vectors_path) // (self.dim * 4) if os.path.exists(vectors_path) else 0
+        self._num_rows = min(int(row[0]), file_rows) if row else file_rows
+        self._truncate_files(self._num_rows)
+        self._codes = np.fromfile(self._path(f"codes.{self.quantization}"), dtype=self._code_dtype())
+        self._codes = self._codes.reshape(-1, self._code_width())[:self._num_rows]
+        if self.quantization == "int8":
+            self._scales = np.fromfile(self._path("scales.f32"), dtype=np.float32)[:self._num_rows]
+        else:
+            self._scales = np.zeros(0, dtype=np.float32)
+        self._alive = np.zeros(self._num_rows, dtype=bool)
+        live_rows = [row for (row,) in self._conn.execute("SELECT row FROM rows")]
+        self._alive[live_rows] = True
+        self._buffers = {"codes": self._codes, "scales": self._scales, "alive": self._alive}
+
+    def _file_widths(self):
+        # Bytes per row in each on-disk file
+        widths = {"vectors.f32": self.dim * 4, f"codes.{self.quantization}": self._code_width()}
+        if self.quantization == "int8":
+            widths["scales.f32"] = 4
+        return widths
+
+    def _truncate_files(self, num_rows):
+        for name, width in self._file_widths().items():
+            path = self._path(name)
+            if os.path.exists(path) and os.path.getsize(path) > num_rows * width:
+                with open(path, "r+b") as f:
+                    f.truncate(num_rows * width)
+
+    def _code_dtype(self):
+        return np.int8 if self.quantization == "int8" else np.uint8
+
+    def _code_width(self):
+        return self.dim if self.quantization == "int8" else (self.dim + 7) // 8
+
+    def _full_vectors(self):
+        # Re-mapped lazily after appends; reads fault in only the rows used
+        if self._vectors is None or len(self._vectors) != self._num_rows:
+            self._vectors = np.memmap(self._path("vectors.f32"), dtype=np.float32, mode="r",
+                                      shape=(self._num_rows, self.dim)) if self._num_rows else None
+        return self._vectors
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in texts]
+        ids = list(ids) if ids is not None else [str(uuid.uuid4()) for _ in texts]
+
+        vectors = np.asarray(self.embedding_function.embed_documents(texts), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with self._conn:
+                    self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('dim', ?)", (str(self.dim),))
+                self._buffers = {
+                    "codes": np.zeros((0, self._code_width()), dtype=self._code_dtype()),
+                    "scales": self._scales,
+                    "alive": self._alive,
+                }
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the store ({self.dim})")
+
+            # Upsert: replaced ids keep their old row as a tombstone
+            replaced = self._rows_for_ids(ids)
+            first_row = self._num_rows
+            rows = list(range(first_row, first_row + len(texts)))
+
+            if self.quantization == "int8":
+                codes, scales = quantize_int8(vectors)
+            else:
+                codes, scales = quantize_binary(vectors), None
+
+            # Replaced rows are deleted, new rows inserted and the files
+            # appended in one transaction; if any of it fails, the rows roll
+            # back (the replaced ones stay live) and the files are cut back to
+            # first_row, so row numbers match file offsets
+            try:
+                with self._conn:
+                    self._conn.executemany("DELETE FROM rows WHERE row = ?", [(row,) for row in replaced])
+                    self._conn.executemany(
+                        "INSERT INTO rows (row, chunk_id, source, text, metadata) VALUES (?, ?, ?, ?, ?)",
+                        [
+                            (row, chunk_id, metadata.get("source"), text, json.dumps(metadata))
+                            for row, chunk_id, text, metadata in zip(rows, ids, texts, metadatas)
+                        ],
+                    )
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO meta (key, value) VALUES ('num_rows', ?)", (str(first_row + len(rows)),)
+                    )
+                    if scales is not None:
+                        append_file(self._path("scales.f32"), scales.tobytes())
+                    append_file(self._path(f"codes.{self.quantization}"), codes.tobytes())
+                    append_file(self._path("vectors.f32"), vectors.tobytes())
+            except Exception:
+                self._truncate_files(first_row)
+                raise
+            if scales is not None:
+                self._buffers["scales"] = append_rows(self._buffers["scales"], first_row, scales)
+            self._num_rows += len(rows)
+            self._buffers["codes"] = append_rows(self._buffers["codes"], first_row, codes)
+            self._buffers["alive"] = append_rows(self._buffers["alive"], first_row, np.ones(len(rows), dtype=bool))
+            self._buffers["alive"][replaced] = False
+            self._codes = self._buffers["codes"][:self._num_rows]
+            self._alive = self._buffers["alive"][:self._num_rows]
+            if self.quantization == "int8":
+                self._scales = self._buffers["scales"][:self._num_rows]
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        if not ids:
+            return None
+        with self._lock:
+            self._delete_ids(ids)
+            self._maybe_compact()
+        return True
+
+    def _rows_for_ids(self, ids):
+        rows = []
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows.extend(row for (row,) in self._conn.execute(
+                f"SELECT row FROM rows WHERE chunk_id IN ({placeholders})", batch
+            ))
+        return rows
+
+    def _delete_ids(self, ids):
+        rows = self._rows_for_ids(ids)
+        if not rows:
+            return
+        with self._conn:
+            self._conn.executemany("DELETE FROM rows WHERE row = ?", [(row,) for row in rows])
+        self._alive[rows] = False
+
+    def _maybe_compact(self):
+        dead = self._num_rows - int(self._alive.sum())
+        if dead >= COMPACT_MIN_DEAD and dead >= COMPACT_RATIO * self._num_rows:
+            self._compact()
+
+    def _compact(self):
+        # Rewrites the vector files without tombstones and renumbers rows.
+        # The new files are written beside the old ones, the renumbering is
+        # committed, and only then are the files moved into place; _load
+        # completes the move after a crash in between.
+        kept = np.flatnonzero(self._alive)
+        vectors = np.asarray(self._full_vectors()[kept]) if len(kept) else np.zeros((0, self.dim), np.float32)
+        self._vectors = None
+        files = {"vectors.f32": vectors, f"codes.{self.quantization}": self._codes[kept]}
+        if self.quantization == "int8":
+            files["scales.f32"] = self._scales[kept]
+        for name, array in files.items():
+            with open(self._path(f"{name}.tmp"), "wb") as f:
+                f.write(array.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+        with self._conn:
+            self._conn.execute("CREATE TEMP TABLE remap (old INTEGER PRIMARY KEY, new INTEGER NOT NULL)")
+            self._conn.executemany("INSERT INTO remap (old, new) VALUES (?, ?)",
+                                   [(int(old), new) for new, old in enumerate(kept)])
+            # Shift rows out of the way first so renumbering never collides
+            self._conn.execute("UPDATE rows SET row = -1 - (SELECT new FROM remap WHERE old = rows.row)")
+            self._conn.execute("UPDATE rows SET row = -1 - row")
+            self._conn.execute("DROP TABLE remap")
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('num_rows', ?)", (str(len(kept)),))
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('compacted_files', '1')")
+        self._load()
+        logger.info(f"Compacted quantized vector store to {self._num_rows} vectors")
+
+    def _install_compacted_files(self):
+        for name in self._file_widths():
+            tmp_path = self._path(f"{name}.tmp")
+            if os.path.exists(tmp_path):
+                os.replace(tmp_path, self._path(name))
+        with self._conn:
+            self._conn.execute("DELETE FROM meta WHERE key = 'compacted_files'")
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=None, **kwargs):
+        include = include if include is not None else ["documents", "metadatas"]
+        query = "SELECT row, chunk_id, text, metadata FROM rows"
+        clauses, params = [], []
+        if ids is not None:
+            ids = list(ids)
+            if not ids:
+                return {"ids": [], "documents": [], "metadatas": []}
+            clauses.append(f"chunk_id IN ({','.join('?' * len(ids))})")
+            params.extend(ids)
+        for key, value in (where or {}).items():
+            if key == "source":
+                clauses.append("source = ?")
+            else:
+                clauses.append(f"json_extract(metadata, '$.{key}') = ?")
+            params.append(value)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY row"
+        if limit is not None or offset:
+            query += " LIMIT ? OFFSET ?"
+            params.extend([limit if limit is not None else -1, offset or 0])
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+            embeddings = None
+            if "embeddings" in include:
+                # Normalised float32 vectors, read from the memory-mapped file
+                vectors = self._full_vectors()
+                embeddings = [vectors[row].tolist() for row, _, _, _ in rows]
+        return {
+            "ids": [chunk_id for _, chunk_id, _, _ in rows],
+            "documents": [text for _, _, text, _ in rows] if "documents" in include else None,
+            "metadatas": [json.loads(metadata) for _, _, _, metadata in rows] if "metadatas" in include else None,
+            "embeddings": embeddings,
+        }
+
+    def _first_pass(self, query_vector, candidates_k):
+        # Approximate scores over all live rows, block by block so the float
+        # working set stays bounded; higher is better.
+        scores = np.empty(self._num_rows, dtype=np.float32)
+        if self.quantization == "binary":
+            query_bits = quantize_binary(query_vector[None, :])[0]
+        for start in range(0, self._num_rows, SCAN_BLOCK_ROWS):
+            block = self._codes[start:start + SCAN_BLOCK_ROWS]
+            if self.quantization == "int8":
+                scores[start:start + len(block)] = (block.astype(np.float32) @ query_vector) * self._scales[start:start + len(block)]
+            else:
+                scores[start:start + len(block)] = -POPCOUNT[np.bitwise_xor(block, query_bits)].sum(axis=1, dtype=np.int32)
+        scores[~self._alive] = -np.inf
+        candidates_k = min(candidates_k, int(self._alive.sum()))
+        if candidates_k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.argpartition(-scores, candidates_k - 1)[:candidates_k]
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k=4, **kwargs):
+        query_vector = np.asarray(embedding, dtype=np.float32)
+        query_vector /= np.linalg.norm(query_vector) or 1.0
+        with self._lock:
+            if not self._num_rows:
+                return []
+            candidates = np.sort(self._first_pass(query_vector, k * self.rescore_factor))
+            if not len(candidates):
+                return []
+            exact = np.asarray(self._full_vectors()[candidates]) @ query_vector
+            order = np.argsort(-exact)[:k]
+            top_rows = [int(candidates[i]) for i in order]
+            distances = {int(candidates[i]): float(1.0 - exact[i]) for i in order}
+            placeholders = ",".join("?" * len(top_rows))
+            rows = {
+                row: (text, metadata)
+                for row, text, metadata in self._conn.execute(
+                    f"SELECT row, text, metadata FROM rows WHERE row IN ({placeholders})", top_rows
+                )
+            }
+        return [
+            (Document(page_content=rows[row][0], metadata=json.loads(rows[row][1])), distances[row])
+            for row in top_rows if row in rows
+        ]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_relevance_scores(self.embedding_function.embed_query(query), k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def persist(self):
+        # Writes go straight to disk; only reclaim space from deletions here
+        with self._lock:
+            if self._num_rows and not self._alive.all():
+                self._maybe_compact()
+
+    def memory_stats(self):
+        with self._lock:
+            live = int(self._alive.sum())
+            resident = sum(buffer.nbytes for buffer in self._buffers.values())
+            return {
+                "quantization": self.quantization,
+                "vectors": live,
+                "tombstones": self._num_rows - live,
+                "dim": self.dim,
+                "resident_bytes": resident,
+                "float32_bytes": self._num_rows * (self.dim or 0) * 4,
+            }
+
+    def close(self):
+        with self._lock:
+            self._vectors = None
+            self._conn.close()
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, directory="./chroma_db/quantized", **kwargs):
+        store = cls(directory, embedding, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
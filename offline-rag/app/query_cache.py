@@ -0,0 +1,72 @@
+import re
+import threading
+from collections import OrderedDict
+
+_generation = 0
+_generation_lock = threading.Lock()
+
+
+def get_collection_generation():
+    return _generation
+
+
+def bump_collection_generation():
+    # Called whenever the collection changes so cached results keyed by an
+    # older generation can never be served again.
+    global _generation
+    with _generation_lock:
+        _generation += 1
+        return _generation
+
+
+def normalize_query(query):
+    query = re.sub(r"\s+", " ", query.strip().lower())
+    return query.rstrip("?!. ")
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = max(1, int(maxsize))
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+
+class QueryCache:
+    def __init__(self, maxsize=256):
+        self.embeddings = LRUCache(maxsize)
+        self.results = LRUCache(maxsize)
+
+    def stats(self):
+        return {
+            "generation": get_collection_generation(),
+            "embeddings": self.embeddings.stats(),
+            "results": self.results.stats(),
+        }
@@ -1,10 +1,20 @@
 
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings.fastembed import FastEmbedEmbeddings
-from .utils import load_config
-from .document_processor import get_embedding_function, get_vectorstore
+from .utils import load_config, get_config_value, cache_resource
+from .document_processor import get_embedding_function, get_vectorstore, get_keyword_index, get_answer_cache, get_parent_store, sync_collection
+from .answer_cache import record, replay
+from .bm25_index import reciprocal_rank_fusion
+from .reranker import BudgetedReranker, CrossEncoderReranker, MMRReranker
+from .query_cache import QueryCache, get_collection_generation, normalize_query
+from .context_budget import assemble_context, overlap_length
+from .manifest import sha256_text
+from .conversation import ConversationStore, compact_conversation
+from .prompts import build_summary_prompt, get_history_prefix
+from .scheduler import SchedulerBusyError
+from .telemetry import current_trace, get_telemetry, record_cache, timed, trace_stream
+from langchain_core.documents import Document
 import streamlit as st
 import logging
+import time
 
 config = load_config()
 
@@ -12,39 +22,307 @@ config = load_config()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-@st.cache_resource
-def get_embedding_function():
+query_cache = QueryCache(get_config_value(config, 'query_cache_size', 256))
+
+def get_query_embedding(query):
+    key = normalize_query(query)
+    embedding = query_cache.embeddings.get(key)
+    record_cache("query_embedding", embedding is not None)
+    if embedding is None:
+        with timed("embed_query"):
+            embedding = get_embedding_function().embed_query(query)
+        query_cache.embeddings.put(key, embedding)
+    return embedding
+
+def retrieve_documents(query, top_k=3):
+    # Returns (document, score) pairs ranked best-first
+    sync_collection()
+    key = (normalize_query(query), top_k, get_collection_generation())
+    scored_docs = query_cache.results.get(key)
+    record_cache("query_results", scored_docs is not None)
+    if scored_docs is not None:
+        logger.info(f"Query cache hit for query: {query}")
+        return scored_docs
+
+    if get_config_value(config, 'hybrid_search', True):
+        scored_docs = hybrid_search(query, top_k)
+    else:
+        scored_docs = dense_search(query, top_k)
+    query_cache.results.put(key, scored_docs)
+    return scored_docs
+
+def dense_search(query, top_k):
+    vectorstore = get_vectorstore()
+    embedding = get_query_embedding(query)
+    with timed("vector_search"):
+        return vectorstore.similarity_search_by_vector_with_relevance_scores(embedding, k=top_k)
+
+def fusion_key(doc):
+    # Chunks ingested before ids were content-addressed carry no chunk_id, and
+    # the keyword index knows them by their vector store id; both rankings
+    # name such a chunk by its source and a hash of its text instead
+    chunk_id = doc.metadata.get('chunk_id')
+    if chunk_id:
+        return chunk_id
+    return f"{doc.metadata.get('source')}\0{sha256_text(doc.page_content)}"
+
+def hybrid_search(query, top_k):
+    # Dense and BM25 rankings fused with reciprocal-rank fusion; the returned
+    # score is the fused RRF score (higher is better).
+    started = time.perf_counter()
+    dense = dense_search(query, top_k)
+    dense_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with timed("keyword_search"):
+        keyword_hits = get_keyword_index().search(query, top_k)
+    keyword_seconds = time.perf_counter() - started
+
+    docs_by_key = {}
+    dense_keys = []
+    for doc, _ in dense:
+        key = fusion_key(doc)
+        docs_by_key.setdefault(key, doc)
+        dense_keys.append(key)
+    # Keyword hits the dense search did not return are read so they can be
+    # keyed like the dense hits; ids no longer in the vector store drop out
+    keyword_ids = [chunk_id for chunk_id, _ in keyword_hits]
+    key_by_id = {chunk_id: chunk_id for chunk_id in keyword_ids}
+    missing = [chunk_id for chunk_id in keyword_ids if chunk_id not in docs_by_key]
+    if missing:
+        results = get_vectorstore().get(ids=missing, include=["documents", "metadatas"])
+        for chunk_id, text, metadata in zip(results['ids'], results['documents'], results['metadatas']):
+            doc = Document(page_content=text, metadata=metadata)
+            key_by_id[chunk_id] = fusion_key(doc)
+            docs_by_key.setdefault(key_by_id[chunk_id], doc)
+    keyword_keys = [key_by_id[chunk_id] for chunk_id in keyword_ids]
+
+    fused = reciprocal_rank_fusion([dense_keys, keyword_keys], k=get_config_value(config, 'rrf_k', 60))[:top_k]
+
+    logger.info(f"Hybrid search: dense {dense_seconds * 1000:.1f} ms, keyword {keyword_seconds * 1000:.1f} ms, {len(missing)} keyword-only hits")
+    return [(docs_by_key[key], score) for key, score in fused if key in docs_by_key]
+
+@cache_resource
+def get_reranker():
+    mode = get_config_value(config, 'rerank_mode', "none")
     try:
-        return FastEmbedEmbeddings(
-            model_name=config['embedding_model'],
-            max_length=512,
-            doc_embed_type="passage"
-        )
+        if mode == "cross-encoder":
+            reranker = CrossEncoderReranker(
+                get_config_value(config, 'rerank_model', "cross-encoder/ms-marco-MiniLM-L-6-v2"),
+                cache_dir="./models"
+            )
+        elif mode == "mmr":
+            reranker = MMRReranker(get_embedding_function(), get_config_value(config, 'mmr_lambda', 0.5))
+        else:
+            return None
     except Exception as e:
-        logger.error(f"Error loading embedding model: {str(e)}")
-        st.error(f"Error loading embedding model: {str(e)}")
+        logger.error(f"Error loading {mode} reranker, continuing without reranking: {str(e)}")
         return None
+    return BudgetedReranker(reranker, get_config_value(config, 'rerank_budget_ms', 500))
+
+def rerank_documents(query, top_k):
+    # Over-fetch candidates, rerank them in one batch and keep the best top_k
+    reranker = get_reranker()
+    candidates_k = get_config_value(config, 'rerank_candidates', 40)
+
+    started = time.perf_counter()
+    scored_docs = retrieve_documents(query, max(top_k, candidates_k))
+    retrieve_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with timed("rerank"):
+        scored_docs, reranked = reranker.rerank(query, scored_docs)
+    rerank_seconds = time.perf_counter() - started
+
+    logger.info(
+        f"Retrieval timings: first stage {retrieve_seconds * 1000:.1f} ms, "
+        f"rerank {rerank_seconds * 1000:.1f} ms ({'applied' if reranked else 'skipped'})"
+    )
+    return scored_docs[:top_k]
+
+def expand_to_parents(parent_store, scored_docs, limit):
+    # Swaps child hits for their parent sections. Parents are taken in the
+    # order of their best child until limit distinct ones are found, then
+    # neighbouring parents of a source are merged into one passage that
+    # ranks where its best part did. Chunks without a parent_id (indexed
+    # before parent/child indexing was on) are kept as they are.
+    ranked = []
+    seen = set()
+    for doc, score in scored_docs:
+        key = doc.metadata.get('parent_id') or doc.metadata.get('chunk_id') or doc.page_content
+        if key in seen:
+            continue
+        seen.add(key)
+        ranked.append((doc, score))
+        if len(ranked) >= limit:
+            break
+    parents = parent_store.get_many(
+        [doc.metadata['parent_id'] for doc, _ in ranked if doc.metadata.get('parent_id')]
+    )
+    max_overlap = get_config_value(config, 'parent_chunk_overlap', 0)
+
+    passages = []
+    by_source = {}
+    for rank, (doc, score) in enumerate(ranked):
+        parent = parents.get(doc.metadata.get('parent_id'))
+        if parent is None:
+            passages.append({"rank": rank, "score": score, "doc": doc})
+        else:
+            by_source.setdefault(parent['source'], []).append((rank, score, parent))
+    for hits in by_source.values():
+        hits.sort(key=lambda hit: (hit[2]['page'], hit[2]['position']))
+        run = [hits[0]]
+        for hit in hits[1:]:
+            if parent_store.adjacent(run[-1][2], hit[2]):
+                run.append(hit)
+            else:
+                passages.append(merge_parents(run, max_overlap))
+                run = [hit]
+        passages.append(merge_parents(run, max_overlap))
+    passages.sort(key=lambda passage: passage["rank"])
+    return [(passage["doc"], passage["score"]) for passage in passages]
 
-def retrieve_context(query, top_k=3):
+def merge_parents(run, max_overlap):
+    text = run[0][2]['text']
+    for _, _, parent in run[1:]:
+        text = text + "\n" + parent['text'][overlap_length(text, parent['text'], max_overlap):]
+    best_rank, best_score, first = min(run, key=lambda hit: hit[0])
+    metadata = {
+        "source": first['source'],
+        "page": run[0][2]['page'],
+        "parent_id": first['parent_id'],
+        "parent_ids": [parent['parent_id'] for _, _, parent in run],
+    }
+    return {"rank": best_rank, "score": best_score, "doc": Document(page_content=text, metadata=metadata)}
+
+def build_context(query, top_k=3, token_budget=None, count_tokens=None):
     embeddings = get_embedding_function()
     if embeddings is None:
         logger.error("Failed to initialize embeddings.")
-        return ""
+        return "", {}
 
     try:
-        vectorstore = get_vectorstore()
-
-        # Log the number of documents in the vectorstore
-        logger.info(f"Number of documents in vectorstore: {vectorstore._collection.count()}")
-
-        docs = vectorstore.similarity_search(query, k=top_k)
-        context = "\n".join([doc.page_content for doc in docs])
+        fetch_k = max(top_k, get_config_value(config, 'context_fetch_k', top_k))
+        # Without a token budget fall back to the plain top-k behaviour
+        limit = fetch_k if token_budget is not None else top_k
+        parent_store = get_parent_store()
+        max_overlap = int(config.get('chunk_overlap', 0))
+        if parent_store is not None:
+            # Several children often share a parent, so fetch more of them
+            fetch_k *= get_config_value(config, 'parent_fetch_factor', 4)
+        with timed("retrieval"):
+            if get_reranker() is not None:
+                scored_docs = rerank_documents(query, fetch_k)
+            else:
+                scored_docs = retrieve_documents(query, fetch_k)
+            if parent_store is not None:
+                scored_docs = expand_to_parents(parent_store, scored_docs, limit)
+                max_overlap = get_config_value(config, 'parent_chunk_overlap', 0)
+        scored_docs = scored_docs[:limit]
+        context, accounting = assemble_context(
+            scored_docs,
+            count_tokens=count_tokens,
+            token_budget=token_budget,
+            max_overlap=max_overlap
+        )
 
-        logger.info(f"Retrieved {len(docs)} documents for query: {query}")
+        logger.info(f"Retrieved {len(scored_docs)} documents for query: {query}")
+        logger.info(f"Packed {len(accounting['chunks'])} chunks into {accounting['context_tokens']} context tokens (budget: {token_budget})")
         logger.info(f"Context: {context[:500]}...")  # Log first 500 characters of context
 
-        return context
+        return context, accounting
     except Exception as e:
         logger.error(f"Error retrieving context: {str(e)}")
         st.error(f"Error retrieving context: {str(e)}")
-        return ""
\ No newline at end of file
+        return "", {}
+
+def retrieve_context(query, top_k=3, token_budget=None, count_tokens=None):
+    context, _ = build_context(query, top_k, token_budget=token_budget, count_tokens=count_tokens)
+    return context
+
+def get_query_cache_stats():
+    return query_cache.stats()
+
+@cache_resource
+def get_conversation_store():
+    return ConversationStore(get_config_value(config, 'chat_max_sessions', 256))
+
+def get_conversation(model_handler, model_choice, session_id):
+    # The session's chat history, or None when multi-turn chat is off. Turns
+    # that outgrow chat_history_max_tokens are folded into a rolling summary
+    # first, so the history plus the context still fit in the window.
+    if session_id is None or not get_config_value(config, 'chat_history_enabled', True):
+        return None
+    conversation = get_conversation_store().get(session_id)
+    summary_tokens = get_config_value(config, 'chat_summary_max_tokens', 128)
+    compact_conversation(
+        conversation,
+        get_config_value(config, 'chat_history_max_tokens', int(config['model_n_ctx']) // 4),
+        lambda text: model_handler.count_tokens(text, model_choice),
+        lambda summary, turns: model_handler.complete(
+            build_summary_prompt(summary, turns), model_choice, summary_tokens, session_id=session_id
+        ),
+        keep_turns=get_config_value(config, 'chat_keep_turns', 2)
+    )
+    return conversation
+
+def clear_conversation(model_handler, session_id):
+    model_handler.drop_session(session_id)
+    return get_conversation_store().clear(session_id)
+
+def stream_answer(model_handler, model_choice, question, full_prompt, system_prompt="", context="",
+                  sources=(), cache_prefixes=None, session_id=None, conversation=None):
+    # Returns (stream, cached). A cached answer is replayed immediately;
+    # otherwise generation is queued (raising SchedulerBusyError right away
+    # if the queue is full) and the finished answer is stored. The request
+    # trace started by the caller, if any, is written once the stream ends.
+    # With a conversation, the finished answer becomes its next turn.
+    trace = current_trace()
+    telemetry = get_telemetry(config)
+    answer_cache = get_answer_cache()
+    history, summary = conversation.snapshot() if conversation is not None else ([], "")
+    session_prefix = get_history_prefix(system_prompt, history, summary) if history or summary else None
+    if session_prefix:
+        # A follow-up depends on the conversation, which the cache key omits
+        answer_cache = None
+    embedding = None
+    if answer_cache is not None:
+        if answer_cache.similarity_threshold is not None:
+            embedding = get_query_embedding(question)
+        answer = answer_cache.lookup(model_choice, system_prompt, context, question, embedding=embedding)
+        record_cache("answer", answer is not None)
+        if answer is not None:
+            logger.info(f"Answer cache hit for question: {question}")
+            stream = replay(answer)
+            if conversation is not None:
+                stream = record(stream, lambda answer: conversation.add_turn(question, answer))
+            return trace_stream(stream, trace, telemetry), True
+
+    try:
+        stream = model_handler.generate_stream(
+            full_prompt, model_choice=model_choice, cache_prefixes=cache_prefixes, session_id=session_id, trace=trace,
+            session_prefix=session_prefix
+        )
+    except SchedulerBusyError:
+        telemetry.write(trace, "rejected")
+        raise
+    if answer_cache is not None:
+        stream = record(stream, lambda answer: answer_cache.store(
+            model_choice, system_prompt, context, question, answer, sources, embedding=embedding
+        ))
+    if conversation is not None:
+        stream = record(stream, lambda answer: conversation.add_turn(question, answer))
+    return trace_stream(stream, trace, telemetry), False
+
+def get_answer_cache_stats():
+    answer_cache = get_answer_cache()
+    return answer_cache.stats() if answer_cache is not None else None
+
+def get_conversation_stats(session_id=None):
+    stats = get_conversation_store().stats()
+    if session_id is not None:
+        stats["session"] = get_conversation_store().get(session_id).as_dict()
+    return stats
+
+def get_telemetry_summary():
+    return get_telemetry(config).summary()
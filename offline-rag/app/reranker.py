@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class CrossEncoderReranker:
+    def __init__(self, model_name, cache_dir="./models", max_length=512):
+        from sentence_transformers import CrossEncoder
+
+        # local_files_only keeps this usable on air-gapped hosts: the model
+        # must already be in cache_dir (or model_name must be a local path).
+        self.model = CrossEncoder(
+            model_name,
+            max_length=max_length,
+            device="cpu",
+            local_files_only=True,
+            tokenizer_args={"cache_dir": cache_dir},
+            automodel_args={"cache_dir": cache_dir},
+        )
+
+    def rerank(self, query, scored_docs):
+        pairs = [(query, doc.page_content) for doc, _ in scored_docs]
+        scores = self.model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+        order = np.argsort(-np.asarray(scores))
+        return [(scored_docs[i][0], float(scores[i])) for i in order]
+
+
+class MMRReranker:
+    def __init__(self, embeddings, lambda_mult=0.5):
+        self.embeddings = embeddings
+        self.lambda_mult = lambda_mult
+
+    def rerank(self, query, scored_docs):
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        doc_vectors = np.asarray(
+            self.embeddings.embed_documents([doc.page_content for doc, _ in scored_docs]), dtype=np.float32
+        )
+        query_vector /= np.linalg.norm(query_vector) or 1.0
+        doc_vectors /= np.linalg.norm(doc_vectors, axis=1, keepdims=True).clip(min=1e-12)
+
+        relevance = doc_vectors @ query_vector
+        similarity = doc_vectors @ doc_vectors.T
+        selected = []
+        remaining = list(range(len(scored_docs)))
+        while remaining:
+            if selected:
+                redundancy = similarity[np.ix_(remaining, selected)].max(axis=1)
+            else:
+                redundancy = np.zeros(len(remaining), dtype=np.float32)
+            mmr = self.lambda_mult * relevance[remaining] - (1 - self.lambda_mult) * redundancy
+            best = remaining[int(np.argmax(mmr))]
+            selected.append(best)
+            remaining.remove(best)
+        return [(scored_docs[i][0], float(relevance[i])) for i in selected]
+
+
+# Runs a reranker under a latency budget. Scoring happens on a worker thread;
+# if it does not finish in time the candidates keep their first-stage order.
+# A timed-out job cannot be interrupted and keeps the single worker busy, so
+# reranking is skipped until it finishes rather than queueing behind it.
+class BudgetedReranker:
+    def __init__(self, reranker, budget_ms):
+        self.reranker = reranker
+        self.budget_seconds = budget_ms / 1000 if budget_ms else None
+        self.timeouts = 0
+        self.skipped = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reranker")
+        self._overrun = None
+        self._lock = threading.Lock()
+
+    def rerank(self, query, scored_docs):
+        if len(scored_docs) < 2:
+            return scored_docs, False
+        with self._lock:
+            if self._overrun is not None and not self._overrun.done():
+                self.skipped += 1
+                logger.warning(
+                    f"A timed-out rerank is still running; using first-stage order for {len(scored_docs)} candidates"
+                )
+                return scored_docs, False
+            self._overrun = None
+        started = time.perf_counter()
+        future = self._executor.submit(self.reranker.rerank, query, scored_docs)
+        try:
+            reranked = future.result(timeout=self.budget_seconds)
+        except TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+                self._overrun = future
+            logger.warning(
+                f"Reranking {len(scored_docs)} candidates exceeded {self.budget_seconds * 1000:.0f} ms; "
+                f"using first-stage order"
+            )
+            return scored_docs, False
+        except Exception as e:
+            logger.error(f"Error reranking candidates: {str(e)}")
+            return scored_docs, False
+        logger.info(f"Reranked {len(scored_docs)} candidates in {(time.perf_counter() - started) * 1000:.1f} ms")
+        return reranked, True
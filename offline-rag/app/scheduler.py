@@ -0,0 +1,168 @@
+import logging
+import queue
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class SchedulerBusyError(RuntimeError):
+    pass
+
+
+class GenerationRequest:
+    def __init__(self, session_id, make_stream):
+        self.session_id = session_id
+        self.make_stream = make_stream
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        self.cancelled = threading.Event()
+        self.output = queue.Queue()
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+# Iterator over a request's output. Closing it, or dropping the last
+# reference to it, cancels the request, including one that is still queued
+# and was never iterated, e.g. when the client disconnects before the first
+# token. A generator's finally block would not run in that case.
+class GenerationStream:
+    def __init__(self, request):
+        self.request = request
+        self._done = False
+        self._finalizer = weakref.finalize(self, request.cancel)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        item = self.request.output.get()
+        if item is _DONE:
+            self._done = True
+            raise StopIteration
+        if isinstance(item, BaseException):
+            self._done = True
+            raise item
+        return item
+
+    def close(self):
+        self._done = True
+        self._finalizer()
+
+
+# Serialises generations on one llama.cpp context. A Llama object holds a
+# single KV cache, so llama-cpp-python cannot batch independent sequences;
+# instead requests are queued per session and sessions are served round-robin,
+# so one client submitting many prompts cannot starve the others. Each request
+# streams its tokens back through its own queue and stops generating as soon
+# as the consumer goes away.
+class GenerationScheduler:
+    def __init__(self, name, max_queue=8, window=200):
+        self.name = name
+        self.max_queue = max(1, int(max_queue))
+        self._sessions = OrderedDict()
+        self._depth = 0
+        self._condition = threading.Condition()
+        self._active = None
+        self._waits = deque(maxlen=window)
+        self._runs = deque(maxlen=window)
+        self.completed = 0
+        self.cancelled = 0
+        self.rejected = 0
+        self.failed = 0
+        self._worker = threading.Thread(target=self._run, name=f"generation-{name}", daemon=True)
+        self._worker.start()
+
+    def submit(self, session_id, make_stream):
+        # make_stream is called on the scheduler thread and must return an
+        # iterator of text pieces; it is closed early on cancellation.
+        request = GenerationRequest(session_id, make_stream)
+        with self._condition:
+            if self._depth >= self.max_queue:
+                self.rejected += 1
+                raise SchedulerBusyError(
+                    f"Generation queue for {self.name} is full ({self._depth} waiting); try again shortly"
+                )
+            self._sessions.setdefault(session_id, deque()).append(request)
+            self._depth += 1
+            self._condition.notify()
+        return request
+
+    def stream(self, session_id, make_stream):
+        # Submits eagerly so a full queue is reported to the caller right away
+        request = self.submit(session_id, make_stream)
+        return GenerationStream(request)
+
+    def _next_request(self):
+        with self._condition:
+            while not self._depth:
+                self._condition.wait()
+            session_id, requests = self._sessions.popitem(last=False)
+            request = requests.popleft()
+            if requests:
+                # The session goes to the back of the line for its next turn
+                self._sessions[session_id] = requests
+            self._depth -= 1
+            return request
+
+    def _run(self):
+        while True:
+            request = self._next_request()
+            if request.cancelled.is_set():
+                self.cancelled += 1
+                request.output.put(_DONE)
+                continue
+
+            request.started_at = time.perf_counter()
+            self._waits.append(request.started_at - request.submitted_at)
+            self._active = request
+            stream = None
+            try:
+                stream = request.make_stream()
+                for piece in stream:
+                    if request.cancelled.is_set():
+                        break
+                    request.output.put(piece)
+                if request.cancelled.is_set():
+                    self.cancelled += 1
+                    logger.info(f"Generation cancelled for session {request.session_id}")
+                else:
+                    self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error generating response: {str(e)}")
+                request.output.put(e)
+            finally:
+                if stream is not None and hasattr(stream, "close"):
+                    stream.close()
+                self._runs.append(time.perf_counter() - request.started_at)
+                self._active = None
+                request.output.put(_DONE)
+
+    def metrics(self):
+        with self._condition:
+            depth = self._depth
+            sessions = len(self._sessions)
+        waits = sorted(self._waits)
+        runs = list(self._runs)
+        return {
+            "queue_depth": depth,
+            "max_queue": self.max_queue,
+            "waiting_sessions": sessions,
+            "active": self._active is not None,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "wait_p50_seconds": round(waits[len(waits) // 2], 3) if waits else None,
+            "wait_p95_seconds": round(waits[int(len(waits) * 0.95)], 3) if waits else None,
+            "wait_max_seconds": round(waits[-1], 3) if waits else None,
+            "mean_run_seconds": round(sum(runs) / len(runs), 3) if runs else None,
+        }
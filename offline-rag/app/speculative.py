@@ -0,0 +1,211 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+# Speculative decoding for ModelHandler. llama-cpp-python verifies draft
+# tokens itself (Llama(draft_model=...)): the target model evaluates the last
+# sampled token plus the draft in one batch and keeps drafted tokens for as
+# long as they match what it samples, so the output distribution is
+# unchanged. Drafts come either from prompt lookup (copying n-gram
+# continuations out of the prompt, which suits RAG answers quoting their
+# context) or from a small GGUF sharing the target's vocabulary.
+
+logger = logging.getLogger(__name__)
+
+_speculative_llama_class = None
+
+
+def get_speculative_llama_class(llama_cpp):
+    # llama-cpp-python 0.3.0 ignores the idx it is asked to sample at and
+    # always uses the last logits row, so every drafted token would be
+    # checked against the wrong position. Sampling at the requested row of
+    # the last batch keeps greedy output identical to normal decoding.
+    global _speculative_llama_class
+    if _speculative_llama_class is None:
+        class SpeculativeLlama(llama_cpp.Llama):
+            def sample(self, *args, idx=None, **kwargs):
+                if self._sampler is None or idx is None:
+                    return super().sample(*args, idx=idx, **kwargs)
+                return self._sampler.sample(self._ctx, idx - self.n_tokens)
+
+        _speculative_llama_class = SpeculativeLlama
+    return _speculative_llama_class
+
+
+class GGUFDraftModel:
+    # Greedy drafts from a small Llama. Its KV cache is kept between calls,
+    # so each call only evaluates the tokens accepted since the last one.
+    def __init__(self, model, num_pred_tokens=4):
+        self.model = model
+        self.num_pred_tokens = max(1, int(num_pred_tokens))
+
+    def __call__(self, input_ids, **kwargs):
+        model = self.model
+        if len(input_ids) + self.num_pred_tokens > model.n_ctx():
+            return np.array([], dtype=np.intc)
+        common = 0
+        for cached, token in zip(model.input_ids[:model.n_tokens], input_ids):
+            if cached != token:
+                break
+            common += 1
+        # The last input token is always evaluated so its logits are fresh
+        model.n_tokens = min(common, len(input_ids) - 1)
+        model.eval(input_ids[model.n_tokens:].tolist())
+
+        draft = []
+        for index in range(self.num_pred_tokens):
+            token = model.sample(temp=0.0)
+            if token == model.token_eos():
+                break
+            draft.append(token)
+            if index < self.num_pred_tokens - 1:
+                model.eval([token])
+        return np.array(draft, dtype=np.intc)
+
+
+class SpeculativeStats:
+    # Wraps a draft model and counts how many drafted tokens the target kept.
+    # The target calls the draft once per verification step with everything
+    # it has accepted so far, so the growth in input length since the
+    # previous call tells how much of the previous draft survived.
+    def __init__(self, draft_model, method):
+        self.draft_model = draft_model
+        self.method = method
+        self.calls = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.draft_seconds = 0.0
+        self._pending = None
+
+    def start(self):
+        # A new generation; a draft left over from the last one was never verified
+        self._pending = None
+
+    def __call__(self, input_ids, **kwargs):
+        if self._pending is not None:
+            start, count = self._pending
+            self.proposed += count
+            self.accepted += min(count, max(0, len(input_ids) - start - 1))
+        started = time.perf_counter()
+        draft = self.draft_model(input_ids, **kwargs)
+        self.draft_seconds += time.perf_counter() - started
+        self.calls += 1
+        self._pending = (len(input_ids), len(draft)) if len(draft) else None
+        return draft
+
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "proposed": self.proposed,
+            "accepted": self.accepted,
+            "draft_seconds": self.draft_seconds,
+        }
+
+    def since(self, before, tokens_generated):
+        # Per-generation figures from a snapshot taken before it started
+        proposed = self.proposed - before["proposed"]
+        accepted = self.accepted - before["accepted"]
+        calls = self.calls - before["calls"]
+        return {
+            "method": self.method,
+            "proposed_tokens": proposed,
+            "accepted_tokens": accepted,
+            "acceptance_rate": round(accepted / proposed, 3) if proposed else None,
+            # Each verification step is one batched forward pass of the target
+            "tokens_per_target_pass": round(tokens_generated / calls, 2) if calls else None,
+            "draft_seconds": round(self.draft_seconds - before["draft_seconds"], 4),
+        }
+
+    def summary(self):
+        return {
+            "method": self.method,
+            "calls": self.calls,
+            "proposed_tokens": self.proposed,
+            "accepted_tokens": self.accepted,
+            "acceptance_rate": round(self.accepted / self.proposed, 3) if self.proposed else None,
+            "draft_seconds": round(self.draft_seconds, 3),
+        }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare generation speed with and without speculative decoding"
+    )
+    parser.add_argument("--model", default="Llama 3", help="Model choice as listed in the UI")
+    parser.add_argument("--prompt", action="append", help="Prompt to generate from (repeatable)")
+    parser.add_argument("--runs", type=int, default=3, help="Generations per prompt and mode")
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--output", help="Also write the JSON report here")
+    return parser.parse_args(argv)
+
+
+DEFAULT_PROMPTS = [
+    "Context: The pump must be primed before start-up. Open the vent valve, fill the casing with water "
+    "and close the vent valve once water flows out steadily.\n\n"
+    "Question: How is the pump primed before start-up?\n\nAnswer:",
+]
+
+
+def measure(model_handler, model_choice, prompts, runs, max_tokens):
+    # Each prompt is evaluated once up front, so the timed runs reuse its KV
+    # cache and mostly measure decoding
+    model = model_handler.get_model(model_choice)
+    draft = getattr(model, "draft_model", None)
+    tokens = 0
+    seconds = 0.0
+    for prompt in prompts:
+        model(prompt, max_tokens=1, temperature=0.0)
+        for _ in range(runs):
+            if isinstance(draft, SpeculativeStats):
+                draft.start()
+            started = time.perf_counter()
+            output = model(prompt, max_tokens=max_tokens, temperature=0.0)
+            seconds += time.perf_counter() - started
+            tokens += output["usage"]["completion_tokens"]
+    return {"tokens": tokens, "seconds": round(seconds, 3),
+            "tokens_per_second": round(tokens / seconds, 2) if seconds else None}
+
+
+def main(argv=None):
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app.model_handler import ModelHandler
+    from app.model_pool import ModelPool
+    from app.utils import load_config, get_config_value
+
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    config = load_config()
+    method = get_config_value(config, 'speculative_decoding', "none")
+    if method == "none":
+        sys.exit("Set SPECULATIVE_DECODING to prompt-lookup or draft-model to compare against it")
+    prompts = args.prompt or DEFAULT_PROMPTS
+
+    # Separate pools so both models stay loaded side by side
+    baseline = ModelHandler(dict(config, speculative_decoding="none"), pool=ModelPool())
+    speculative = ModelHandler(config, pool=ModelPool())
+    report = {"model": args.model, "method": method, "prompts": len(prompts), "runs": args.runs}
+    report["baseline"] = measure(baseline, args.model, prompts, args.runs, args.max_tokens)
+    report["speculative"] = measure(speculative, args.model, prompts, args.runs, args.max_tokens)
+    stats = speculative.get_speculative_stats().get(args.model)
+    report["draft"] = stats
+    if stats is None:
+        report["note"] = "No draft model was attached; see the log for why"
+    elif report["baseline"]["tokens_per_second"] and report["speculative"]["tokens_per_second"]:
+        report["speedup"] = round(
+            report["speculative"]["tokens_per_second"] / report["baseline"]["tokens_per_second"], 2
+        )
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import importlib
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+# Wall-clock timings of the first import of heavy modules and of model and
+# embedder loads, shown behind the Debug checkbox.
+class StartupReport:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.imports = {}
+        self.loads = {}
+        self.marks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, section, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            with self._lock:
+                getattr(self, section).setdefault(name, round(seconds, 3))
+
+    def mark(self, name):
+        with self._lock:
+            self.marks.setdefault(name, round(time.perf_counter() - self.started, 3))
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "imports_seconds": dict(sorted(self.imports.items(), key=lambda item: -item[1])),
+                "loads_seconds": dict(self.loads),
+                "since_start_seconds": dict(self.marks),
+            }
+
+
+startup_report = StartupReport()
+
+
+def lazy_import(module_name):
+    # Imports on first use and records how long the first import took
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+    with startup_report.timed("imports", module_name):
+        return importlib.import_module(module_name)
+
+
+def warm_up(model_handler, get_embedding_function, get_vectorstore):
+    # Loads the embedder, vector store and LLMs so the first question does
+    # not pay for them; meant to run on a background thread.
+    try:
+        with startup_report.timed("loads", "embedding_model"):
+            get_embedding_function()
+        with startup_report.timed("loads", "vectorstore"):
+            get_vectorstore()
+        with startup_report.timed("loads", "llm"):
+            model_handler.warm_up()
+    except Exception as e:
+        logger.error(f"Error warming up models: {str(e)}")
+    finally:
+        startup_report.mark("warm_up_done")
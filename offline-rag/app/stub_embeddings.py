@@ -0,0 +1,32 @@
+import hashlib
+import re
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+# Deterministic feature-hashing embedder. It needs no model files, so the
+# benchmark and smoke tests run on air-gapped hosts with identical vectors on
+# every machine; retrieval quality is bag-of-words, not semantic.
+class HashingEmbeddings(Embeddings):
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in WORD_PATTERN.findall(text.lower()):
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            vector[value % self.dim] += 1.0 if value >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
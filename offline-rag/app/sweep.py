@@ -0,0 +1,256 @@
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+from app.benchmark import apply_overrides, build_corpus, fact_query, git_revision, percentiles
+
+# Offline sweep over chunking settings. Every (chunk_size, chunk_overlap,
+# parent_chunk_size) setting is indexed from scratch in its own worker process through
+# process_documents, then each top_k is scored on a labeled question set for
+# recall, prompt-token cost and retrieve_context latency. All workers share
+# one embedding cache, so chunk text that repeats across settings is only
+# embedded once. The Pareto-optimal configurations are printed at the end.
+#
+#   python -m app.sweep --embedding-model stub --chunk-sizes 500 1000 --top-k 3 5
+#   python -m app.sweep --corpus ./documents --questions questions.jsonl
+#
+# A questions file holds one {"question": ..., "answer": ...} object per
+# line; a question counts as recalled when its answer appears in the
+# retrieved context. Workers share the CPU, so run with --workers 1 when
+# latency matters more than sweep time.
+
+OBJECTIVES = (("recall", max), ("mean_prompt_tokens", min), ("p50_ms", min))
+
+
+def write_synthetic_corpus(directory, args):
+    # The benchmark corpus, with each planted fact as a labeled question
+    documents, facts = build_corpus(args.docs, args.pages, args.facts_per_doc, seed=args.seed)
+    corpus_dir = os.path.join(directory, "corpus")
+    os.makedirs(corpus_dir, exist_ok=True)
+    for name, data in documents:
+        with open(os.path.join(corpus_dir, name), "wb") as f:
+            f.write(data)
+    questions_path = os.path.join(directory, "questions.jsonl")
+    with open(questions_path, "w") as f:
+        for fact in facts:
+            f.write(json.dumps({"question": fact_query(fact), "answer": fact["code"]}) + "\n")
+    return corpus_dir, questions_path
+
+
+def load_questions(path):
+    questions = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                questions.append((item["question"], item["answer"]))
+    return questions
+
+
+def get_token_counter(config):
+    # Prompt cost in the generator's own tokens when its GGUF is available
+    # (only the vocabulary is loaded), otherwise about four characters a token
+    model_path = config.get('llama_model_path')
+    if model_path and os.path.exists(model_path):
+        try:
+            import llama_cpp
+            vocab = llama_cpp.Llama(model_path=model_path, vocab_only=True, verbose=False)
+            return lambda text: len(vocab.tokenize(text.encode("utf-8"), add_bos=False)), "gguf"
+        except Exception:
+            pass
+    return lambda text: (len(text) + 3) // 4, "chars/4"
+
+
+def run_setting(task):
+    # Runs in a fresh worker process: the app modules keep their stores in
+    # module-level caches relative to the working directory, so each setting
+    # gets its own process and directory.
+    chunk_size, chunk_overlap, parent_chunk_size, top_ks, options = task
+    run_dir = os.path.join(options["workdir"], f"chunk{chunk_size}-overlap{chunk_overlap}-parent{parent_chunk_size}")
+    os.makedirs(run_dir, exist_ok=True)
+    os.chdir(run_dir)
+    if options["models_dir"] and not os.path.exists("models"):
+        os.symlink(options["models_dir"], "models")
+
+    from app import document_processor, rag
+
+    # rag logs every retrieved context at INFO
+    logging.getLogger().setLevel(logging.WARNING)
+    apply_overrides([document_processor, rag], {
+        "embedding_model": options["embedding_model"],
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "parent_chunk_size": parent_chunk_size,
+        "vector_storage": options["vector_storage"],
+        "hybrid_search": options["hybrid_search"],
+        "embedding_cache_dir": options["embedding_cache_dir"],
+        # Pool workers are daemonic and cannot start extraction processes
+        "ingest_workers": 1,
+    })
+    count_tokens, token_counter = get_token_counter(document_processor.config)
+    questions = load_questions(options["questions"])
+
+    uploads = []
+    for path in sorted(glob.glob(os.path.join(options["corpus"], "*.pdf"))):
+        with open(path, "rb") as f:
+            uploads.append(document_processor.UploadedDocument(os.path.basename(path), f.read()))
+    started = time.perf_counter()
+    num_chunks = document_processor.process_documents(uploads)
+    ingest_seconds = time.perf_counter() - started
+    # Chunks embedded here versus found in the shared cache
+    embeddings = document_processor.get_embedding_function()
+    cache_stats = {"hits": embeddings.hits, "misses": embeddings.misses} if hasattr(embeddings, "hits") else None
+
+    rows = []
+    for top_k in top_ks:
+        # Each top_k starts cold so its latencies include the query embedding
+        rag.query_cache.results.clear()
+        rag.query_cache.embeddings.clear()
+        rag.retrieve_context("warm up", top_k)
+        rag.query_cache.embeddings.clear()
+
+        hits, tokens, latencies = 0, [], []
+        for question, answer in questions:
+            query_started = time.perf_counter()
+            context = rag.retrieve_context(question, top_k)
+            latencies.append(time.perf_counter() - query_started)
+            tokens.append(count_tokens(context))
+            if answer.lower() in context.lower():
+                hits += 1
+        rows.append({
+            "chunk_size": chunk_size,
+            "chunk_overlap": chunk_overlap,
+            "parent_chunk_size": parent_chunk_size,
+            "top_k": top_k,
+            "chunks": num_chunks,
+            "ingest_seconds": round(ingest_seconds, 3),
+            "recall": round(hits / len(questions), 4) if questions else None,
+            "mean_prompt_tokens": round(sum(tokens) / len(tokens), 1) if tokens else None,
+            "max_prompt_tokens": max(tokens) if tokens else None,
+            "token_counter": token_counter,
+            "embedding_cache": cache_stats,
+            **percentiles(latencies),
+        })
+    return rows
+
+
+def dominates(first, second):
+    at_least_as_good = all(
+        (first[key] >= second[key]) if better is max else (first[key] <= second[key]) for key, better in OBJECTIVES
+    )
+    return at_least_as_good and any(first[key] != second[key] for key, _ in OBJECTIVES)
+
+
+def pareto_front(rows):
+    rows = [row for row in rows if all(row.get(key) is not None for key, _ in OBJECTIVES)]
+    front = [row for row in rows if not any(dominates(other, row) for other in rows)]
+    return sorted(front, key=lambda row: (-row["recall"], row["mean_prompt_tokens"], row["p50_ms"]))
+
+
+def format_table(rows):
+    header = f"{'chunk_size':>10} {'overlap':>7} {'parent':>6} {'top_k':>5} {'recall':>7} {'tokens':>8} {'p50_ms':>8} {'p99_ms':>8}"
+    lines = [header, "-" * len(header)]
+    for row in rows:
+        lines.append(
+            f"{row['chunk_size']:>10} {row['chunk_overlap']:>7} {row['parent_chunk_size']:>6} {row['top_k']:>5} {row['recall']:>7.3f} "
+            f"{row['mean_prompt_tokens']:>8.1f} {row['p50_ms']:>8.2f} {row['p99_ms']:>8.2f}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep chunking settings and report the recall/cost/latency Pareto front")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[250, 500, 1000, 1500])
+    parser.add_argument("--chunk-overlaps", type=int, nargs="+", default=[0, 50, 100, 200])
+    parser.add_argument("--parent-chunk-sizes", type=int, nargs="+", default=[0],
+                        help="parent section sizes for parent/child indexing; 0 embeds whole chunks")
+    parser.add_argument("--top-k", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("--corpus", default=None, help="directory of PDFs (default: the synthetic benchmark corpus)")
+    parser.add_argument("--questions", default=None, help="JSONL of {\"question\", \"answer\"}; required with --corpus")
+    parser.add_argument("--docs", type=int, default=20, help="synthetic PDFs")
+    parser.add_argument("--pages", type=int, default=10, help="pages per synthetic PDF")
+    parser.add_argument("--facts-per-doc", type=int, default=5, help="planted facts (questions) per synthetic PDF")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--embedding-model", default=None,
+                        help="embedding model name, or 'stub' for the deterministic offline embedder")
+    parser.add_argument("--vector-storage", choices=["chroma", "int8", "binary"], default=None)
+    parser.add_argument("--hybrid-search", type=lambda value: value.lower() in ("1", "true", "yes", "on"), default=None)
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1),
+                        help="settings indexed in parallel; each worker loads its own embedding model")
+    parser.add_argument("--workdir", default=None, help="directory for the stores (default: a fresh temp dir)")
+    parser.add_argument("--output", default=None, help="write every result and the Pareto front as JSON")
+    args = parser.parse_args(argv)
+    if args.corpus and not args.questions:
+        parser.error("--questions is required with --corpus")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="offline-rag-sweep-"))
+    os.makedirs(workdir, exist_ok=True)
+    if args.corpus:
+        corpus_dir, questions_path = os.path.abspath(args.corpus), os.path.abspath(args.questions)
+    else:
+        corpus_dir, questions_path = write_synthetic_corpus(workdir, args)
+
+    from app.utils import load_config, get_config_value
+    config = load_config()
+    models_dir = os.path.abspath("models")
+    options = {
+        "workdir": workdir,
+        "models_dir": models_dir if os.path.isdir(models_dir) else None,
+        "corpus": corpus_dir,
+        "questions": questions_path,
+        "embedding_model": args.embedding_model,
+        "vector_storage": args.vector_storage,
+        "hybrid_search": args.hybrid_search,
+        "embedding_cache_dir": os.path.abspath(
+            get_config_value(config, 'embedding_cache_dir', os.path.join(workdir, "embedding_cache"))
+        ),
+    }
+    tasks = [
+        (chunk_size, chunk_overlap, parent_chunk_size, sorted(set(args.top_k)), options)
+        for chunk_size in sorted(set(args.chunk_sizes))
+        for chunk_overlap in sorted(set(args.chunk_overlaps))
+        for parent_chunk_size in sorted(set(args.parent_chunk_sizes))
+        if chunk_overlap < chunk_size and (parent_chunk_size == 0 or chunk_size < parent_chunk_size)
+    ]
+
+    rows = []
+    started = time.perf_counter()
+    context = multiprocessing.get_context("spawn")
+    # One task per process, so no setting inherits another's cached stores
+    with context.Pool(processes=max(1, args.workers), maxtasksperchild=1) as pool:
+        for setting_rows in pool.imap_unordered(run_setting, tasks):
+            rows.extend(setting_rows)
+            first = setting_rows[0]
+            print(f"chunk_size={first['chunk_size']} overlap={first['chunk_overlap']} "
+                  f"parent={first['parent_chunk_size']}: "
+                  f"{first['chunks']} chunks in {first['ingest_seconds']:.1f}s", flush=True)
+    rows.sort(key=lambda row: (row["chunk_size"], row["chunk_overlap"], row["parent_chunk_size"], row["top_k"]))
+    front = pareto_front(rows)
+
+    print(f"\n{len(rows)} configurations in {time.perf_counter() - started:.1f}s; Pareto front "
+          f"(max recall, min prompt tokens, min p50 latency):\n")
+    print(format_table(front))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "revision": git_revision(),
+                "workdir": workdir,
+                "corpus": corpus_dir,
+                "questions": questions_path,
+                "results": rows,
+                "pareto_front": front,
+            }, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+from .utils import get_config_value
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the Prometheus histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Histograms exported on /metrics: metric name -> field of a trace record
+HISTOGRAM_FIELDS = {
+    "request_seconds": "total_seconds",
+    "embed_query_seconds": ("seconds", "embed_query"),
+    "vector_search_seconds": ("seconds", "vector_search"),
+    "time_to_first_token_seconds": ("generation", "ttft_seconds"),
+    "generation_seconds": ("generation", "total_seconds"),
+}
+
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+# Timings, token counts and cache outcomes of one question, from retrieval to
+# the last generated token. Retrieval code finds the trace through a context
+# variable; generation runs on the scheduler thread, so the trace is handed to
+# it explicitly.
+class RequestTrace:
+    def __init__(self, kind, **fields):
+        self.request_id = uuid.uuid4().hex
+        self.kind = kind
+        self.fields = fields
+        self.timestamp = time.time()
+        self.started = time.perf_counter()
+        self.seconds = {}
+        self.cache = {}
+        self.generation = {}
+        self.status = None
+
+    @property
+    def finished(self):
+        return self.status is not None
+
+    def add_seconds(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def cache_outcome(self, name, hit):
+        # The first lookup is the one the request actually waited on
+        self.cache.setdefault(name, "hit" if hit else "miss")
+
+    def as_record(self):
+        return {
+            "request_id": self.request_id,
+            "timestamp": round(self.timestamp, 3),
+            "kind": self.kind,
+            "status": self.status,
+            **self.fields,
+            "total_seconds": round(time.perf_counter() - self.started, 4),
+            "seconds": {name: round(seconds, 4) for name, seconds in self.seconds.items()},
+            "cache": dict(self.cache),
+            "generation": dict(self.generation),
+        }
+
+
+def start_trace(kind, **fields):
+    # Becomes the current trace of this thread (or asyncio task) until the
+    # next request starts one
+    trace = RequestTrace(kind, **fields)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    trace = _current_trace.get()
+    return trace if trace is not None and not trace.finished else None
+
+
+@contextmanager
+def timed(name):
+    # Adds the elapsed time to the current trace, if there is one
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = current_trace()
+        if trace is not None:
+            trace.add_seconds(name, time.perf_counter() - started)
+
+
+def record_cache(name, hit):
+    trace = current_trace()
+    if trace is not None:
+        trace.cache_outcome(name, hit)
+
+
+def record_generation(trace, prompt_tokens, tokens_generated, ttft, token_gaps, total_seconds, **fields):
+    if trace is None:
+        return
+    trace.generation.update(
+        prompt_tokens=prompt_tokens,
+        tokens_generated=tokens_generated,
+        ttft_seconds=round(ttft, 4) if ttft is not None else None,
+        total_seconds=round(total_seconds, 4),
+        tokens_per_second=round(tokens_generated / total_seconds, 2) if total_seconds > 0 else None,
+        inter_token_ms={
+            "p50": round(percentile(token_gaps, 0.5) * 1000, 2) if token_gaps else None,
+            "p95": round(percentile(token_gaps, 0.95) * 1000, 2) if token_gaps else None,
+            "max": round(max(token_gaps) * 1000, 2) if token_gaps else None,
+            "mean": round(sum(token_gaps) / len(token_gaps) * 1000, 2) if token_gaps else None,
+        },
+        **fields
+    )
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+# Writes finished traces to a size-rotated JSONL file and keeps running
+# totals for the Prometheus endpoint plus the most recent records for the
+# Debug summary.
+class Telemetry:
+    def __init__(self, path=None, max_bytes=10 * 2**20, backups=5, window=200):
+        self.path = path
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._cache_lookups = {}
+        self._tokens = {"prompt": 0, "generated": 0}
+        self._histograms = {name: Histogram() for name in HISTOGRAM_FIELDS}
+        self._handler = None
+        if path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                self._handler = logging.handlers.RotatingFileHandler(
+                    path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+                )
+                self._handler.setFormatter(logging.Formatter("%(message)s"))
+            except OSError as e:
+                logger.error(f"Error opening telemetry file {path}, keeping telemetry in memory only: {str(e)}")
+
+    def write(self, trace, status="ok"):
+        if trace is None or trace.finished:
+            return None
+        trace.status = status
+        record = trace.as_record()
+        with self._lock:
+            self._recent.append(record)
+            key = (record["kind"], status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            for cache, outcome in record["cache"].items():
+                key = (cache, outcome)
+                self._cache_lookups[key] = self._cache_lookups.get(key, 0) + 1
+            self._tokens["prompt"] += record["generation"].get("prompt_tokens") or 0
+            self._tokens["generated"] += record["generation"].get("tokens_generated") or 0
+            for name, field in HISTOGRAM_FIELDS.items():
+                value = record[field] if isinstance(field, str) else record[field[0]].get(field[1])
+                if value is not None:
+                    self._histograms[name].observe(value)
+        if self._handler is not None:
+            self._handler.handle(logging.makeLogRecord({"msg": json.dumps(record)}))
+        return record
+
+    def recent(self):
+        with self._lock:
+            return list(self._recent)
+
+    def summary(self, slowest=5):
+        records = self.recent()
+        totals = [record["total_seconds"] for record in records]
+        ttfts = [record["generation"]["ttft_seconds"] for record in records
+                 if record["generation"].get("ttft_seconds") is not None]
+        hits = {}
+        for record in records:
+            for cache, outcome in record["cache"].items():
+                counts = hits.setdefault(cache, {"hit": 0, "miss": 0})
+                counts[outcome] += 1
+        return {
+            "requests": len(records),
+            "total_p50_seconds": percentile(totals, 0.5),
+            "total_p95_seconds": percentile(totals, 0.95),
+            "ttft_p50_seconds": percentile(ttfts, 0.5),
+            "ttft_p95_seconds": percentile(ttfts, 0.95),
+            "cache": hits,
+            "slowest": [
+                {
+                    "question": (record.get("question") or "")[:80],
+                    "status": record["status"],
+                    "total_seconds": record["total_seconds"],
+                    "seconds": record["seconds"],
+                    "ttft_seconds": record["generation"].get("ttft_seconds"),
+                    "tokens_generated": record["generation"].get("tokens_generated"),
+                }
+                for record in sorted(records, key=lambda record: -record["total_seconds"])[:slowest]
+            ],
+            "path": self.path if self._handler is not None else None,
+        }
+
+    def prometheus_text(self, prefix="offline_rag"):
+        lines = []
+        with self._lock:
+            lines.append(f"# TYPE {prefix}_requests_total counter")
+            for (kind, status), count in sorted(self._requests.items()):
+                lines.append(f'{prefix}_requests_total{{kind="{kind}",status="{status}"}} {count}')
+            lines.append(f"# TYPE {prefix}_cache_lookups_total counter")
+            for (cache, outcome), count in sorted(self._cache_lookups.items()):
+                lines.append(f'{prefix}_cache_lookups_total{{cache="{cache}",outcome="{outcome}"}} {count}')
+            lines.append(f"# TYPE {prefix}_tokens_total counter")
+            for kind, count in self._tokens.items():
+                lines.append(f'{prefix}_tokens_total{{kind="{kind}"}} {count}')
+            for name, histogram in self._histograms.items():
+                lines.append(f"# TYPE {prefix}_{name} histogram")
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'{prefix}_{name}_bucket{{le="{bound}"}} {count}')
+                lines.append(f'{prefix}_{name}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{prefix}_{name}_sum {histogram.sum:.6f}")
+                lines.append(f"{prefix}_{name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        if self._handler is not None:
+            self._handler.close()
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def get_telemetry(config):
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            enabled = get_config_value(config, 'telemetry_enabled', True)
+            _telemetry = Telemetry(
+                get_config_value(config, 'telemetry_path', "./telemetry/requests.jsonl") if enabled else None,
+                max_bytes=int(get_config_value(config, 'telemetry_max_mb', 10) * 2**20),
+                backups=get_config_value(config, 'telemetry_backups', 5),
+            )
+        return _telemetry
+
+
+def trace_stream(stream, trace, telemetry):
+    # Passes pieces through and writes the trace once the consumer is done
+    status = "cancelled"
+    try:
+        for piece in stream:
+            yield piece
+        status = "ok"
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+        telemetry.write(trace, status)
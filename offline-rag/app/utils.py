@@ -1,3 +1,5 @@
+import functools
+import threading
 import yaml
 import os
 from dotenv import load_dotenv
@@ -22,4 +24,55 @@ def load_config():
         if isinstance(config[key], str) and config[key].isdigit():
             config[key] = int(config[key])
 
-    return config
\ No newline at end of file
+    return config
+
+def get_config_value(config, key, default=None):
+    # Optional settings may be absent from config.yaml, so fall back to the
+    # matching upper-case environment variable before using the default.
+    value = config.get(key)
+    if value is None:
+        value = os.getenv(key.upper())
+    if value is None:
+        return default
+
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in ("true", "yes", "on"):
+            return True
+        if lowered in ("false", "no", "off"):
+            return False
+        if lowered.isdigit():
+            return int(lowered)
+        try:
+            return float(lowered)
+        except ValueError:
+            return value
+    return value
+
+def cache_resource(func):
+    # st.cache_resource only caches inside a running Streamlit app. Scripts
+    # such as the benchmark share the same resources through a process cache.
+    import streamlit as st
+    from streamlit import runtime
+
+    streamlit_cached = st.cache_resource(func)
+    cache = {}
+    lock = threading.RLock()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if runtime.exists():
+            return streamlit_cached(*args, **kwargs)
+        key = (args, tuple(sorted(kwargs.items())))
+        with lock:
+            if key not in cache:
+                cache[key] = func(*args, **kwargs)
+            return cache[key]
+
+    def clear():
+        streamlit_cached.clear()
+        with lock:
+            cache.clear()
+
+    wrapper.clear = clear
+    return wrapper
@@ -0,0 +1,85 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app import document_processor
+from app.benchmark import make_pdf
+
+# Every store document_processor opens is cached per process, so each test
+# starts and ends with none of them loaded
+CACHED_RESOURCES = (
+    document_processor.get_embedding_function,
+    document_processor.get_index_bundle,
+    document_processor.get_vectorstore,
+    document_processor.get_manifest,
+    document_processor.get_answer_cache,
+    document_processor.get_keyword_index,
+    document_processor.get_parent_store,
+    document_processor.get_ingest_job_runner,
+)
+
+
+def clear_resources():
+    for resource in CACHED_RESOURCES:
+        resource.clear()
+    # Chroma keeps one client per persist directory for the life of the process
+    from chromadb.api.client import SharedSystemClient
+    SharedSystemClient.clear_system_cache()
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # document_processor with its stores under a fresh working directory,
+    # embedding with the deterministic stub model
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(document_processor.DOCUMENTS_DIR, exist_ok=True)
+    for key, value in (("embedding_model", "stub"), ("vector_storage", "chroma"), ("ingest_workers", 1),
+                       ("parent_chunk_size", 0), ("persist_uploads", False)):
+        monkeypatch.setitem(document_processor.config, key, value)
+    monkeypatch.setattr(document_processor, "_collection_version", None)
+    monkeypatch.setattr(document_processor, "_ingest_job_runner", None)
+    clear_resources()
+    yield document_processor
+    clear_resources()
+
+
+@pytest.fixture
+def make_upload():
+    # An uploaded PDF with one line of text per page
+    def make(name, pages):
+        return document_processor.UploadedDocument(name, make_pdf([[text] for text in pages]))
+    return make
+
+
+# Keeps the parts of llama_cpp.Llama the caches use: a fixed-size input_ids
+# buffer of which only the first n_tokens are evaluated, eval, and state
+# snapshots holding copies of input_ids and the logits
+class FakeModel:
+    def __init__(self, n_ctx=64, n_vocab=16):
+        self.input_ids = np.zeros(n_ctx, dtype=np.intc)
+        self.scores = np.zeros((n_ctx, n_vocab), dtype=np.single)
+        self.n_tokens = 0
+        self.evaluated = 0
+
+    def eval(self, tokens):
+        self.input_ids[self.n_tokens:self.n_tokens + len(tokens)] = tokens
+        self.n_tokens += len(tokens)
+        self.evaluated += len(tokens)
+
+    def reset(self):
+        # Like Llama.reset, leaves the stale tokens in input_ids
+        self.n_tokens = 0
+
+    def save_state(self):
+        return SimpleNamespace(input_ids=self.input_ids.copy(), scores=self.scores.copy(), n_tokens=self.n_tokens,
+                               llama_state_size=1000)
+
+    def load_state(self, state):
+        self.input_ids = state.input_ids.copy()
+        self.scores = state.scores.copy()
+        self.n_tokens = state.n_tokens
+
+    def evaluated_tokens(self):
+        return self.input_ids[:self.n_tokens].tolist()
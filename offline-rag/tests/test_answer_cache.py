@@ -0,0 +1,65 @@
+from app.answer_cache import AnswerCache, record, replay
+
+SYSTEM = "Answer from the context."
+CONTEXT = "The feed pump part number is PX-1100."
+QUESTION = "What is the feed pump part number?"
+
+
+def test_exact_hit_needs_the_same_model_prompt_and_context(tmp_path):
+    cache = AnswerCache(str(tmp_path / "answers.sqlite3"))
+    cache.store("Mistral", SYSTEM, CONTEXT, QUESTION, "PX-1100.", ["pumps.pdf"])
+
+    assert cache.lookup("Mistral", SYSTEM, CONTEXT, "  what is the FEED pump part number ") == "PX-1100."
+    assert cache.lookup("Llama", SYSTEM, CONTEXT, QUESTION) is None
+    assert cache.lookup("Mistral", SYSTEM, CONTEXT + " It was replaced in 2023.", QUESTION) is None
+    assert cache.stats() == {"entries": 1, "hits": 1, "semantic_hits": 0, "misses": 2}
+
+
+def test_near_duplicate_question_hits_only_within_its_context(tmp_path):
+    cache = AnswerCache(str(tmp_path / "answers.sqlite3"), similarity_threshold=0.9)
+    cache.store("Mistral", SYSTEM, CONTEXT, QUESTION, "PX-1100.", ["pumps.pdf"], embedding=[1.0, 0.0, 0.0])
+
+    assert cache.lookup("Mistral", SYSTEM, CONTEXT, "Which part number does the feed pump have?",
+                        embedding=[0.95, 0.1, 0.0]) == "PX-1100."
+    assert cache.lookup("Mistral", SYSTEM, CONTEXT, "How often is the seal replaced?",
+                        embedding=[0.3, 0.9, 0.0]) is None
+    assert cache.lookup("Mistral", SYSTEM, "Other context.", "Which part number does the feed pump have?",
+                        embedding=[1.0, 0.0, 0.0]) is None
+    assert cache.semantic_hits == 1
+
+
+def test_least_recently_used_answers_are_evicted(tmp_path):
+    cache = AnswerCache(str(tmp_path / "answers.sqlite3"), max_entries=2)
+    for question in ("first?", "second?"):
+        cache.store("Mistral", SYSTEM, CONTEXT, question, question.upper(), [])
+    assert cache.lookup("Mistral", SYSTEM, CONTEXT, "first?") == "FIRST?"
+    cache.store("Mistral", SYSTEM, CONTEXT, "third?", "THIRD?", [])
+
+    assert cache.lookup("Mistral", SYSTEM, CONTEXT, "second?") is None
+    assert cache.lookup("Mistral", SYSTEM, CONTEXT, "first?") == "FIRST?"
+    assert cache.stats()["entries"] == 2
+
+
+def test_changing_or_removing_a_document_drops_its_answers(store, make_upload):
+    store.process_documents([make_upload("pumps.pdf", [CONTEXT]), make_upload("valves.pdf", ["Valve VX-2200."])])
+    cache = store.get_answer_cache()
+    cache.store("Mistral", SYSTEM, CONTEXT, QUESTION, "PX-1100.", ["pumps.pdf"])
+    cache.store("Mistral", SYSTEM, "Valve VX-2200.", "Valve part?", "VX-2200.", ["valves.pdf"])
+
+    store.process_documents([make_upload("pumps.pdf", ["The feed pump part number is PX-1200."])])
+    assert cache.lookup("Mistral", SYSTEM, CONTEXT, QUESTION) is None
+    assert cache.lookup("Mistral", SYSTEM, "Valve VX-2200.", "Valve part?") == "VX-2200."
+
+    store.remove_document("valves.pdf")
+    assert cache.lookup("Mistral", SYSTEM, "Valve VX-2200.", "Valve part?") is None
+
+
+def test_only_finished_streams_are_recorded():
+    finished = []
+    assert "".join(record(replay("Replace the seal."), finished.append)) == "Replace the seal."
+    assert finished == ["Replace the seal."]
+
+    stream = record(replay("Replace the seal every year."), finished.append)
+    next(stream)
+    stream.close()
+    assert finished == ["Replace the seal."]
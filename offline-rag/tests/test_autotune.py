@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app import autotune
+
+LLAMA_CPP = SimpleNamespace(llama_supports_mlock=lambda: True)
+
+
+# Stands in for MicroBenchmark with speeds that are a function of the
+# settings: decode peaks at 4 threads, prefill at 8 threads and n_batch 256
+class FakeBench:
+    load_seconds = {(True, False): 1.0, (True, True): 1.5, (False, False): 3.0}
+    decode_bonus = {}
+
+    def __init__(self, llama_cpp, model_path, n_ctx, prompt_tokens, decode_tokens, runs):
+        pass
+
+    def load(self, n_batch, n_threads, n_threads_batch, use_mmap=True, use_mlock=False):
+        model = {"n_batch": n_batch, "n_threads": n_threads, "n_threads_batch": n_threads_batch,
+                 "memory": (use_mmap, use_mlock)}
+        return model, self.load_seconds[model["memory"]]
+
+    def set_threads(self, model, n_threads, n_threads_batch):
+        model.update(n_threads=n_threads, n_threads_batch=n_threads_batch)
+
+    def measure(self, model):
+        decode = 20.0 - abs(model["n_threads"] - 4) + self.decode_bonus.get(model["memory"], 0.0)
+        prefill = 100.0 - 5 * abs(model["n_threads_batch"] - 8) - abs(model["n_batch"] - 256) / 64
+        return {"prefill_tokens_per_second": prefill, "decode_tokens_per_second": decode}
+
+
+@pytest.fixture
+def model_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(autotune, "MicroBenchmark", FakeBench)
+    monkeypatch.setattr(autotune, "mlock_allowed", lambda num_bytes: True)
+    path = tmp_path / "model.gguf"
+    path.write_bytes(b"GGUF")
+    return str(path)
+
+
+def test_each_stage_keeps_its_winner(model_path):
+    settings, results = autotune.autotune(LLAMA_CPP, model_path, n_ctx=2048, n_batch=512, threads=[1, 2, 4, 8],
+                                          batch_sizes=[64, 256, 512, 4096])
+    # Near-equal decode speeds are a tie that the faster load breaks
+    assert settings == {"n_threads": 4, "n_threads_batch": 8, "n_batch": 256, "use_mmap": True, "use_mlock": False}
+    assert [row["threads"] for row in results["threads"]] == [1, 2, 4, 8]
+    # Batch sizes larger than the context are not tried
+    assert [row["n_batch"] for row in results["batch_sizes"]] == [64, 256, 512]
+    assert [row["option"] for row in results["memory"]] == ["mmap", "mmap+mlock", "no-mmap"]
+
+
+def test_clearly_faster_decode_beats_a_faster_load(model_path, monkeypatch):
+    monkeypatch.setattr(FakeBench, "decode_bonus", {(False, False): 5.0})
+    settings, _ = autotune.autotune(LLAMA_CPP, model_path, n_ctx=2048, n_batch=512, threads=[4, 8])
+    assert (settings["use_mmap"], settings["use_mlock"]) == (False, False)
+
+
+def test_mlock_is_skipped_without_the_memlock_limit(model_path, monkeypatch):
+    monkeypatch.setattr(autotune, "mlock_allowed", lambda num_bytes: False)
+    monkeypatch.setattr(FakeBench, "decode_bonus", {(True, True): 5.0})
+    settings, results = autotune.autotune(LLAMA_CPP, model_path, n_ctx=2048, n_batch=512, threads=[4])
+    assert settings["use_mlock"] is False
+    assert "RLIMIT_MEMLOCK" in results["memory"][1]["skipped"]
+
+
+def test_default_memory_option_when_none_can_be_measured(model_path, monkeypatch):
+    monkeypatch.setattr(autotune, "mlock_allowed", lambda num_bytes: False)
+    settings, results = autotune.autotune(LLAMA_CPP, model_path, n_ctx=2048, n_batch=512, threads=[4],
+                                          memory_options=["mmap+mlock"])
+    assert (settings["use_mmap"], settings["use_mlock"]) == (True, False)
+    assert [row["option"] for row in results["memory"]] == ["mmap+mlock"]
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from app.bm25_index import BM25Index, reciprocal_rank_fusion
+
+
+def test_rrf_ranks_agreement_above_a_single_top_hit():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["b", "c", "d"]], k=60)
+    assert [key for key, _ in fused] == ["b", "c", "a", "d"]
+    assert fused[0][1] == pytest.approx(1 / 62 + 1 / 61)
+    assert dict(fused)["d"] == pytest.approx(1 / 63)
+
+
+def test_rrf_k_flattens_rank_differences():
+    # First for one retriever only versus fourth for both
+    rankings = [["solo", "a", "b", "shared"], ["c", "d", "e", "shared"]]
+    sharp = dict(reciprocal_rank_fusion(rankings, k=1))
+    assert sharp["solo"] > sharp["shared"]
+    flat = dict(reciprocal_rank_fusion(rankings, k=60))
+    assert flat["shared"] > flat["solo"]
+
+
+def test_rrf_of_nothing_is_empty():
+    assert reciprocal_rank_fusion([[], []]) == []
+
+
+def test_part_numbers_match_whole_and_in_parts():
+    index = BM25Index()
+    index.add_many([("c1", "a.pdf", "Order part PN-4471-B for the pump"), ("c2", "a.pdf", "Clause 4.2.1 covers valves")])
+    assert index.search("PN-4471-B", 2)[0][0] == "c1"
+    assert index.search("4471", 2)[0][0] == "c1"
+    assert index.search("4.2.1", 2)[0][0] == "c2"
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "bm25_index.npz")
+    index = BM25Index(path)
+    index.add_many([
+        ("c1", "pumps.pdf", "Feed pump PX-1100 über seal"),
+        ("c2", None, "Relief valve VX-2200"),
+        ("c3", "old.pdf", "Retired sensor SX-3300"),
+    ])
+    index.remove_source("old.pdf")
+    index.save()
+
+    loaded = BM25Index.load(path)
+    assert len(loaded) == 2
+    for query in ("PX-1100", "über", "valve", "SX-3300"):
+        assert loaded.search(query, 3) == pytest.approx(index.search(query, 3))
+    loaded.remove_source("pumps.pdf")
+    assert loaded.search("PX-1100", 3) == []
+
+
+def test_pickled_index_is_rejected_without_unpickling(tmp_path):
+    path = str(tmp_path / "bm25_index.npz")
+    np.savez(path, tokens=np.array(["pump"], dtype=object), lengths=np.array([1]),
+             post_docs=np.array([0], dtype=np.int32), post_tfs=np.array([1], dtype=np.int32),
+             chunk_ids=np.array(["c1"], dtype=object), sources=np.array(["a.pdf"], dtype=object),
+             doc_len=np.array([1], dtype=np.int32))
+    with pytest.raises(ValueError, match="pickled"):
+        BM25Index.load(path)
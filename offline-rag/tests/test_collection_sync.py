@@ -0,0 +1,93 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+from app.collection_lock import CollectionLock
+from app.manifest import IngestManifest
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in another process, as the API would next to the UI
+INGEST = textwrap.dedent("""
+    import sys
+    from app import document_processor
+    from app.benchmark import make_pdf
+    name, text = sys.argv[1], sys.argv[2]
+    pages = [[f"{text} page {page}"] for page in range(20)]
+    document_processor.process_documents([document_processor.UploadedDocument(name, make_pdf(pages))])
+""")
+
+
+def run_app(code, *args, cwd, wait=True):
+    env = {key: value for key, value in os.environ.items() if key != "INDEX_BUNDLE"}
+    env.update(PYTHONPATH=APP_ROOT, EMBEDDING_MODEL="stub", VECTOR_STORAGE="chroma", INGEST_WORKERS="1",
+               PARENT_CHUNK_SIZE="0")
+    process = subprocess.Popen([sys.executable, "-c", code, *args], cwd=cwd, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if not wait:
+        return process
+    stdout, stderr = process.communicate(timeout=120)
+    assert process.returncode == 0, stderr
+    return stdout
+
+
+def test_collection_version_is_shared_through_the_file(tmp_path):
+    path = str(tmp_path / "manifest.sqlite3")
+    writer, reader = IngestManifest(path), IngestManifest(path)
+    assert reader.collection_version() == ""
+
+    version = writer.bump_collection_version()
+    assert reader.collection_version() == version
+    assert writer.bump_collection_version() != version
+
+    writer.close()
+    os.remove(path)
+    assert reader.is_replaced()
+    reader.close()
+
+
+def test_lock_excludes_other_processes(tmp_path):
+    path = str(tmp_path / "write.lock")
+    probe = f"from app.collection_lock import CollectionLock; print(CollectionLock({path!r}).acquire(blocking=False))"
+    lock = CollectionLock(path)
+    with lock:
+        with lock:
+            # Re-entrant within this thread
+            assert run_app(probe, cwd=tmp_path).strip() == "False"
+        assert run_app(probe, cwd=tmp_path).strip() == "False"
+    assert run_app(probe, cwd=tmp_path).strip() == "True"
+
+
+def test_concurrent_writers_keep_every_chunk(store, tmp_path):
+    writers = [run_app(INGEST, f"{name}.pdf", f"The {name} part number is {code}", cwd=tmp_path, wait=False)
+               for name, code in (("pump", "PX-1100"), ("valve", "VX-2200"))]
+    for writer in writers:
+        _, stderr = writer.communicate(timeout=120)
+        assert writer.returncode == 0, stderr
+
+    keyword_index = store.get_keyword_index()
+    for source, code in (("pump.pdf", "PX-1100"), ("valve.pdf", "VX-2200")):
+        assert len(store.get_manifest().chunk_ids(source)) == 20
+        assert len(store.get_vectorstore().get(where={"source": source})["ids"]) == 20
+        assert len(keyword_index.search(code, 50)) == 20
+
+
+def test_reader_reloads_after_another_process_ingests(store, make_upload, tmp_path):
+    store.process_documents([make_upload("pump.pdf", ["The pump part number is PX-1100."])])
+    assert store.get_keyword_index().search("VX-2200", 5) == []
+
+    run_app(INGEST, "valve.pdf", "The valve part number is VX-2200", cwd=tmp_path)
+    store.sync_collection()
+    assert len(store.get_keyword_index().search("VX-2200", 50)) == 20
+    assert len(store.get_vectorstore().get(where={"source": "valve.pdf"})["ids"]) == 20
+    assert store.get_existing_documents() == ["pump.pdf", "valve.pdf"]
+
+
+def test_clear_keeps_the_lock_file(store, make_upload):
+    store.process_documents([make_upload("pump.pdf", ["The pump part number is PX-1100."])])
+    lock_inode = os.stat(store.WRITE_LOCK_PATH).st_ino
+    store.clear_vectorstore()
+    # Another process waiting on the lock must keep waiting on the same file
+    assert os.stat(store.WRITE_LOCK_PATH).st_ino == lock_inode
+    assert store.get_existing_documents() == []
@@ -0,0 +1,61 @@
+from langchain_core.documents import Document
+
+from app.context_budget import assemble_context, overlap_length
+
+OVERLAP = "replace the seal every 2000 hours"
+
+
+def scored(*chunks):
+    return [(Document(page_content=text, metadata={"source": source, "page": 0}), 1.0 - rank / 10)
+            for rank, (source, text) in enumerate(chunks)]
+
+
+def test_chunks_that_do_not_fit_are_skipped_for_smaller_ones():
+    docs = scored(("a.pdf", "one two three"), ("a.pdf", "four five six seven eight"), ("b.pdf", "nine"))
+    context, accounting = assemble_context(docs, token_budget=5, separator="\n")
+    # Whitespace tokens; the separator counts nothing
+    assert context == "one two three\nnine"
+    assert accounting["context_tokens"] == 4
+    assert accounting["over_budget_dropped"] == 1
+    assert [chunk["source"] for chunk in accounting["chunks"]] == ["a.pdf", "b.pdf"]
+
+
+def test_separator_tokens_count_against_the_budget():
+    docs = scored(("a.pdf", "one two"), ("b.pdf", "three four"))
+    count = lambda text: len(text)
+    context, _ = assemble_context(docs, count_tokens=count, token_budget=len("one two") + 1 + 9,
+                                  separator="|")
+    assert context == "one two"
+    context, accounting = assemble_context(docs, count_tokens=count, token_budget=len("one two") + 1 + 10,
+                                           separator="|")
+    assert context == "one two|three four"
+    assert accounting["context_tokens"] == 18
+
+
+def test_overlap_between_neighbouring_chunks_is_sent_once():
+    docs = scored(("a.pdf", f"The pump manual says to {OVERLAP}"), ("a.pdf", f"{OVERLAP} of running time."))
+    context, accounting = assemble_context(docs, max_overlap=len(OVERLAP))
+    assert context == f"The pump manual says to {OVERLAP}\n of running time."
+    assert accounting["overlap_chars_removed"] == len(OVERLAP)
+
+
+def test_duplicates_and_other_sources_are_told_apart():
+    docs = scored(("a.pdf", f"Always {OVERLAP} carefully."), ("a.pdf", OVERLAP), ("b.pdf", OVERLAP))
+    context, accounting = assemble_context(docs, max_overlap=len(OVERLAP))
+    # Contained in a selected chunk of the same source; the same words in
+    # another document are kept
+    assert context == f"Always {OVERLAP} carefully.\n{OVERLAP}"
+    assert accounting["duplicates_dropped"] == 1
+
+
+def test_short_coincidental_overlaps_are_kept():
+    assert overlap_length("ends with the pump", "the pump starts", 50) == 0
+    assert overlap_length(f"x {OVERLAP}", f"{OVERLAP} y", 50) == len(OVERLAP)
+    assert overlap_length(f"x {OVERLAP}", f"{OVERLAP} y", 20) == 0
+
+
+def test_no_budget_keeps_everything():
+    docs = scored(("a.pdf", "one two three"), ("b.pdf", "four five"))
+    context, accounting = assemble_context(docs)
+    assert context == "one two three\nfour five"
+    assert accounting["token_budget"] is None and accounting["over_budget_dropped"] == 0
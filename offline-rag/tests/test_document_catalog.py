@@ -0,0 +1,48 @@
+from app.manifest import sha256_bytes
+
+PUMP = "The feed pump part number is PX-1100."
+VALVE = "The relief valve part number is VX-2200."
+
+
+def test_catalog_is_read_without_scanning_the_vector_store(store, make_upload, monkeypatch):
+    upload = make_upload("pumps.pdf", [PUMP, VALVE])
+    store.process_documents([upload, make_upload("valves.pdf", [VALVE])])
+    # The first read checks once for chunks indexed before the catalog existed
+    store.get_document_catalog()
+
+    def scan(*args, **kwargs):
+        raise AssertionError("the vector store was scanned")
+    monkeypatch.setattr(store.get_vectorstore(), "get", scan)
+    catalog = store.get_document_catalog()
+    assert [(document["source"], document["chunk_count"]) for document in catalog] == [
+        ("pumps.pdf", 2), ("valves.pdf", 1)
+    ]
+    assert catalog[0]["byte_size"] == len(upload.getbuffer())
+    assert catalog[0]["content_hash"] == sha256_bytes(upload.getbuffer())
+    assert catalog[0]["ingested_at"] > 0
+
+
+def test_catalog_follows_changes_and_removals(store, make_upload):
+    store.process_documents([make_upload("pumps.pdf", [PUMP])])
+    store.process_documents([make_upload("pumps.pdf", [PUMP, VALVE])])
+    assert [document["chunk_count"] for document in store.get_document_catalog()] == [2]
+
+    store.remove_document("pumps.pdf")
+    assert store.get_document_catalog() == []
+
+
+def test_collection_without_a_catalog_is_backfilled_once(store, monkeypatch):
+    vectorstore = store.get_vectorstore()
+    vectorstore.add_texts([PUMP, VALVE, VALVE], metadatas=[{"source": "pumps.pdf"}] + [{"source": "valves.pdf"}] * 2,
+                          ids=["legacy-1", "legacy-2", "legacy-3"])
+    scans = []
+    get = vectorstore.get
+    monkeypatch.setattr(vectorstore, "get", lambda *args, **kwargs: scans.append(kwargs) or get(*args, **kwargs))
+
+    for _ in range(2):
+        catalog = store.get_document_catalog()
+        assert [(document["source"], document["chunk_count"], document["byte_size"]) for document in catalog] == [
+            ("pumps.pdf", 1, None), ("valves.pdf", 2, None)
+        ]
+    # One page with the chunks and one empty page, on the first call only
+    assert len(scans) == 2
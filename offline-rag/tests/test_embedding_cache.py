@@ -0,0 +1,89 @@
+import logging
+import threading
+
+import numpy as np
+
+from app.embedding_cache import CachedEmbeddings, EmbeddingCache, text_hash
+from app.stub_embeddings import HashingEmbeddings
+
+TEXTS = [f"The pump part number is PX-{number}." for number in range(40)]
+
+
+# Counts the texts that reach the model
+class CountingEmbeddings(HashingEmbeddings):
+    def __init__(self):
+        super().__init__(dim=16)
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return super().embed_documents(texts)
+
+
+def orphaned_rows(cache):
+    rows = [row for (row,) in cache._conn.execute("SELECT row FROM entries ORDER BY row")]
+    return sorted(set(range(max(rows) + 1)) - set(rows))
+
+
+def test_cached_texts_are_not_embedded_again(tmp_path):
+    model = CountingEmbeddings()
+    embeddings = CachedEmbeddings(model, EmbeddingCache(str(tmp_path)))
+    first = embeddings.embed_documents(TEXTS[:3] + TEXTS[:1])
+    assert model.embedded == TEXTS[:3]
+    assert (embeddings.hits, embeddings.misses) == (1, 3)
+
+    second = embeddings.embed_documents(TEXTS[:4])
+    assert model.embedded == TEXTS[:4]
+    assert (embeddings.hits, embeddings.misses) == (1 + 3, 3 + 1)
+    np.testing.assert_allclose(second[:3], first[:3], atol=1e-6)
+    np.testing.assert_allclose(second, model.embed_documents(TEXTS[:4]), atol=1e-6)
+
+    # Another process opening the same directory sees the vectors
+    reopened = EmbeddingCache(str(tmp_path))
+    assert len(reopened) == 4
+    np.testing.assert_allclose(reopened.get_many([text_hash(TEXTS[3])])[text_hash(TEXTS[3])], second[3], atol=1e-6)
+
+
+def test_overlapping_writers_leave_no_orphaned_rows(tmp_path):
+    # Two processes miss the same text, embed it, and store it one after the other
+    model = HashingEmbeddings(dim=16)
+    first, second = EmbeddingCache(str(tmp_path)), EmbeddingCache(str(tmp_path))
+    first.put_many([(text_hash(text), vector) for text, vector in zip(TEXTS[:2], model.embed_documents(TEXTS[:2]))])
+    second.put_many([(text_hash(text), vector) for text, vector in zip(TEXTS[1:3], model.embed_documents(TEXTS[1:3]))])
+
+    assert len(second) == 3
+    assert orphaned_rows(second) == []
+    found = second.get_many([text_hash(text) for text in TEXTS[:3]])
+    np.testing.assert_allclose([found[text_hash(text)] for text in TEXTS[:3]], model.embed_documents(TEXTS[:3]),
+                               atol=1e-6)
+
+
+def test_concurrent_misses_share_one_copy_of_each_vector(tmp_path):
+    model = HashingEmbeddings(dim=16)
+    results = {}
+
+    def embed(worker):
+        embeddings = CachedEmbeddings(model, EmbeddingCache(str(tmp_path)))
+        texts = TEXTS[worker * 5:worker * 5 + 20]
+        results[worker] = (texts, embeddings.embed_documents(texts))
+
+    threads = [threading.Thread(target=embed, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    cache = EmbeddingCache(str(tmp_path))
+    assert len(cache) == 35
+    assert orphaned_rows(cache) == []
+    for texts, vectors in results.values():
+        np.testing.assert_allclose(vectors, model.embed_documents(texts), atol=1e-6)
+
+
+def test_unavailable_cache_is_reported(store, tmp_path, monkeypatch, caplog):
+    (tmp_path / "not-a-directory").write_text("")
+    monkeypatch.setitem(store.config, "embedding_cache_dir", str(tmp_path / "not-a-directory" / "cache"))
+    model = HashingEmbeddings()
+    with caplog.at_level(logging.WARNING, logger="app.document_processor"):
+        assert store.cache_embeddings(model, "stub") is model
+    assert "EMBEDDING_CACHE_DIR" in caplog.text
@@ -0,0 +1,31 @@
+LEGACY = {
+    "legacy-1": "The relief valve part number is VX-2200.",
+    "legacy-2": "Relief valves open at 12 bar.",
+    "legacy-3": "The feed pump part number is PX-1100.",
+}
+
+
+def test_legacy_chunks_are_fused_once(store):
+    from app.rag import hybrid_search
+
+    # Indexed before chunk ids were content-addressed: no chunk_id metadata,
+    # random vector store ids, and a keyword index backfilled from those ids
+    store.get_vectorstore().add_texts(list(LEGACY.values()), metadatas=[{"source": "legacy.pdf"}] * len(LEGACY),
+                                      ids=list(LEGACY))
+    assert "legacy-1" in store.get_keyword_index()
+
+    results = hybrid_search("relief valve VX-2200", 3)
+    texts = [doc.page_content for doc, _ in results]
+    assert len(texts) == len(set(texts)) == 3
+    assert texts[0] == LEGACY["legacy-1"]
+    # Found by both retrievers, so fused from two ranks
+    assert results[0][1] > 1 / 61
+
+
+def test_keyword_only_hits_are_read_from_the_vector_store(store, make_upload):
+    from app.rag import hybrid_search
+
+    store.process_documents([make_upload("manual.pdf", list(LEGACY.values()))])
+    results = hybrid_search("PX-1100", 3)
+    assert len({doc.metadata["chunk_id"] for doc, _ in results}) == len(results) == 3
+    assert results[0][0].page_content == LEGACY["legacy-3"]
@@ -0,0 +1,93 @@
+import pytest
+
+from app.index_bundle import (
+    BundleKeywordIndex, BundleVectorStore, IndexBundle, ReadOnlyIndexError, export_bundle, import_bundle, write_bundle
+)
+
+PAGES = {
+    "pumps.pdf": ["The feed pump part number is PX-1100.", "Replace the pump seal every 2000 hours."],
+    "valves.pdf": ["The relief valve part number is VX-2200.", "Relief valves open at 12 bar."],
+}
+QUERIES = ["feed pump part number", "pump seal hours", "relief valve bar", "VX-2200"]
+
+
+def top_id(vectorstore, embeddings, query):
+    # Only the best hit: the bundle scans exactly where Chroma's HNSW is
+    # approximate, and the stub embedder ties on unrelated chunks
+    hits = vectorstore.similarity_search_by_vector_with_relevance_scores(embeddings.embed_query(query), k=1)
+    return hits[0][0].metadata["chunk_id"]
+
+
+def test_exported_bundle_serves_the_same_results(store, make_upload, tmp_path):
+    store.process_documents([make_upload(name, pages) for name, pages in PAGES.items()])
+    embeddings = store.get_embedding_function()
+    live_vectorstore = store.get_vectorstore()
+    live_results = {query: top_id(live_vectorstore, embeddings, query) for query in QUERIES}
+    live_keyword = {query: store.get_keyword_index().search(query, 1) for query in QUERIES}
+    live_catalog = store.get_document_catalog()
+
+    exported = str(tmp_path / "export.ragbundle")
+    header = export_bundle(exported, live_vectorstore, live_catalog, "stub", parent_store=store.get_parent_store())
+    assert header["count"] == 4
+    info = import_bundle(exported, store.INDEX_BUNDLE_PATH)
+    assert info["count"] == 4
+    assert info["documents"] == 2
+
+    for resource in (store.get_vectorstore, store.get_keyword_index, store.get_index_bundle):
+        resource.clear()
+    vectorstore = store.get_vectorstore()
+    assert isinstance(vectorstore, BundleVectorStore)
+    for query in QUERIES:
+        assert top_id(vectorstore, embeddings, query) == live_results[query]
+        assert store.get_keyword_index().search(query, 1) == pytest.approx(live_keyword[query])
+    assert [(document["source"], document["content_hash"]) for document in store.get_document_catalog()] == [
+        (document["source"], document["content_hash"]) for document in live_catalog
+    ]
+
+    assert store.is_read_only()
+    with pytest.raises(ReadOnlyIndexError):
+        store.process_documents([make_upload("more.pdf", ["Anything."])])
+
+
+def test_corrupt_bundle_is_not_imported(store, make_upload, tmp_path):
+    store.process_documents([make_upload("pumps.pdf", PAGES["pumps.pdf"])])
+    exported = str(tmp_path / "export.ragbundle")
+    export_bundle(exported, store.get_vectorstore(), store.get_document_catalog(), "stub")
+
+    bundle = IndexBundle(exported)
+    offset = bundle._body_start + bundle.header["sections"]["texts"]["offset"]
+    bundle.close()
+    with open(exported, "r+b") as f:
+        f.seek(offset)
+        f.write(b"X")
+
+    target = tmp_path / "installed.ragbundle"
+    with pytest.raises(ValueError, match="corrupt"):
+        import_bundle(exported, str(target))
+    assert not target.exists()
+
+
+def test_ids_are_found_by_binary_search(store, make_upload, tmp_path):
+    store.process_documents([make_upload(name, pages) for name, pages in PAGES.items()])
+    chunk_ids = sorted(store.get_vectorstore().get()["ids"])
+    exported = str(tmp_path / "export.ragbundle")
+    header = export_bundle(exported, store.get_vectorstore(), store.get_document_catalog(), "stub")
+    assert "ids_order" in header["sections"]
+
+    # A bundle written before the order sections existed
+    bundle = IndexBundle(exported)
+    sections = {name: bundle.array(name).copy() for name in header["sections"] if not name.endswith("_order")}
+    legacy_header = {key: value for key, value in bundle.header.items() if key != "sections"}
+    bundle.close()
+    legacy = str(tmp_path / "legacy.ragbundle")
+    write_bundle(legacy, legacy_header, sections)
+
+    for path in (exported, legacy):
+        bundle = IndexBundle(path)
+        vectorstore = BundleVectorStore(bundle, store.get_embedding_function())
+        keyword_index = BundleKeywordIndex(bundle)
+        wanted = [chunk_ids[2], "missing", chunk_ids[0]]
+        assert vectorstore.get(ids=wanted)["ids"] == [chunk_ids[2], chunk_ids[0]]
+        assert all(chunk_id in keyword_index for chunk_id in chunk_ids)
+        assert "missing" not in keyword_index and "" not in keyword_index
+        bundle.close()
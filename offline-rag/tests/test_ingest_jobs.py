@@ -0,0 +1,109 @@
+import time
+
+import pytest
+
+from app.ingest_jobs import IngestJobRunner, IngestJobStore
+
+
+class Upload:
+    def __init__(self, name, data=b"%PDF"):
+        self.name = name
+        self.data = data
+
+    def getbuffer(self):
+        return memoryview(self.data)
+
+
+# Stands in for document_processor.process_documents
+class FakeIngest:
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.ingested = []
+
+    def __call__(self, documents, on_progress=None):
+        for document in documents:
+            if document.name in self.fail:
+                raise ValueError(f"{document.name} is not a PDF")
+            self.ingested.append((document.name, bytes(document.getbuffer())))
+            on_progress(document.name, pages_total=1, pages=1, chunks=2, chunks_done=2)
+        return 2
+
+
+def wait_for(store, job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = store.get_job(job_id)
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.02)
+    pytest.fail(f"job {job_id} did not finish: {store.get_job(job_id)}")
+
+
+def test_failed_file_does_not_stop_the_job(tmp_path):
+    ingest = FakeIngest(fail={"broken.pdf"})
+    runner = IngestJobRunner(IngestJobStore(str(tmp_path / "jobs.sqlite3")), ingest, str(tmp_path))
+    job_id = runner.submit([Upload("broken.pdf"), Upload("manual.pdf")])
+    job = wait_for(runner.store, job_id)
+    runner.close()
+
+    assert job["status"] == "failed"
+    assert [(f["source"], f["status"], f["error"]) for f in job["files"]] == [
+        ("broken.pdf", "failed", "broken.pdf is not a PDF"),
+        ("manual.pdf", "done", None),
+    ]
+    assert ingest.ingested == [("manual.pdf", b"%PDF")]
+    assert job["fraction"] == 1 and job["chunks_added"] == 2
+
+
+def test_abandoned_job_resumes_from_disk(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    (tmp_path / "manual.pdf").write_bytes(b"%PDF saved")
+    # A process that created the job and died before running it
+    crashed = IngestJobStore(path, lease_seconds=0)
+    crashed.create_job("job", [("manual.pdf", str(tmp_path / "manual.pdf"), 10), ("memory.pdf", None, 4)])
+    crashed.close()
+
+    ingest = FakeIngest()
+    runner = IngestJobRunner(IngestJobStore(path), ingest, str(tmp_path))
+    job = wait_for(runner.store, "job")
+    runner.close()
+
+    assert ingest.ingested == [("manual.pdf", b"%PDF saved")]
+    files = {f["source"]: f for f in job["files"]}
+    assert files["manual.pdf"]["status"] == "done"
+    assert files["memory.pdf"]["status"] == "failed"
+    assert "PERSIST_UPLOADS" in files["memory.pdf"]["error"]
+
+
+def test_live_job_of_another_process_is_left_alone(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    (tmp_path / "manual.pdf").write_bytes(b"%PDF")
+    other = IngestJobStore(path, lease_seconds=60)
+    other.create_job("job", [("manual.pdf", str(tmp_path / "manual.pdf"), 4)])
+
+    ingest = FakeIngest()
+    runner = IngestJobRunner(IngestJobStore(path, lease_seconds=0.3), ingest, str(tmp_path))
+    time.sleep(0.5)
+    assert runner.store.get_job("job")["status"] == "queued"
+    assert ingest.ingested == []
+
+    # Once the owner stops, the heartbeat picks the job up
+    other.release_jobs()
+    other.close()
+    assert wait_for(runner.store, "job")["status"] == "done"
+    runner.close()
+    assert ingest.ingested == [("manual.pdf", b"%PDF")]
+
+
+def test_only_one_process_claims_an_abandoned_job(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    crashed = IngestJobStore(path, lease_seconds=0)
+    crashed.create_job("job", [("manual.pdf", None, 4)])
+    first, second = IngestJobStore(path), IngestJobStore(path)
+
+    assert first.abandoned_jobs() == second.abandoned_jobs() == ["job"]
+    assert first.claim_job("job")
+    assert not second.claim_job("job")
+    assert second.abandoned_jobs() == []
+    assert first.renew_leases() == {"job"}
+    assert second.renew_leases() == set()
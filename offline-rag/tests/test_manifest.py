@@ -0,0 +1,45 @@
+PUMP = "The feed pump part number is PX-1100."
+VALVE = "The relief valve part number is VX-2200."
+SENSOR = "The pressure sensor part number is SX-3300."
+
+
+def indexed_ids(store, source):
+    return set(store.get_vectorstore().get(where={"source": source})["ids"])
+
+
+def test_unchanged_document_is_skipped(store, make_upload):
+    upload = make_upload("manual.pdf", [PUMP, VALVE])
+    assert store.process_documents([upload]) == 2
+    chunk_ids = store.get_manifest().chunk_ids("manual.pdf")
+
+    assert store.process_documents([upload]) == 0
+    assert store.get_manifest().chunk_ids("manual.pdf") == chunk_ids
+    assert indexed_ids(store, "manual.pdf") == chunk_ids
+
+
+def test_changed_document_reindexes_only_changed_chunks(store, make_upload):
+    store.process_documents([make_upload("manual.pdf", [PUMP, VALVE])])
+    before = store.get_manifest().chunk_ids("manual.pdf")
+
+    assert store.process_documents([make_upload("manual.pdf", [PUMP, SENSOR])]) == 1
+    after = store.get_manifest().chunk_ids("manual.pdf")
+    assert len(before & after) == 1
+    assert indexed_ids(store, "manual.pdf") == after
+
+    keyword_index = store.get_keyword_index()
+    assert keyword_index.search("VX-2200", 3) == []
+    assert [chunk_id for chunk_id, _ in keyword_index.search("SX-3300", 3)] == list(after - before)
+    assert [(document["source"], document["chunk_count"]) for document in store.get_document_catalog()] == [
+        ("manual.pdf", 2)
+    ]
+
+
+def test_remove_document_drops_its_chunks(store, make_upload):
+    store.process_documents([make_upload("manual.pdf", [PUMP]), make_upload("spares.pdf", [VALVE])])
+
+    assert store.remove_document("manual.pdf")
+    assert store.get_manifest().chunk_ids("manual.pdf") == set()
+    assert indexed_ids(store, "manual.pdf") == set()
+    assert store.get_keyword_index().search("PX-1100", 3) == []
+    assert store.get_existing_documents() == ["spares.pdf"]
+
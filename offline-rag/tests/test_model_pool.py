@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+
+from app import model_pool
+from app.model_pool import ModelPool
+
+MB = 2**20
+
+
+@pytest.fixture(autouse=True)
+def steady_rss(monkeypatch):
+    # Footprints come from the file sizes alone
+    monkeypatch.setattr(model_pool, "current_rss_bytes", lambda: 0)
+
+
+@pytest.fixture
+def gguf(tmp_path):
+    def make(name, size_mb=1):
+        path = tmp_path / f"{name}.gguf"
+        path.write_bytes(b"\0" * (size_mb * MB))
+        return str(path)
+    return make
+
+
+class Loader:
+    def __init__(self, release=None):
+        self.release = release
+        self.loaded = []
+
+    def __call__(self, path):
+        self.loaded.append(path)
+        if self.release is not None:
+            self.release.wait(5)
+        return object()
+
+
+def test_a_model_is_loaded_once_and_shared(gguf):
+    pool, loader = ModelPool(), Loader()
+    path = gguf("llama")
+    model = pool.get("Llama 3", path, loader)
+    assert pool.get("Llama 3", path, loader) is model
+    assert loader.loaded == [path]
+
+    metrics = pool.metrics()
+    assert metrics["models"]["Llama 3"]["uses"] == 2
+    assert metrics["models"]["Llama 3"]["footprint_mb"] == 1.0
+    assert metrics["budget_mb"] is None
+
+
+def test_concurrent_requests_wait_for_a_single_load(gguf):
+    release = threading.Event()
+    pool, loader = ModelPool(), Loader(release)
+    path = gguf("llama")
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(pool.get("Llama 3", path, loader)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert loader.loaded == [path]
+    assert len(results) == 4 and len({id(model) for model in results}) == 1
+
+
+def test_least_recently_used_model_is_evicted_over_budget(gguf):
+    pool, loader = ModelPool(max_ram_mb=2), Loader()
+    pool.get("a", gguf("a"), loader)
+    pool.get("b", gguf("b"), loader)
+    pool.get("a", gguf("a"), loader)
+    pool.get("c", gguf("c"), loader)
+
+    assert pool.loaded_models() == ["a", "c"]
+    assert pool.evictions == 1
+    assert pool.metrics()["used_mb"] == 2.0
+
+
+def test_a_model_larger_than_the_budget_still_loads(gguf):
+    pool, loader = ModelPool(max_ram_mb=1), Loader()
+    pool.get("a", gguf("a"), loader)
+    pool.get("big", gguf("big", size_mb=2), loader)
+    # Everything else is evicted to make what room there is
+    assert pool.loaded_models() == ["big"]
+
+
+def test_failed_warm_up_does_not_stop_the_others(gguf):
+    def loader(path):
+        if "broken" in path:
+            raise RuntimeError("bad magic")
+        return object()
+
+    pool = ModelPool()
+    pool.warm_up({"broken": gguf("broken"), "llama": gguf("llama")}, loader)
+    assert pool.loaded_models() == ["llama"]
+    assert pool.evict("llama") and not pool.evict("llama")
@@ -0,0 +1,93 @@
+import pytest
+from langchain_core.documents import Document
+
+from app.parent_store import ParentStore
+
+SECTIONS = [
+    ("p1", "a.pdf", 0, 0, "Section one covers the feed pump and its part number PX-1100."),
+    ("p2", "a.pdf", 0, 1, "Section two covers the seal, replaced every 2000 hours."),
+    ("p3", "a.pdf", 1, 0, "Section three covers the relief valve VX-2200."),
+    ("q1", "b.pdf", 0, 0, "The pressure sensor part number is SX-3300."),
+]
+
+
+@pytest.fixture
+def rag(store):
+    from app import rag
+    return rag
+
+
+@pytest.fixture
+def parent_store(tmp_path):
+    parent_store = ParentStore(str(tmp_path / "parents.sqlite3"))
+    parent_store.add_many(SECTIONS)
+    yield parent_store
+    parent_store.close()
+
+
+def child(parent_id, text="child"):
+    return Document(page_content=text, metadata={"parent_id": parent_id, "chunk_id": f"{parent_id}-{text}"})
+
+
+def texts(scored_docs):
+    return [doc.page_content for doc, _ in scored_docs]
+
+
+def test_children_are_swapped_for_distinct_parents(rag, parent_store):
+    hits = [(child("p3"), 0.9), (child("p3", "other"), 0.8), (child("q1"), 0.7), (child("p1"), 0.6)]
+    expanded = rag.expand_to_parents(parent_store, hits, limit=2)
+    # The second child of p3 does not use up a place
+    assert texts(expanded) == [SECTIONS[2][4], SECTIONS[3][4]]
+    assert [score for _, score in expanded] == [0.9, 0.7]
+    assert expanded[0][0].metadata["parent_ids"] == ["p3"]
+
+
+def test_neighbouring_parents_are_merged_in_reading_order(rag, parent_store):
+    hits = [(child("p3"), 0.9), (child("q1"), 0.8), (child("p1"), 0.7), (child("p2"), 0.6)]
+    expanded = rag.expand_to_parents(parent_store, hits, limit=4)
+    # p1, p2 and p3 are consecutive sections, so they become one passage at
+    # p3's rank, followed by the sensor section
+    assert texts(expanded) == ["\n".join(section[4] for section in SECTIONS[:3]), SECTIONS[3][4]]
+    merged = expanded[0][0]
+    assert merged.metadata["parent_ids"] == ["p1", "p2", "p3"]
+    assert (merged.metadata["parent_id"], merged.metadata["page"], expanded[0][1]) == ("p3", 0, 0.9)
+
+
+def test_parents_with_a_gap_stay_apart(rag, parent_store):
+    expanded = rag.expand_to_parents(parent_store, [(child("p1"), 0.9), (child("p3"), 0.8)], limit=4)
+    assert texts(expanded) == [SECTIONS[0][4], SECTIONS[2][4]]
+
+
+def test_chunks_without_a_parent_are_kept(rag, parent_store):
+    legacy = Document(page_content="Indexed before parents existed.", metadata={"source": "old.pdf"})
+    expanded = rag.expand_to_parents(parent_store, [(legacy, 0.9), (child("missing"), 0.8), (child("q1"), 0.7)],
+                                     limit=3)
+    assert texts(expanded) == ["Indexed before parents existed.", "child", SECTIONS[3][4]]
+
+
+def test_merging_drops_the_overlap_between_parents(rag):
+    shared = "seal every 2000 hours of service"
+    run = [
+        (1, 0.5, {"parent_id": "a", "source": "a.pdf", "page": 0, "text": f"Replace the {shared}"}),
+        (0, 0.9, {"parent_id": "b", "source": "a.pdf", "page": 0, "text": f"{shared}, or sooner."}),
+    ]
+    passage = rag.merge_parents(run, max_overlap=len(shared))
+    assert passage["doc"].page_content == f"Replace the {shared}\n, or sooner."
+    assert (passage["rank"], passage["score"], passage["doc"].metadata["parent_id"]) == (0, 0.9, "b")
+    assert rag.merge_parents(run, max_overlap=0)["doc"].page_content == f"Replace the {shared}\n{shared}, or sooner."
+
+
+def test_context_is_built_from_parent_sections(rag, store, make_upload, monkeypatch):
+    for key, value in (("chunk_size", 60), ("chunk_overlap", 0), ("parent_chunk_size", 400)):
+        monkeypatch.setitem(store.config, key, value)
+        monkeypatch.setitem(rag.config, key, value)
+    page = ("The feed pump part number is PX-1100. Replace its seal every 2000 hours. "
+            "Check the bearings monthly and log the vibration readings.")
+    store.process_documents([make_upload("pumps.pdf", [page])])
+    assert len(store.get_parent_store()) == 1
+    assert len(store.get_vectorstore().get()["ids"]) > 1
+
+    rag.query_cache.results.clear()
+    context, accounting = rag.build_context("bearings vibration", top_k=1)
+    assert "PX-1100" in context and "vibration" in context
+    assert len(accounting["chunks"]) == 1
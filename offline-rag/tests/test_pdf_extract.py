@@ -0,0 +1,45 @@
+import gc
+import os
+
+import pytest
+
+from app.benchmark import make_pdf
+from app.pdf_extract import EmptyDocumentError, count_pages, extract_page_range
+
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc")
+def test_mapped_files_are_closed(tmp_path):
+    path = tmp_path / "manual.pdf"
+    path.write_bytes(make_pdf([["The feed pump part number is PX-1100."], ["Relief valves open at 12 bar."]]))
+    # Without the collector, a mapping is only closed if extraction closes it
+    gc.disable()
+    try:
+        before = open_fds()
+        for _ in range(20):
+            assert count_pages(str(path)) == 2
+            pages, _ = extract_page_range(str(path), 0, 2)
+        assert open_fds() == before
+    finally:
+        gc.enable()
+    assert [page for page, _ in pages] == [0, 1]
+    assert "PX-1100" in pages[0][1]
+
+
+def test_empty_files_are_reported(tmp_path):
+    path = tmp_path / "empty.pdf"
+    path.write_bytes(b"")
+    with pytest.raises(EmptyDocumentError, match="empty.pdf is empty"):
+        count_pages(str(path))
+    with pytest.raises(EmptyDocumentError):
+        extract_page_range(memoryview(b""), 0, 1)
+
+
+def test_empty_upload_does_not_stop_the_others(store, make_upload):
+    empty = store.UploadedDocument("empty.pdf", b"")
+    with pytest.raises(EmptyDocumentError, match="empty.pdf"):
+        store.process_documents([empty, make_upload("manual.pdf", ["The feed pump part number is PX-1100."])])
+    assert store.get_existing_documents() == ["manual.pdf"]
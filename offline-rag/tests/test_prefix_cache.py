@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import pytest
+
+from app.prefix_cache import PrefixCache, state_bytes
+
+from conftest import FakeModel
+
+SYSTEM = [1, 2, 3, 4]
+CONTEXT = [5, 6, 7, 8, 9]
+QUESTION = [10, 11]
+
+
+def test_prefix_state_is_restored_after_another_prompt():
+    model = FakeModel()
+    cache = PrefixCache(model, max_bytes=2**20)
+    prompt = SYSTEM + CONTEXT + QUESTION
+    assert cache.prepare(prompt, [SYSTEM, SYSTEM + CONTEXT]) == len(SYSTEM + CONTEXT)
+    assert model.evaluated == len(SYSTEM + CONTEXT)
+    assert cache.stats()["entries"] == 2
+
+    model.reset()
+    model.eval([20, 21, 22, 23, 24, 25, 26, 27, 28, 29])
+    evaluated = model.evaluated
+    assert cache.prepare(prompt, [SYSTEM, SYSTEM + CONTEXT]) == len(SYSTEM + CONTEXT)
+    assert model.evaluated == evaluated
+    assert model.evaluated_tokens() == SYSTEM + CONTEXT
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_prefix_cache_extends_the_shorter_cached_prefix():
+    model = FakeModel()
+    cache = PrefixCache(model, max_bytes=2**20)
+    cache.prepare(SYSTEM + CONTEXT + QUESTION, [SYSTEM, SYSTEM + CONTEXT])
+
+    other_context = [30, 31, 32]
+    model.reset()
+    evaluated = model.evaluated
+    assert cache.prepare(SYSTEM + other_context + QUESTION, [SYSTEM, SYSTEM + other_context]) == 7
+    # Only the new context is evaluated on top of the cached system prompt
+    assert model.evaluated - evaluated == len(other_context)
+    assert model.evaluated_tokens() == SYSTEM + other_context
+
+
+def test_stale_input_ids_are_not_a_live_prefix():
+    model = FakeModel()
+    # Too small to keep any state, so only the live KV cache can help
+    cache = PrefixCache(model, max_bytes=0)
+    prompt = SYSTEM + CONTEXT + QUESTION
+    cache.prepare(prompt, [SYSTEM + CONTEXT])
+    model.reset()
+
+    evaluated = model.evaluated
+    assert cache.prepare(prompt, [SYSTEM + CONTEXT]) == len(SYSTEM + CONTEXT)
+    assert model.evaluated - evaluated == len(SYSTEM + CONTEXT)
+    assert cache.misses == 2
+
+
+def test_budget_counts_the_whole_state():
+    model = FakeModel()
+    size = state_bytes(model.save_state())
+    assert size == 1000 + model.scores.nbytes + model.input_ids.nbytes
+
+    cache = PrefixCache(model, max_bytes=size - 1)
+    cache.prepare(SYSTEM + CONTEXT + QUESTION, [SYSTEM + CONTEXT])
+    assert cache.stats()["entries"] == 0
+
+    model = FakeModel()
+    cache = PrefixCache(model, max_bytes=size)
+    cache.prepare(SYSTEM + CONTEXT + QUESTION, [SYSTEM, SYSTEM + CONTEXT])
+    assert cache.stats()["entries"] == 1
+
+
+@pytest.mark.skipif(not os.environ.get("TEST_GGUF_PATH"), reason="TEST_GGUF_PATH is not set")
+def test_restored_prefix_matches_a_fresh_prefill():
+    llama_cpp = pytest.importorskip("llama_cpp")
+    model = llama_cpp.Llama(model_path=os.environ["TEST_GGUF_PATH"], n_ctx=256, verbose=False)
+    system = model.tokenize(b"You answer questions about pump maintenance manuals.")
+    prompt = system + model.tokenize(b" How often is the seal replaced?", add_bos=False)
+
+    def next_token():
+        return int(np.argmax(model.scores[model.n_tokens - 1]))
+
+    model.reset()
+    model.eval(prompt)
+    expected = next_token()
+
+    cache = PrefixCache(model, max_bytes=2**30)
+    cache.prepare(prompt, [system])
+    model.reset()
+    model.eval(model.tokenize(b"Something else entirely."))
+    assert cache.prepare(prompt, [system]) == len(system)
+    model.eval(prompt[model.n_tokens:])
+    assert next_token() == expected
@@ -0,0 +1,144 @@
+import os
+
+import numpy as np
+import pytest
+
+from app import quantized_store
+from app.quantized_store import QuantizedVectorStore
+from app.stub_embeddings import HashingEmbeddings
+
+TEXTS = {
+    "pump": "feed pump part number PX-1100",
+    "valve": "relief valve part number VX-2200",
+    "sensor": "pressure sensor part number SX-3300",
+}
+
+
+@pytest.fixture(params=["int8", "binary"])
+def open_store(request, tmp_path):
+    embeddings = HashingEmbeddings()
+    stores = []
+
+    def open_store():
+        # rescore_factor covers the whole store, so results are exact
+        store = QuantizedVectorStore(str(tmp_path / "quantized"), embeddings, quantization=request.param,
+                                     rescore_factor=100)
+        stores.append(store)
+        return store
+    yield open_store
+    for store in stores:
+        store.close()
+
+
+def add(store, names):
+    store.add_texts([TEXTS[name] for name in names], metadatas=[{"source": f"{name}.pdf"} for name in names],
+                    ids=list(names))
+
+
+def top_hit(store, text):
+    embedding = store.embedding_function.embed_query(text)
+    return store.similarity_search_by_vector_with_relevance_scores(embedding, k=1)[0][0].page_content
+
+
+def test_search_survives_reopen(open_store):
+    store = open_store()
+    add(store, TEXTS)
+    for text in TEXTS.values():
+        assert top_hit(store, text) == text
+
+    reopened = open_store()
+    assert sorted(reopened.get()["ids"]) == sorted(TEXTS)
+    for text in TEXTS.values():
+        assert top_hit(reopened, text) == text
+
+
+def test_upsert_replaces_text_and_vector(open_store):
+    store = open_store()
+    add(store, ["pump", "valve"])
+    store.add_texts(["backup generator part number GX-4400"], metadatas=[{"source": "pump.pdf"}], ids=["pump"])
+
+    result = store.get(ids=["pump"], include=["documents", "embeddings"])
+    assert result["documents"] == ["backup generator part number GX-4400"]
+    expected = np.asarray(store.embedding_function.embed_query("backup generator part number GX-4400"))
+    assert np.allclose(result["embeddings"][0], expected, atol=1e-6)
+    assert store.memory_stats()["vectors"] == 2
+    assert top_hit(store, "backup generator GX-4400") == "backup generator part number GX-4400"
+
+
+def test_delete_and_compact(open_store, monkeypatch):
+    monkeypatch.setattr(quantized_store, "COMPACT_MIN_DEAD", 1)
+    store = open_store()
+    add(store, TEXTS)
+    store.delete(ids=["pump"])
+    store.persist()
+
+    assert store.memory_stats()["tombstones"] == 0
+    assert sorted(store.get()["ids"]) == ["sensor", "valve"]
+    assert store.get(where={"source": "pump.pdf"})["ids"] == []
+    for name in ("valve", "sensor"):
+        assert top_hit(store, TEXTS[name]) == TEXTS[name]
+    reopened = open_store()
+    assert reopened.memory_stats()["vectors"] == 2
+    assert top_hit(reopened, TEXTS["sensor"]) == TEXTS["sensor"]
+
+
+def test_failed_add_keeps_rows_aligned(open_store):
+    store = open_store()
+    add(store, ["pump"])
+    with pytest.raises(Exception):
+        # Duplicate ids in one batch violate the rows table's unique chunk_id
+        store.add_texts(["one", "two"], ids=["dup", "dup"])
+    add(store, ["sensor"])
+
+    for current in (store, open_store()):
+        assert sorted(current.get()["ids"]) == ["pump", "sensor"]
+        embedding = current.get(ids=["sensor"], include=["embeddings"])["embeddings"][0]
+        assert np.allclose(embedding, current.embedding_function.embed_query(TEXTS["sensor"]), atol=1e-6)
+        assert top_hit(current, TEXTS["sensor"]) == TEXTS["sensor"]
+
+
+def test_failed_upsert_keeps_the_replaced_row(open_store):
+    store = open_store()
+    add(store, ["pump", "valve"])
+    with pytest.raises(Exception):
+        store.add_texts(["one", "two"], ids=["pump", "pump"])
+
+    for current in (store, open_store()):
+        assert current.get(ids=["pump"])["documents"] == [TEXTS["pump"]]
+        assert current.memory_stats()["vectors"] == 2
+        assert top_hit(current, TEXTS["pump"]) == TEXTS["pump"]
+
+
+def test_interrupted_compaction_is_completed_on_open(open_store, monkeypatch):
+    monkeypatch.setattr(quantized_store, "COMPACT_MIN_DEAD", 1)
+    store = open_store()
+    add(store, TEXTS)
+
+    # The renumbering commits, then the process dies before moving the files
+    def crash(*args):
+        raise OSError("killed")
+    with monkeypatch.context() as patch:
+        patch.setattr(quantized_store.os, "replace", crash)
+        with pytest.raises(OSError):
+            store.delete(ids=["pump"])
+
+    reopened = open_store()
+    stats = reopened.memory_stats()
+    assert (stats["vectors"], stats["tombstones"]) == (2, 0)
+    assert sorted(reopened.get()["ids"]) == ["sensor", "valve"]
+    for name in ("valve", "sensor"):
+        assert top_hit(reopened, TEXTS[name]) == TEXTS[name]
+
+
+def test_compaction_files_from_before_the_commit_are_discarded(open_store):
+    store = open_store()
+    add(store, TEXTS)
+    store.close()
+    directory = store.directory
+    with open(os.path.join(directory, "vectors.f32.tmp"), "wb") as f:
+        f.write(b"partial")
+
+    reopened = open_store()
+    assert sorted(reopened.get()["ids"]) == sorted(TEXTS)
+    assert top_hit(reopened, TEXTS["valve"]) == TEXTS["valve"]
+    assert not any(name.endswith(".tmp") for name in os.listdir(directory))
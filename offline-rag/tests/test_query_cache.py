@@ -0,0 +1,74 @@
+import pytest
+
+from app.manifest import IngestManifest
+from app.query_cache import LRUCache, normalize_query
+
+PUMP = "The feed pump part number is PX-1100."
+VALVE = "The relief valve part number is VX-2200."
+
+
+@pytest.fixture
+def rag(store):
+    from app import rag
+    rag.query_cache.results.clear()
+    rag.query_cache.embeddings.clear()
+    yield rag
+    rag.query_cache.results.clear()
+    rag.query_cache.embeddings.clear()
+
+
+def sources(scored_docs):
+    return [doc.metadata["source"] for doc, _ in scored_docs]
+
+
+def test_repeated_query_is_served_from_the_cache(rag, store, make_upload):
+    store.process_documents([make_upload("pumps.pdf", [PUMP])])
+    first = rag.retrieve_documents("Feed pump part number?", 3)
+    hits = rag.query_cache.results.hits
+
+    assert rag.retrieve_documents("  feed PUMP part   number ", 3) is first
+    assert rag.query_cache.results.hits == hits + 1
+    # A different top_k is a different result
+    rag.retrieve_documents("feed pump part number", 2)
+    assert rag.query_cache.results.hits == hits + 1
+
+
+def test_ingesting_invalidates_cached_results(rag, store, make_upload):
+    store.process_documents([make_upload("pumps.pdf", [PUMP])])
+    assert sources(rag.retrieve_documents("relief valve VX-2200", 3)) == ["pumps.pdf"]
+
+    store.process_documents([make_upload("valves.pdf", [VALVE])])
+    assert sources(rag.retrieve_documents("relief valve VX-2200", 3))[0] == "valves.pdf"
+
+    store.remove_document("valves.pdf")
+    assert sources(rag.retrieve_documents("relief valve VX-2200", 3)) == ["pumps.pdf"]
+
+
+def test_change_in_another_process_invalidates_cached_results(rag, store, make_upload):
+    store.process_documents([make_upload("pumps.pdf", [PUMP])])
+    rag.retrieve_documents("feed pump", 3)
+    generation = rag.get_collection_generation()
+
+    # What another process sharing chroma_db records when it changes the collection
+    other = IngestManifest(store.MANIFEST_PATH)
+    other.bump_collection_version()
+    other.close()
+    misses = rag.query_cache.results.misses
+    rag.retrieve_documents("feed pump", 3)
+    assert rag.get_collection_generation() > generation
+    assert rag.query_cache.results.misses == misses + 1
+
+
+def test_lru_evicts_the_least_recently_used():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+    assert cache.stats() == {"hits": 3, "misses": 1, "size": 2}
+
+
+def test_normalize_query_ignores_case_spacing_and_end_punctuation():
+    assert normalize_query("  How often is the SEAL\treplaced?! ") == "how often is the seal replaced"
+    assert normalize_query("PX-1100.") != normalize_query("PX-1101")
@@ -0,0 +1,74 @@
+import threading
+
+from langchain_core.documents import Document
+
+from app.reranker import BudgetedReranker, MMRReranker
+from app.stub_embeddings import HashingEmbeddings
+
+
+def scored(*texts):
+    return [(Document(page_content=text), 1.0 - rank / 10) for rank, text in enumerate(texts)]
+
+
+def texts(scored_docs):
+    return [doc.page_content for doc, _ in scored_docs]
+
+
+# Reverses the candidates, optionally waiting for a release first
+class ReverseReranker:
+    def __init__(self, release=None):
+        self.release = release
+        self.calls = 0
+
+    def rerank(self, query, scored_docs):
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait(5)
+        return list(reversed(scored_docs))
+
+
+class FailingReranker:
+    def rerank(self, query, scored_docs):
+        raise RuntimeError("model missing")
+
+
+def test_mmr_prefers_a_diverse_second_pick():
+    docs = scored("pump seal replacement interval", "pump seal replacement interval hours",
+                  "pump bearing lubrication")
+    reranked = MMRReranker(HashingEmbeddings(), lambda_mult=0.3).rerank("pump seal replacement", docs)
+    assert texts(reranked)[:2] == ["pump seal replacement interval", "pump bearing lubrication"]
+
+    # Relevance alone keeps the near-duplicate second
+    reranked = MMRReranker(HashingEmbeddings(), lambda_mult=1.0).rerank("pump seal replacement", docs)
+    assert texts(reranked)[1] == "pump seal replacement interval hours"
+
+
+def test_reranking_within_budget_is_applied():
+    reranker = BudgetedReranker(ReverseReranker(), budget_ms=5000)
+    reranked, applied = reranker.rerank("q", scored("a", "b", "c"))
+    assert applied and texts(reranked) == ["c", "b", "a"]
+    # A single candidate has nothing to reorder
+    assert reranker.rerank("q", scored("a")) == (scored("a"), False)
+
+
+def test_overrun_keeps_first_stage_order_and_skips_until_it_finishes():
+    release = threading.Event()
+    inner = ReverseReranker(release)
+    reranker = BudgetedReranker(inner, budget_ms=20)
+    docs = scored("a", "b", "c")
+
+    assert reranker.rerank("q", docs) == (docs, False)
+    assert reranker.timeouts == 1
+    # Still running: not queued behind it
+    assert reranker.rerank("q", docs) == (docs, False)
+    assert (reranker.skipped, inner.calls) == (1, 1)
+
+    release.set()
+    reranker._overrun.result(timeout=5)
+    reranked, applied = reranker.rerank("q", docs)
+    assert applied and texts(reranked) == ["c", "b", "a"]
+
+
+def test_failed_reranking_keeps_first_stage_order():
+    docs = scored("a", "b")
+    assert BudgetedReranker(FailingReranker(), budget_ms=1000).rerank("q", docs) == (docs, False)
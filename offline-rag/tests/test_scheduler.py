@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+
+from app.scheduler import GenerationScheduler
+from app.telemetry import start_trace
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return
+        time.sleep(0.01)
+    pytest.fail("timed out")
+
+
+# A generation that yields one piece and then waits until it is closed or
+# released, recording what happened to it
+class SlowGeneration:
+    def __init__(self, pieces=("Replace", " the", " seal.")):
+        self.pieces = pieces
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.closed = threading.Event()
+
+    def __call__(self):
+        self.started.set()
+        try:
+            for index, piece in enumerate(self.pieces):
+                if index:
+                    self.release.wait(5)
+                yield piece
+        finally:
+            self.closed.set()
+
+
+def test_sessions_are_served_round_robin():
+    scheduler = GenerationScheduler("test")
+    blocker = SlowGeneration(pieces=("a", "b"))
+    order = []
+
+    def generation(name):
+        def make_stream():
+            order.append(name)
+            yield name
+        return make_stream
+
+    streams = [scheduler.stream("x", blocker)]
+    blocker.started.wait(5)
+    for session_id, name in (("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("c", "c1"), ("b", "b2")):
+        streams.append(scheduler.stream(session_id, generation(name)))
+    blocker.release.set()
+    for stream in streams:
+        list(stream)
+    assert order == ["a1", "b1", "c1", "a2", "b2", "a3"]
+    assert scheduler.metrics()["completed"] == 7
+
+
+def test_closing_a_running_stream_cancels_the_generation():
+    scheduler = GenerationScheduler("test")
+    generation = SlowGeneration()
+    stream = scheduler.stream("a", generation)
+    assert next(stream) == "Replace"
+
+    stream.close()
+    generation.release.set()
+    assert generation.closed.wait(5)
+    wait_until(lambda: scheduler.metrics()["cancelled"] == 1)
+    assert scheduler.metrics()["completed"] == 0
+
+
+def test_dropping_a_queued_stream_skips_its_generation():
+    scheduler = GenerationScheduler("test")
+    blocker = SlowGeneration(pieces=("a", "b"))
+    running = scheduler.stream("x", blocker)
+    blocker.started.wait(5)
+
+    queued = SlowGeneration()
+    stream = scheduler.stream("a", queued)
+    del stream
+    blocker.release.set()
+    assert list(running) == ["a", "b"]
+    wait_until(lambda: scheduler.metrics()["cancelled"] == 1)
+    assert not queued.started.is_set()
+
+
+class FakeModelHandler:
+    def __init__(self, scheduler, generation):
+        self.scheduler = scheduler
+        self.generation = generation
+        # Kept alive so only an explicit close, not garbage collection, can
+        # cancel the generation
+        self.streams = []
+
+    def generate_stream(self, prompt, model_choice, cache_prefixes=None, session_id=None, trace=None,
+                        session_prefix=None):
+        stream = self.scheduler.stream(session_id, self.generation)
+        self.streams.append(stream)
+        return stream
+
+
+def test_closing_the_answer_stream_cancels_the_scheduler_slot(store):
+    from app.rag import stream_answer
+
+    scheduler = GenerationScheduler("test")
+    generation = SlowGeneration()
+    trace = start_trace("chat")
+    model_handler = FakeModelHandler(scheduler, generation)
+    stream, cached = stream_answer(model_handler, "Mistral", "How often?", "prompt", session_id="a")
+    assert not cached
+    assert next(stream) == "Replace"
+
+    # The answer cache and telemetry wrappers pass the close through
+    stream.close()
+    generation.release.set()
+    assert generation.closed.wait(5)
+    wait_until(lambda: scheduler.metrics()["cancelled"] == 1)
+    assert trace.status == "cancelled"
+    # A cancelled answer is not cached
+    assert store.get_answer_cache().lookup("Mistral", "", "", "How often?") is None
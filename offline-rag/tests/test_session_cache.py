@@ -0,0 +1,41 @@
+from app.prefix_cache import SessionCache
+
+from conftest import FakeModel
+
+SYSTEM = [1, 2, 3, 4]
+CONTEXT = [5, 6, 7, 8, 9]
+QUESTION = [10, 11]
+
+
+def test_session_state_is_restored_after_another_session():
+    model = FakeModel()
+    cache = SessionCache(model, max_bytes=2**20)
+    history = SYSTEM + [40, 41, 42]
+    assert cache.prepare("alice", history + QUESTION, history) == len(history)
+
+    model.reset()
+    cache.prepare("bob", SYSTEM + [50, 51] + QUESTION, SYSTEM + [50, 51])
+    evaluated = model.evaluated
+    assert cache.prepare("alice", history + CONTEXT + QUESTION, history) == len(history)
+    assert model.evaluated == evaluated
+    assert model.evaluated_tokens() == history
+    assert cache.stats()["sessions"] == 2
+
+    cache.drop("alice")
+    assert cache.stats()["sessions"] == 1
+
+
+def test_session_cache_extends_the_previous_turn():
+    model = FakeModel()
+    cache = SessionCache(model, max_bytes=2**20)
+    history = SYSTEM + [40, 41]
+    cache.prepare("alice", history + QUESTION, history)
+    model.reset()
+
+    longer = history + QUESTION + [60, 61]
+    evaluated = model.evaluated
+    assert cache.prepare("alice", longer + [62], longer) == len(longer)
+    # The earlier conversation comes from the saved state
+    assert model.evaluated - evaluated == len(longer) - len(history)
+    assert model.evaluated_tokens() == longer
+    assert cache.hits == 1
@@ -0,0 +1,111 @@
+import types
+
+import numpy as np
+
+from app import speculative
+from app.speculative import GGUFDraftModel, SpeculativeStats
+
+EOS = 99
+
+
+# Stands in for a small Llama: greedy sampling continues counting up from the
+# last evaluated token, and the KV cache is the evaluated prefix
+class CountingLlama:
+    def __init__(self, n_ctx=64, eos_after=None):
+        self.input_ids = []
+        self.n_tokens = 0
+        self.evaluated = []
+        self._n_ctx = n_ctx
+        self.eos_after = eos_after
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def token_eos(self):
+        return EOS
+
+    def eval(self, tokens):
+        self.evaluated.append(list(tokens))
+        self.input_ids = self.input_ids[:self.n_tokens] + list(tokens)
+        self.n_tokens = len(self.input_ids)
+
+    def sample(self, temp):
+        last = self.input_ids[self.n_tokens - 1]
+        return EOS if last == self.eos_after else last + 1
+
+
+class FixedDraft:
+    def __init__(self, *drafts):
+        self.drafts = list(drafts)
+
+    def __call__(self, input_ids, **kwargs):
+        return np.array(self.drafts.pop(0), dtype=np.intc)
+
+
+def ids(*tokens):
+    return np.array(tokens, dtype=np.intc)
+
+
+def test_draft_model_only_evaluates_tokens_accepted_since_the_last_call():
+    model = CountingLlama()
+    draft = GGUFDraftModel(model, num_pred_tokens=3)
+    assert draft(ids(1, 2, 3)).tolist() == [4, 5, 6]
+    assert model.evaluated == [[1, 2, 3], [4], [5]]
+
+    # The target kept 4 and 5, then sampled 7 itself
+    model.evaluated.clear()
+    assert draft(ids(1, 2, 3, 4, 5, 7)).tolist() == [8, 9, 10]
+    assert model.evaluated == [[7], [8], [9]]
+
+
+def test_draft_stops_at_end_of_sequence_and_context_limit():
+    assert GGUFDraftModel(CountingLlama(eos_after=4), num_pred_tokens=4)(ids(1, 2, 3)).tolist() == [4]
+    model = CountingLlama(n_ctx=6)
+    assert GGUFDraftModel(model, num_pred_tokens=4)(ids(1, 2, 3)).tolist() == []
+    assert model.evaluated == []
+
+
+def test_accepted_tokens_are_counted_from_input_growth():
+    stats = SpeculativeStats(FixedDraft([11, 12, 13, 14], [21, 22], [], [31]), "draft-model")
+    before = stats.snapshot()
+    stats(ids(*range(10)))
+    # Two drafted tokens kept plus the one the target sampled
+    stats(ids(*range(13)))
+    # Both kept, plus the target's own token
+    stats(ids(*range(16)))
+    stats(ids(*range(17)))
+
+    assert (stats.proposed, stats.accepted) == (6, 4)
+    figures = stats.since(before, tokens_generated=8)
+    assert figures["acceptance_rate"] == round(4 / 6, 3)
+    assert figures["tokens_per_target_pass"] == 2.0
+
+    # A draft from an earlier generation is never verified
+    stats = SpeculativeStats(FixedDraft([1, 2], []), "prompt-lookup")
+    stats(ids(1))
+    stats.start()
+    stats(ids(1, 2, 3))
+    assert stats.summary()["proposed_tokens"] == 0
+
+
+def test_speculative_llama_samples_at_the_requested_row(monkeypatch):
+    monkeypatch.setattr(speculative, "_speculative_llama_class", None)
+
+    class Llama:
+        def __init__(self, sampler):
+            self._sampler = sampler
+            self._ctx = "ctx"
+            self.n_tokens = 10
+
+        def sample(self, *args, idx=None, **kwargs):
+            return "last row"
+
+    class Sampler:
+        def sample(self, ctx, idx):
+            return ctx, idx
+
+    cls = speculative.get_speculative_llama_class(types.SimpleNamespace(Llama=Llama))
+    assert speculative.get_speculative_llama_class(types.SimpleNamespace(Llama=object)) is cls
+    assert cls(Sampler()).sample(idx=12) == ("ctx", 2)
+    assert cls(Sampler()).sample() == "last row"
+    assert cls(None).sample(idx=12) == "last row"
@@ -0,0 +1,64 @@
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+from app.sweep import dominates, format_table, load_questions, pareto_front, run_setting, write_synthetic_corpus
+
+
+def row(top_k, recall, tokens, p50):
+    return {"chunk_size": 500, "chunk_overlap": 50, "parent_chunk_size": 0, "top_k": top_k, "recall": recall,
+            "mean_prompt_tokens": tokens, "p50_ms": p50, "p99_ms": p50 * 2}
+
+
+def test_pareto_front_keeps_only_undominated_settings():
+    best_recall = row(5, 1.0, 900.0, 3.0)
+    cheapest = row(1, 0.6, 200.0, 2.0)
+    balanced = row(3, 0.9, 500.0, 2.5)
+    worse = row(4, 0.9, 600.0, 2.5)
+    tie = dict(balanced, chunk_size=1000)
+    unscored = row(2, None, 300.0, 1.0)
+
+    assert dominates(balanced, worse) and not dominates(worse, balanced)
+    # Equal on every objective: neither dominates
+    assert not dominates(balanced, tie)
+    front = pareto_front([cheapest, worse, balanced, best_recall, tie, unscored])
+    assert front == [best_recall, balanced, tie, cheapest]
+    assert len(format_table(front).splitlines()) == 2 + len(front)
+
+
+def test_synthetic_corpus_has_a_question_per_fact(tmp_path):
+    args = SimpleNamespace(docs=2, pages=2, facts_per_doc=2, seed=0)
+    corpus_dir, questions_path = write_synthetic_corpus(str(tmp_path), args)
+    assert len(list((tmp_path / "corpus").glob("*.pdf"))) == 2
+    questions = load_questions(questions_path)
+    assert len(questions) == 4
+    assert len({answer for _, answer in questions}) == 4
+
+
+@pytest.fixture
+def root_log_level():
+    level = logging.getLogger().level
+    yield
+    logging.getLogger().setLevel(level)
+
+
+def test_setting_is_scored_for_each_top_k(store, tmp_path, monkeypatch, root_log_level):
+    from app import rag
+    # run_setting overrides the module configs for the life of its process
+    monkeypatch.setattr(store, "config", dict(store.config))
+    monkeypatch.setattr(rag, "config", dict(rag.config))
+    corpus_dir, questions_path = write_synthetic_corpus(
+        str(tmp_path), SimpleNamespace(docs=2, pages=2, facts_per_doc=2, seed=0))
+    options = {
+        "workdir": str(tmp_path / "runs"), "models_dir": None, "corpus": corpus_dir, "questions": questions_path,
+        "embedding_model": "stub", "vector_storage": "chroma", "hybrid_search": True,
+        "embedding_cache_dir": str(tmp_path / "embedding_cache"),
+    }
+
+    rows = run_setting((300, 0, 0, [1, 5], options))
+    assert [r["top_k"] for r in rows] == [1, 5]
+    assert all(r["chunks"] > 0 and r["token_counter"] == "chars/4" for r in rows)
+    assert rows[0]["mean_prompt_tokens"] < rows[1]["mean_prompt_tokens"]
+    assert 0 <= rows[0]["recall"] <= rows[1]["recall"] <= 1
+    assert rows[0]["p50_ms"] > 0
@@ -0,0 +1,102 @@
+import json
+
+import pytest
+
+from app.telemetry import Telemetry, record_cache, record_generation, start_trace, timed, trace_stream
+
+
+@pytest.fixture
+def telemetry(tmp_path):
+    telemetry = Telemetry(str(tmp_path / "telemetry" / "requests.jsonl"))
+    yield telemetry
+    telemetry.close()
+
+
+def read_records(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_trace_collects_stages_caches_and_generation(telemetry):
+    trace = start_trace("chat", question="What is the pump part number?")
+    for _ in range(2):
+        with timed("vector_search"):
+            pass
+    record_cache("query", False)
+    # Only the first lookup counts
+    record_cache("query", True)
+    record_generation(trace, prompt_tokens=120, tokens_generated=10, ttft=0.2,
+                      token_gaps=[0.01, 0.02, 0.03], total_seconds=0.5)
+
+    record = telemetry.write(trace)
+    assert record["status"] == "ok" and record["kind"] == "chat"
+    assert record["question"] == "What is the pump part number?"
+    assert list(record["seconds"]) == ["vector_search"]
+    assert record["cache"] == {"query": "miss"}
+    assert record["generation"]["tokens_per_second"] == 20.0
+    assert record["generation"]["inter_token_ms"]["max"] == 30.0
+    assert read_records(telemetry.path) == [record]
+
+
+def test_a_finished_trace_is_written_once_and_stops_collecting(telemetry):
+    trace = start_trace("chat")
+    assert telemetry.write(trace, "error")["status"] == "error"
+    assert telemetry.write(trace) is None
+
+    with timed("vector_search"):
+        pass
+    assert trace.seconds == {}
+    assert len(read_records(telemetry.path)) == 1
+
+
+def test_prometheus_counters_and_cumulative_buckets(telemetry):
+    for cache_hit in (False, True):
+        trace = start_trace("chat")
+        record_cache("answer", cache_hit)
+        record_generation(trace, 100, 5, 0.03, [], 0.2)
+        telemetry.write(trace)
+
+    text = telemetry.prometheus_text()
+    assert 'offline_rag_requests_total{kind="chat",status="ok"} 2' in text
+    assert 'offline_rag_cache_lookups_total{cache="answer",outcome="hit"} 1' in text
+    assert 'offline_rag_tokens_total{kind="generated"} 10' in text
+    assert 'offline_rag_time_to_first_token_seconds_bucket{le="0.025"} 0' in text
+    assert 'offline_rag_time_to_first_token_seconds_bucket{le="0.05"} 2' in text
+    assert 'offline_rag_time_to_first_token_seconds_bucket{le="60.0"} 2' in text
+    assert 'offline_rag_time_to_first_token_seconds_count 2' in text
+    # Stages the requests never reached have empty histograms
+    assert 'offline_rag_embed_query_seconds_count 0' in text
+
+
+def test_log_file_is_rotated(tmp_path):
+    path = tmp_path / "requests.jsonl"
+    telemetry = Telemetry(str(path), max_bytes=600, backups=2)
+    for index in range(20):
+        telemetry.write(start_trace("chat", question=f"question {index} " + "x" * 100))
+    telemetry.close()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["requests.jsonl", "requests.jsonl.1", "requests.jsonl.2"]
+    assert read_records(path)[-1]["question"].startswith("question 19 ")
+    assert telemetry.summary()["requests"] == 20
+
+
+def test_stream_status_follows_the_consumer():
+    telemetry = Telemetry()
+
+    trace = start_trace("chat")
+    assert "".join(trace_stream(iter(["a", "b"]), trace, telemetry)) == "ab"
+
+    trace = start_trace("chat")
+    stream = trace_stream(iter(["a", "b"]), trace, telemetry)
+    next(stream)
+    stream.close()
+
+    def failing():
+        yield "a"
+        raise RuntimeError("decode failed")
+    trace = start_trace("chat")
+    with pytest.raises(RuntimeError):
+        list(trace_stream(failing(), trace, telemetry))
+
+    assert [record["status"] for record in telemetry.recent()] == ["ok", "cancelled", "error"]
+    assert telemetry.summary()["path"] is None